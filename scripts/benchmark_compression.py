@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+import argparse
+
+
+def main(args):
+    import os
+    import time
+    import shutil
+    import tempfile
+
+    import numpy as np
+    import h5py
+
+    from rnn_tauid.conversion import codec_options, manifest_name, \
+        is_stats_dataset
+    from rnn_tauid.utils import open_sample
+
+    # Load datasets to benchmark from the sample
+    with open_sample(args.sample) as f:
+        names = []
+        f.visititems(lambda name, node: names.append(name)
+                     if isinstance(node, h5py.Dataset)
+                     and name != manifest_name
+                     and not is_stats_dataset(name) else None)
+
+        if args.containers:
+            names = [n for n in names if n.split("/")[0] in args.containers]
+
+        # Stored datasets with their own dtypes (e.g. compact integers)
+        data = {n: f.file[n][:args.rows] for n in names}
+
+    raw_bytes = sum(arr.nbytes for arr in data.values())
+    print("Benchmarking {} datasets ({:.1f} MB uncompressed)\n".format(
+        len(data), raw_bytes / 1024.0**2))
+
+    tmpdir = tempfile.mkdtemp(prefix="benchmark_compression_",
+                              dir=args.tmpdir)
+    results = []
+    try:
+        for codec in args.codecs:
+            opts = codec_options(codec, fletcher32=args.fletcher32)
+            fn = os.path.join(tmpdir, "{}.h5".format(codec))
+
+            # Write
+            start = time.time()
+            with h5py.File(fn, "w") as f:
+                for name, arr in data.items():
+                    f.create_dataset(name, data=arr, **opts)
+            t_write = time.time() - start
+
+            file_bytes = os.path.getsize(fn)
+
+            # Read (best of 'repeat' to reduce the influence of the first
+            # read from disk)
+            dest = {name: np.empty_like(arr) for name, arr in data.items()}
+            t_read = float("inf")
+            for _ in range(args.repeat):
+                start = time.time()
+                with h5py.File(fn, "r") as f:
+                    for name in data:
+                        f[name].read_direct(dest[name])
+                t_read = min(t_read, time.time() - start)
+
+            for name, arr in data.items():
+                np.testing.assert_array_equal(arr, dest[name])
+            del dest
+
+            results.append((codec, float(raw_bytes) / file_bytes,
+                            raw_bytes / t_write / 1024.0**2,
+                            raw_bytes / t_read / 1024.0**2))
+            os.remove(fn)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print("{:<12} {:>8} {:>12} {:>12}".format(
+        "Codec", "Ratio", "Write MB/s", "Read MB/s"))
+    for codec, ratio, write_speed, read_speed in results:
+        print("{:<12} {:>8.2f} {:>12.1f} {:>12.1f}".format(
+            codec, ratio, write_speed, read_speed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measures compression ratio and write / read throughput "
+                    "of the compression codecs on a converted sample")
+    parser.add_argument("sample", help="Converted sample (hdf5)")
+
+    parser.add_argument("--codecs", nargs="+",
+                        default=["none", "lzf", "gzip-1", "gzip-4", "gzip-9",
+                                 "blosc-lz4", "blosc-zstd"],
+                        help="Codecs to benchmark")
+    parser.add_argument("--containers", nargs="+", default=None,
+                        help="Containers to benchmark (default: all)")
+    parser.add_argument("--rows", type=int, default=1000000,
+                        help="Number of rows to use from every dataset")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of read repetitions")
+    parser.add_argument("--no-fletcher32", dest="fletcher32",
+                        action="store_false",
+                        help="Benchmark without fletcher32 checksums")
+    parser.add_argument("--tmpdir", default=None,
+                        help="Directory for the benchmark files")
+
+    args = parser.parse_args()
+    main(args)
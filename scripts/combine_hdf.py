@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+import argparse
+import logging as log
+import sys
+
+
+def main(args):
+    import h5py
+
+    from rnn_tauid.utils import h5file_kwargs
+    from rnn_tauid.conversion import combine_samples
+
+    log.basicConfig(level=log.INFO)
+
+    # Sources are opened with the driver of the output file
+    family = "%d" in args.outfile
+    mismatch = [fn for fn in args.samples if ("%d" in fn) != family]
+    if mismatch:
+        log.error("Samples split with '%d' can only be combined into an "
+                  "output split with '%d' and vice versa: " +
+                  ", ".join(mismatch))
+        sys.exit(1)
+
+    srcfs = []
+    try:
+        for fn in args.samples:
+            srcfs.append(h5py.File(fn, "r", **h5file_kwargs(fn)))
+
+        with h5py.File(args.outfile, "w",
+                       **h5file_kwargs(args.outfile)) as outf:
+            n_events = combine_samples(outf, args.samples, srcfs)
+
+        log.info("Combined {} samples with {} events into {}".format(
+            len(srcfs), n_events, args.outfile))
+    finally:
+        for f in srcfs:
+            f.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Combines converted samples into a single sample of "
+                    "virtual datasets referencing the inputs (no copy)")
+    parser.add_argument("outfile", help="Combined sample")
+    parser.add_argument("samples", nargs="+",
+                        help="Samples to combine (in this order)")
+
+    args = parser.parse_args()
+    main(args)
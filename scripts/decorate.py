@@ -9,13 +9,17 @@ def main(args):
     from tqdm import tqdm
     from keras.models import load_model
 
-    from rnn_tauid.utils import load_vars
+    from rnn_tauid.utils import load_vars, open_sample, aligned_chunksize, \
+        ReadPlan
     from rnn_tauid.preprocessing import load_preprocessing
+    from rnn_tauid.expressions import Transform
+    from rnn_tauid.pipeline import Pipeline
 
-    # Determine prongness
-    if "1p" in args.data.lower():
+    # Determine prongness (from the selection if given)
+    name = (args.selection or args.data).lower()
+    if "1p" in name:
         prong = "1p"
-    elif "3p" in args.data.lower():
+    elif "3p" in name:
         prong = "3p"
     else:
         print("Could not infer prongness from sample name.")
@@ -59,23 +63,43 @@ def main(args):
         assert n_cls_vars == len(cls_varnames)
 
     # Load data and decorate
-    h5file = dict(driver="family", memb_size=8*1024**3)
-    with h5py.File(args.data, "r", **h5file) as data:
+    with open_sample(args.data, selection=args.selection) as data:
         length = len(data["TauJets/pt"])
 
+        # Read whole chunks of the input datasets
+        args.chunksize = aligned_chunksize(data, args.chunksize)
+
         chunks = [(i, min(length, i + args.chunksize))
                   for i in range(0, length, args.chunksize)]
 
-        # Arrays to store inputs / outputs
-        x_jet = np.empty((args.chunksize, n_jet_vars), dtype=np.float32)
-        x_trk = np.empty((args.chunksize, n_trk, n_trk_vars), dtype=np.float32)
-        if args.do_clusters:
-            x_cls = np.empty((args.chunksize, n_cls, n_cls_vars), dtype=np.float32)
+        # Ring of input arrays filled in the background
+        def alloc():
+            x_jet = np.empty((args.chunksize, n_jet_vars), dtype=np.float32)
+            x_trk = np.empty((args.chunksize, n_trk, n_trk_vars),
+                             dtype=np.float32)
+            if args.do_clusters:
+                x_cls = np.empty((args.chunksize, n_cls, n_cls_vars),
+                                 dtype=np.float32)
+                return x_jet, x_trk, x_cls
+
+            return x_jet, x_trk
 
         pred = np.full(length, -999.0, dtype=np.float32)
 
-        # Iterate chunks and predict NN output
-        for start, stop in tqdm(chunks):
+        # Datasets shared by several variables are read once per chunk
+        groups = [(jet_vars, None), (trk_vars, n_trk)]
+        if args.do_clusters:
+            groups.append((cls_vars, n_cls))
+        plan = ReadPlan(data, *groups)
+
+        # Load and preprocess a chunk
+        def fill(chunk, buffers):
+            start, stop = chunk
+            if args.do_clusters:
+                x_jet, x_trk, x_cls = buffers
+            else:
+                x_jet, x_trk = buffers
+
             # Slices
             src_jet = np.s_[start:stop]
             src_trk = np.s_[start:stop, :n_trk]
@@ -83,17 +107,25 @@ def main(args):
                 src_cls = np.s_[start:stop, :n_cls]
 
             len_slice = stop - start
+            reader = plan.reader()
 
             # Jet variables
             for i, (varname, func) in enumerate(zip(jet_varnames, jet_func)):
                 # Destination slice
                 dest = np.s_[:len_slice, ..., i]
 
+                # Transforms apply offset and scale in the same pass
+                if isinstance(func, Transform):
+                    func(reader, x_jet, source_sel=src_jet, dest_sel=dest,
+                         offset=offset["jet_preproc"][varname],
+                         scale=scale["jet_preproc"][varname])
+                    continue
+
                 # Call function if var is calculated. Otherwise load from file.
                 if func:
-                    func(data, x_jet, source_sel=src_jet, dest_sel=dest)
+                    func(reader, x_jet, source_sel=src_jet, dest_sel=dest)
                 else:
-                    data[varname].read_direct(x_jet, source_sel=src_jet, dest_sel=dest)
+                    reader[varname].read_direct(x_jet, source_sel=src_jet, dest_sel=dest)
 
                 # Apply offset and scale
                 x_jet[dest] -= offset["jet_preproc"][varname]
@@ -104,12 +136,19 @@ def main(args):
                 # Destination slice
                 dest = np.s_[:len_slice, ..., i]
 
+                # Transforms apply offset and scale in the same pass
+                if isinstance(func, Transform):
+                    func(reader, x_trk, source_sel=src_trk, dest_sel=dest,
+                         offset=offset["trk_preproc"][varname],
+                         scale=scale["trk_preproc"][varname])
+                    continue
+
                 # Call function if var is calculated. Otherwise load from file.
                 if func:
-                    func(data, x_trk, source_sel=src_trk, dest_sel=dest)
+                    func(reader, x_trk, source_sel=src_trk, dest_sel=dest)
                 else:
-                    data[varname].read_direct(x_trk, source_sel=src_trk,
-                                              dest_sel=dest)
+                    reader[varname].read_direct(x_trk, source_sel=src_trk,
+                                                dest_sel=dest)
 
                 # Apply offset and scale
                 x_trk[dest] -= offset["trk_preproc"][varname]
@@ -123,13 +162,20 @@ def main(args):
                     # Destination slice
                     dest = np.s_[:len_slice, ..., i]
 
+                    # Transforms apply offset and scale in the same pass
+                    if isinstance(func, Transform):
+                        func(reader, x_cls, source_sel=src_cls, dest_sel=dest,
+                             offset=offset["cls_preproc"][varname],
+                             scale=scale["cls_preproc"][varname])
+                        continue
+
                     # Call function if var is calculated. Otherwise load from
                     # file.
                     if func:
-                        func(data, x_cls, source_sel=src_cls, dest_sel=dest)
+                        func(reader, x_cls, source_sel=src_cls, dest_sel=dest)
                     else:
-                        data[varname].read_direct(x_cls, source_sel=src_cls,
-                                                  dest_sel=dest)
+                        reader[varname].read_direct(x_cls, source_sel=src_cls,
+                                                    dest_sel=dest)
 
                     # Apply offset and scale
                     x_cls[dest] -= offset["cls_preproc"][varname]
@@ -141,16 +187,28 @@ def main(args):
             if args.do_clusters:
                 x_cls[np.isnan(x_cls)] = 0
 
+        # Next chunks are prepared while predicting
+        pipeline = Pipeline(fill, alloc, depth=args.queue_depth,
+                            workers=args.workers)
+
+        # Iterate chunks and predict NN output
+        for (start, stop), buffers, _ in tqdm(pipeline.run(chunks),
+                                              total=len(chunks)):
+            len_slice = stop - start
+
             # Predict
             if args.do_clusters:
+                x_jet, x_trk, x_cls = buffers
                 pred[start:stop] = model.predict(
                     [x_trk[:len_slice], x_cls[:len_slice], x_jet[:len_slice]],
                     batch_size=1024).ravel()
             else:
+                x_jet, x_trk = buffers
                 pred[start:stop] = model.predict(
                     [x_trk[:len_slice], x_jet[:len_slice]],
                     batch_size=1024).ravel()
 
+        print(pipeline.summary())
 
         with h5py.File(args.outfile, "w") as outf:
             outf["score"] = pred
@@ -162,7 +220,15 @@ if __name__ == "__main__":
     parser.add_argument("model")
     parser.add_argument("data")
 
-    parser.add_argument("--chunksize", default=500000)
+    parser.add_argument("--selection", default=None,
+                        help="Decorate events passing this selection flag "
+                             "(e.g. 1p)")
+    parser.add_argument("--chunksize", type=int, default=500000)
+    parser.add_argument("--queue-depth", type=int, default=2,
+                        help="Number of chunks prepared in the background "
+                             "(0 to prepare in the main thread)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of threads preparing chunks")
     parser.add_argument("--var-mod", default=None)
     parser.add_argument("-o", "--outfile", default="deco.h5")
 
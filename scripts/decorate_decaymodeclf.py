@@ -10,8 +10,11 @@ def main(args):
     from tqdm import tqdm
     from keras.models import load_model
 
-    from rnn_tauid.utils import load_vars_decaymodeclf
+    from rnn_tauid.utils import load_vars_decaymodeclf, open_sample, \
+        aligned_chunksize, ReadPlan
     from rnn_tauid.preprocessing import load_preprocessing
+    from rnn_tauid.expressions import Transform
+    from rnn_tauid.pipeline import Pipeline
 
     logging.basicConfig(level=logging.INFO)
     log = logging.getLogger("main")
@@ -51,25 +54,34 @@ def main(args):
     assert n_conv_vars == len(conv_varnames)
 
     # Load data and decorate
-    h5file = dict(driver="family", memb_size=8*1024**3)
-    with h5py.File(args.data, "r", **h5file) as data:
+    with open_sample(args.data) as data:
         length = len(data["TauJets/pt"])
 
+        # Read whole chunks of the input datasets
+        args.chunksize = aligned_chunksize(data, args.chunksize)
+
         chunks = [(i, min(length, i + args.chunksize))
                   for i in range(0, length, args.chunksize)]
 
-        # Arrays to store inputs / outputs
-        log.info("Allocating memory for evaluation ...")
-        x_chrg = np.empty((args.chunksize, n_chrg, n_chrg_vars), dtype=np.float32)
-        x_neut = np.empty((args.chunksize, n_neut, n_neut_vars), dtype=np.float32)
-        x_shot = np.empty((args.chunksize, n_shot, n_shot_vars), dtype=np.float32)
-        x_conv = np.empty((args.chunksize, n_conv, n_conv_vars), dtype=np.float32)
+        # Ring of input arrays filled in the background
+        def alloc():
+            x_chrg = np.empty((args.chunksize, n_chrg, n_chrg_vars), dtype=np.float32)
+            x_neut = np.empty((args.chunksize, n_neut, n_neut_vars), dtype=np.float32)
+            x_shot = np.empty((args.chunksize, n_shot, n_shot_vars), dtype=np.float32)
+            x_conv = np.empty((args.chunksize, n_conv, n_conv_vars), dtype=np.float32)
+            return x_chrg, x_neut, x_shot, x_conv
 
         pred = np.empty((length, n_classes), dtype=np.float32)
 
-        # Iterate chunks and predict NN output
-        log.info("Starting prediction loop ...")
-        for start, stop in tqdm(chunks):
+        # Datasets shared by several variables are read once per chunk
+        plan = ReadPlan(data, (chrg_vars, n_chrg), (neut_vars, n_neut),
+                        (shot_vars, n_shot), (conv_vars, n_conv))
+
+        # Load and preprocess a chunk
+        def fill(chunk, buffers):
+            start, stop = chunk
+            x_chrg, x_neut, x_shot, x_conv = buffers
+
             # Slices
             src_chrg = np.s_[start:stop, :n_chrg]
             src_neut = np.s_[start:stop, :n_neut]
@@ -77,18 +89,26 @@ def main(args):
             src_conv = np.s_[start:stop, :n_conv]
 
             len_slice = stop - start
+            reader = plan.reader()
 
             log.debug("Loading and preprocessing charged PFO data ...")
             for i, (varname, func) in enumerate(zip(chrg_varnames, chrg_func)):
                 # Destination slice
                 dest = np.s_[:len_slice, ..., i]
 
+                # Transforms apply offset and scale in the same pass
+                if isinstance(func, Transform):
+                    func(reader, x_chrg, source_sel=src_chrg, dest_sel=dest,
+                         offset=offset["chrg_preproc"][varname],
+                         scale=scale["chrg_preproc"][varname])
+                    continue
+
                 # Call function if var is calculated. Otherwise load from file.
                 if func:
-                    func(data, x_chrg, source_sel=src_chrg, dest_sel=dest)
+                    func(reader, x_chrg, source_sel=src_chrg, dest_sel=dest)
                 else:
-                    data[varname].read_direct(x_chrg, source_sel=src_chrg,
-                                              dest_sel=dest)
+                    reader[varname].read_direct(x_chrg, source_sel=src_chrg,
+                                                dest_sel=dest)
 
                 # Apply offset and scale
                 x_chrg[dest] -= offset["chrg_preproc"][varname]
@@ -100,12 +120,19 @@ def main(args):
                 # Destination slice
                 dest = np.s_[:len_slice, ..., i]
 
+                # Transforms apply offset and scale in the same pass
+                if isinstance(func, Transform):
+                    func(reader, x_neut, source_sel=src_neut, dest_sel=dest,
+                         offset=offset["neut_preproc"][varname],
+                         scale=scale["neut_preproc"][varname])
+                    continue
+
                 # Call function if var is calculated. Otherwise load from file.
                 if func:
-                    func(data, x_neut, source_sel=src_neut, dest_sel=dest)
+                    func(reader, x_neut, source_sel=src_neut, dest_sel=dest)
                 else:
-                    data[varname].read_direct(x_neut, source_sel=src_neut,
-                                              dest_sel=dest)
+                    reader[varname].read_direct(x_neut, source_sel=src_neut,
+                                                dest_sel=dest)
 
                 # Apply offset and scale
                 x_neut[dest] -= offset["neut_preproc"][varname]
@@ -117,12 +144,19 @@ def main(args):
                 # Destination slice
                 dest = np.s_[:len_slice, ..., i]
 
+                # Transforms apply offset and scale in the same pass
+                if isinstance(func, Transform):
+                    func(reader, x_shot, source_sel=src_shot, dest_sel=dest,
+                         offset=offset["shot_preproc"][varname],
+                         scale=scale["shot_preproc"][varname])
+                    continue
+
                 # Call function if var is calculated. Otherwise load from file.
                 if func:
-                    func(data, x_shot, source_sel=src_shot, dest_sel=dest)
+                    func(reader, x_shot, source_sel=src_shot, dest_sel=dest)
                 else:
-                    data[varname].read_direct(x_shot, source_sel=src_shot,
-                                              dest_sel=dest)
+                    reader[varname].read_direct(x_shot, source_sel=src_shot,
+                                                dest_sel=dest)
 
                 # Apply offset and scale
                 x_shot[dest] -= offset["shot_preproc"][varname]
@@ -134,12 +168,19 @@ def main(args):
                 # Destination slice
                 dest = np.s_[:len_slice, ..., i]
 
+                # Transforms apply offset and scale in the same pass
+                if isinstance(func, Transform):
+                    func(reader, x_conv, source_sel=src_conv, dest_sel=dest,
+                         offset=offset["conv_preproc"][varname],
+                         scale=scale["conv_preproc"][varname])
+                    continue
+
                 # Call function if var is calculated. Otherwise load from file.
                 if func:
-                    func(data, x_conv, source_sel=src_conv, dest_sel=dest)
+                    func(reader, x_conv, source_sel=src_conv, dest_sel=dest)
                 else:
-                    data[varname].read_direct(x_conv, source_sel=src_conv,
-                                              dest_sel=dest)
+                    reader[varname].read_direct(x_conv, source_sel=src_conv,
+                                                dest_sel=dest)
 
                 # Apply offset and scale
                 x_conv[dest] -= offset["conv_preproc"][varname]
@@ -164,11 +205,25 @@ def main(args):
             x_shot[np.isnan(x_shot)] = 0
             x_conv[np.isnan(x_conv)] = 0
 
+        # Next chunks are prepared while predicting
+        log.info("Allocating memory for evaluation ...")
+        pipeline = Pipeline(fill, alloc, depth=args.queue_depth,
+                            workers=args.workers)
+
+        # Iterate chunks and predict NN output
+        log.info("Starting prediction loop ...")
+        for (start, stop), buffers, _ in tqdm(pipeline.run(chunks),
+                                              total=len(chunks)):
+            x_chrg, x_neut, x_shot, x_conv = buffers
+            len_slice = stop - start
+
             # Predict
             pred[start:stop] = model.predict(
                 [x_chrg[:len_slice], x_neut[:len_slice], x_shot[:len_slice], x_conv[:len_slice]],
                 batch_size=1024**2)
 
+        log.info(pipeline.summary())
+
         log.info("Saving predictions to {} ...".format(args.outfile))
         with h5py.File(args.outfile, "w") as outf:
             outf["score"] = pred
@@ -181,7 +236,12 @@ if __name__ == "__main__":
     parser.add_argument("data")
 
 
-    parser.add_argument("--chunksize", default=500000)
+    parser.add_argument("--chunksize", type=int, default=500000)
+    parser.add_argument("--queue-depth", type=int, default=2,
+                        help="Number of chunks prepared in the background "
+                             "(0 to prepare in the main thread)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of threads preparing chunks")
     parser.add_argument("--var-mod", default=None)
     parser.add_argument("-o", "--outfile", default="deco.h5")
 
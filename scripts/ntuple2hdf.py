@@ -1,13 +1,24 @@
 #!/usr/bin/env python
 import argparse
 import logging as log
+import os
+import shutil
 import sys
+import tempfile
+from fnmatch import fnmatch
+from functools import partial
 
 import numpy as np
 import h5py
 from tqdm import tqdm
 
 from rnn_tauid import cuts
+from rnn_tauid.utils import h5file_kwargs
+from rnn_tauid.conversion import Container, codec_options, codecs, \
+    storages, convert_serial, convert_parallel, convert_streaming, \
+    write_layout_attrs, manifest_name, read_manifest, write_manifest, \
+    append_sample, block_shuffle, compact_dtypes, dataset_name, \
+    write_stats, remove_stats, is_stats_dataset
 
 
 def get_args():
@@ -27,7 +38,68 @@ def get_args():
                         help="Name of the input tree")
     parser.add_argument("--sel", help="Additional selection "
                                       "(e.g. TauJets.mcEventNumber % 2 == 0)")
+    parser.add_argument("--fanout", nargs=3, action="append", default=[],
+                        metavar=("OUTFILE", "SELECTION", "SEL"),
+                        help="Additional output written from the same pass "
+                             "over the input files with its own selection "
+                             "and additional selection (may be empty)")
+    parser.add_argument("--flags", nargs="*", default=None,
+                        metavar="SELECTION",
+                        help="Store the result of these selections (default: "
+                             "all selections in cuts.sel_dict) as bits in "
+                             "TauJets/selection")
     parser.add_argument("--debug", action="store_true")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of worker processes converting input "
+                             "files in parallel")
+    parser.add_argument("--memory-budget", type=float, default=None,
+                        help="Read input files in blocks of entries fitting "
+                             "into this amount of memory (in MB, shared "
+                             "between all workers)")
+    parser.add_argument("--tmpdir", default=None,
+                        help="Directory for intermediate files of the "
+                             "parallel / streaming / append conversion")
+    parser.add_argument("--append", action="store_true",
+                        help="Append input files not yet listed in the "
+                             "manifest of existing output files")
+    parser.add_argument("--shuffle-block", type=int, default=None,
+                        help="Number of events per block for mixing appended "
+                             "events into existing events (default: chunk "
+                             "size of the output or 8192)")
+
+    parser.add_argument("--compression", default="gzip-9",
+                        help="Compression codec for all containers "
+                             "(available: {})".format(", ".join(codecs)))
+    parser.add_argument("--codec", action="append", default=[],
+                        metavar="CONTAINER=CODEC",
+                        help="Compression codec for a single container "
+                             "(e.g. TauTracks=lzf)")
+    parser.add_argument("--no-fletcher32", dest="fletcher32",
+                        action="store_false",
+                        help="Do not store fletcher32 checksums")
+
+    parser.add_argument("--layout", choices=["auto", "rows"], default="auto",
+                        help="Chunk layout: chosen by h5py ('auto') or "
+                             "blocks of events spanning the full object axis "
+                             "('rows')")
+    parser.add_argument("--chunk-rows", type=int, default=8192,
+                        help="Number of events per chunk for '--layout rows'")
+    parser.add_argument("--dtypes", choices=["float32", "compact"],
+                        default="float32",
+                        help="Store all variables as float32 or integer "
+                             "variables (e.g. hit counts) as small integer "
+                             "types ('compact')")
+    parser.add_argument("--dtype", action="append", default=[],
+                        metavar="PATTERN=DTYPE",
+                        help="Storage type for variables matching a pattern "
+                             "(e.g. 'TauTracks/n*Hits=uint8' or "
+                             "'TauClusters/SECOND_R=float16')")
+    parser.add_argument("--storage", choices=storages, default="dense",
+                        help="Store one dataset per branch ('dense'), a "
+                             "single dataset per container ('packed') or "
+                             "sequences without padding ('ragged')")
+    parser.add_argument("--no-stats", dest="stats", action="store_false",
+                        help="Do not store statistics of the variables")
 
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("--tauid", action="store_true")
@@ -50,82 +122,82 @@ def get_args():
     return parser.parse_args()
 
 
-# Global config
-default_value = 0
-seed = 1234567890
+def tau_selection(selection, extra_sel=None):
+    """Combines a selection from 'cuts.sel_dict' with an additional selection"""
+    sel = cuts.sel_dict[selection]
+    if extra_sel:
+        sel = "({}) && ({})".format(sel, extra_sel)
 
-# h5py dataset kwargs
-h5opt = {
-    "compression": "gzip",
-    "compression_opts": 9,
-    "shuffle": True,
-    "fletcher32": True
-}
+    return sel
 
 
-def load_scalar(branches, sel, outf, args):
-    # Number of events after selection
-    n_events = None
+def is_consistent(outf):
+    """
+    Checks that all datasets in the file have the same length. For ragged
+    containers the number of events is given by the counts and the flat
+    datasets have to match the total number of objects.
+    """
+    lengths = set()
 
-    for br in tqdm(branches, disable=args.quiet):
-        data = root2array(args.infiles, treename=args.treename,
-                          branches=br, selection=sel)
-        data = data.astype(np.float32)
+    def visitor(name, node):
+        if not isinstance(node, h5py.Dataset) or name == manifest_name or \
+           is_stats_dataset(name):
+            return
 
-        # Check if same number of events and shuffle
-        if n_events:
-            assert n_events == len(data)
+        group = node.parent
+        if group.attrs.get("storage") == "ragged":
+            if node.name == group["_counts"].name:
+                lengths.add(len(node))
+            elif node.name != group["_offsets"].name:
+                if len(node) != group["_offsets"][-1]:
+                    lengths.add(-1)
         else:
-            n_events = len(data)
+            lengths.add(len(node))
 
-        random_state = np.random.RandomState(seed=seed)
-        random_state.shuffle(data)
+    outf.visititems(visitor)
+    return len(lengths) <= 1
 
-        outf.create_dataset("{}/{}".format(*br.split(".")), data=data,
-                            dtype=np.float32, **h5opt)
 
+if __name__ == "__main__":
+    args = get_args()
+    log.basicConfig(level=log.DEBUG if args.debug else log.INFO)
 
-def load_sequence(branches, mask_branch, max_len, sel, outf, args):
-    # Number of events after selection
-    n_events = None
-
-    mask = root2array(
-        args.infiles, treename=args.treename,
-        branches=(mask_branch, default_value, max_len),
-        selection=sel)
-    mask = (mask == 0)
-
-    for br in tqdm(branches, disable=args.quiet):
-        data = root2array(args.infiles, treename=args.treename,
-                          branches=(br, default_value, max_len),
-                          selection=sel)
-        data = data.astype(np.float32)
-
-        # Set nan
-        data[mask] = np.nan
+    # Input files not yet converted into the outputs
+    if args.append:
+        if args.storage == "ragged":
+            log.error("Cannot append with ragged storage (appended events "
+                      "cannot be mixed into the existing events)")
+            sys.exit(1)
 
-        # Check if same number of events and shuffle
-        if n_events:
-            assert n_events == len(data)
-        else:
-            n_events = len(data)
+        manifests = []
+        for outfile in [args.outfile] + [f[0] for f in args.fanout]:
+            with h5py.File(outfile, "r", **h5file_kwargs(outfile)) as outf:
+                manifests.append(read_manifest(outf))
 
-        random_state = np.random.RandomState(seed=seed)
-        random_state.shuffle(data)
+        if any(m is None for m in manifests):
+            log.error("Cannot append to outputs without manifest")
+            sys.exit(1)
 
-        outf.create_dataset("{}/{}".format(*br.split(".")),
-                            data=data, dtype=np.float32, **h5opt)
+        if any(set(m) != set(manifests[0]) for m in manifests):
+            log.error("Outputs were converted from different input files")
+            sys.exit(1)
 
+        infiles = [fn for fn in args.infiles
+                   if os.path.abspath(fn) not in set(manifests[0])]
+        log.info("Skipping {} input files already converted".format(
+            len(args.infiles) - len(infiles)))
 
-if __name__ == "__main__":
-    args = get_args()
-    log.basicConfig(level=log.DEBUG if args.debug else log.INFO)
+        if not infiles:
+            log.info("No new input files to append")
+            sys.exit(0)
+    else:
+        infiles = args.infiles
 
     # Load here to avoid root taking over the command line
-    from root_numpy import root2array, list_branches
+    from root_numpy import list_branches
 
     # Branches to load
-    branches = list_branches(args.infiles[0], treename=args.treename)
+    branches = list_branches(infiles[0], treename=args.treename)
     jet_branches = [br for br in branches if br.startswith("TauJets")]
 
     if args.tauid:
@@ -140,61 +212,181 @@ if __name__ == "__main__":
         log.error("Could not determine run mode. Exiting ...")
         sys.exit(1)
 
-    # Tau selection
-    sel = cuts.sel_dict[args.selection]
-    if args.sel:
-        sel = "({}) && ({})".format(sel, args.sel)
-
-    log.info("Applying selection: " + sel)
+    # Outputs and their tau selections
+    outfiles = [args.outfile]
+    sels = [tau_selection(args.selection, args.sel)]
 
-    with h5py.File(args.outfile, "w", driver="family",
-                   memb_size=8*1024**3) as outf:
-        log.info("Loading jet branches ...")
-        load_scalar(jet_branches, sel, outf, args)
+    for outfile, selection, extra_sel in args.fanout:
+        if selection not in cuts.sel_dict:
+            log.error("Unknown selection: " + selection)
+            sys.exit(1)
 
-        if args.tauid:
-            log.info("Loading track branches ...")
-            load_sequence(track_branches, "TauTracks.pt", args.tracks, sel, outf, args)
+        outfiles.append(outfile)
+        sels.append(tau_selection(selection, extra_sel))
 
-            log.info("Loading cluster branches ...")
-            load_sequence(cluster_branches, "TauClusters.et", args.clusters, sel, outf, args)
+    for outfile, sel in zip(outfiles, sels):
+        log.info("Applying selection for {}: {}".format(outfile, sel))
 
-        elif args.decaymodeclf:
-            log.info("Loading charged PFO branches ...")
-            load_sequence(chrg_pfo_branches, "ChargedPFO.pt", args.chrg_pfos, sel, outf, args)
+    # Selection flags
+    if args.flags is not None:
+        flag_names = args.flags or sorted(cuts.sel_dict)
+        unknown = set(flag_names) - set(cuts.sel_dict)
+        if unknown:
+            log.error("Unknown selections: " + ", ".join(unknown))
+            sys.exit(1)
 
-            log.info("Loading neutral PFO branches ...")
-            load_sequence(neut_pfo_branches, "NeutralPFO.pt", args.neut_pfos, sel, outf, args)
+        flags = [(name, cuts.sel_dict[name]) for name in flag_names]
+        log.info("Storing selection flags: " + ", ".join(flag_names))
+    else:
+        flags = None
 
-            log.info("Loading shot PFO branches ...")
-            load_sequence(shot_pfo_branches, "ShotPFO.pt", args.shot_pfos, sel, outf, args)
+    # Containers to convert
+    containers = [Container("TauJets", jet_branches, None, None, flags=flags)]
 
-            log.info("Loading conversion track branches ...")
-            load_sequence(conv_branches, "ConvTrack.pt", args.conv_tracks, sel, outf, args)
+    if args.tauid:
+        containers += [
+            Container("TauTracks", track_branches, "TauTracks.pt",
+                      args.tracks),
+            Container("TauClusters", cluster_branches, "TauClusters.et",
+                      args.clusters)
+        ]
+    elif args.decaymodeclf:
+        containers += [
+            Container("ChargedPFO", chrg_pfo_branches, "ChargedPFO.pt",
+                      args.chrg_pfos),
+            Container("NeutralPFO", neut_pfo_branches, "NeutralPFO.pt",
+                      args.neut_pfos),
+            Container("ShotPFO", shot_pfo_branches, "ShotPFO.pt",
+                      args.shot_pfos),
+            Container("ConvTrack", conv_branches, "ConvTrack.pt",
+                      args.conv_tracks)
+        ]
+
+    # Compression codecs
+    container_codecs = dict(c.split("=", 1) for c in args.codec)
+    unknown = set(container_codecs) - set(c.name for c in containers)
+    if unknown:
+        log.error("Unknown containers: " + ", ".join(unknown))
+        sys.exit(1)
 
+    for i, container in enumerate(containers):
+        codec = container_codecs.get(container.name, args.compression)
+        log.info("Compression codec for {}: {}".format(container.name, codec))
+        containers[i] = container._replace(
+            h5opt=codec_options(codec, fletcher32=args.fletcher32))
+
+    # Storage format
+    containers = [c._replace(storage=args.storage) for c in containers]
+
+    # Storage types (later patterns take precedence)
+    dtype_rules = compact_dtypes if args.dtypes == "compact" else []
+    dtype_rules = dtype_rules + [tuple(d.split("=", 1)) for d in args.dtype]
+
+    for i, container in enumerate(containers):
+        dtypes = {}
+        for br in container.branches:
+            for pattern, dtype in dtype_rules:
+                if fnmatch(dataset_name(br), pattern):
+                    dtypes[dataset_name(br)] = np.dtype(dtype).name
+
+        if dtypes and container.storage == "packed":
+            log.warning("Storage types ignored for packed container " +
+                        container.name)
+        elif dtypes:
+            for name, dtype in sorted(dtypes.items()):
+                log.info("Storing {} as {}".format(name, dtype))
+
+        containers[i] = container._replace(dtypes=dtypes)
+
+    # Chunk layout
+    if args.layout == "rows":
+        log.info("Chunking in blocks of {} events".format(args.chunk_rows))
+        containers = [c._replace(chunk_rows=args.chunk_rows)
+                      for c in containers]
+
+    if args.memory_budget:
+        memory_budget = args.memory_budget * 1024**2
+    else:
+        memory_budget = None
+
+    # When appending, the new input files are converted to temporary files
+    # first which are then appended to the outputs
+    if args.append:
+        appenddir = tempfile.mkdtemp(prefix="ntuple2hdf_", dir=args.tmpdir)
+        targets = [os.path.join(appenddir, "append_{}.h5".format(i))
+                   for i in range(len(outfiles))]
+    else:
+        appenddir = None
+        targets = outfiles
+
+    outfs = []
+    try:
+        for target in targets:
+            outfs.append(h5py.File(target, "w", **h5file_kwargs(target)))
+
+        progress = partial(tqdm, disable=args.quiet)
+
+        if args.jobs > 1:
+            if memory_budget:
+                memory_budget /= args.jobs
+
+            convert_parallel(infiles, args.treename, containers, sels,
+                             outfs, args.jobs, memory_budget=memory_budget,
+                             tmpdir=args.tmpdir, progress=progress)
+        elif memory_budget:
+            convert_streaming(infiles, args.treename, containers, sels,
+                              outfs, memory_budget, tmpdir=args.tmpdir,
+                              progress=progress)
         else:
-            log.error("Could not determine run mode. Exiting ...")
-            sys.exit(1)
+            convert_serial(infiles, args.treename, containers, sels,
+                           outfs, progress=progress)
+
+        if args.append:
+            for outf in outfs:
+                outf.close()
+
+            outfs = [h5py.File(target, "r") for target in targets]
+            newfs, outfs = outfs, []
+            try:
+                for outfile, newf in zip(outfiles, newfs):
+                    log.info("Appending to {} ...".format(outfile))
+                    outf = h5py.File(outfile, "a", **h5file_kwargs(outfile))
+                    outfs.append(outf)
+
+                    n_old = append_sample(outf, newf, containers)
+
+                    block_rows = args.shuffle_block or \
+                        outf.attrs.get("chunk_rows") or 8192
+                    block_shuffle(outf, containers, n_old, int(block_rows))
+            finally:
+                for newf in newfs:
+                    newf.close()
+        else:
+            for outf in outfs:
+                write_layout_attrs(outf, containers)
+
+        for outf in outfs:
+            write_manifest(outf, infiles)
+
+        if args.stats:
+            for outf in outfs:
+                write_stats(outf, containers)
+        elif args.append:
+            # Statistics of the existing events are outdated
+            for outf in outfs:
+                remove_stats(outf, containers)
 
         # All datasets should have the same length
         log.info("Performing consistency checks ...")
-        length = None
-
-        def inconsistency_visitor(name, node):
-            """Returns 'True' if file is inconsistent and 'None' otherwise"""
-            global length
-            if isinstance(node, h5py.Dataset):
-                # Node is a dataset
-                if length:
-                    return True if length != len(node) else None
-                else:
-                    length = len(node)
-            else:
-                return None
-
-        inconsistent = outf.visititems(inconsistency_visitor)
-        if inconsistent:
-            log.error("Array lengths inconsistent")
-            sys.exit(1)
-        else:
-            log.info("File passed consistency check")
+        for outfile, outf in zip(outfiles, outfs):
+            if not is_consistent(outf):
+                log.error("Array lengths inconsistent in " + outfile)
+                sys.exit(1)
+
+        log.info("Files passed consistency check")
+    finally:
+        for outf in outfs:
+            outf.close()
+
+        if appenddir:
+            shutil.rmtree(appenddir)
@@ -9,7 +9,7 @@ TREENAME="tree"
 TRAIN_SEL="TauJets.mcEventNumber % 2 == 0"
 TEST_SEL="TauJets.mcEventNumber % 2 == 1"
 
-FLAGS="--treename ${TREENAME}"
+FLAGS="--treename ${TREENAME} --tauid"
 
 
 if [ ! -d "$OUTDIR" ]; then
@@ -21,51 +21,22 @@ else
 fi
 
 
-# TRAINING
+# Every sample is read once and converted with the loosest selection into a
+# train and test output (fan-out). The 1-/3-prong subsets are selected through
+# the selection flags when reading the samples (e.g. '--sig-selection truth1p
+# --bkg-selection 1p' for the training scripts)
 
-# 1-prong signal (training)
-echo "Converting 1-prong signal sample (train)..."
-ntuple2hdf.py $OUTDIR/sig1P_v12_train_%d.h5 truth1p \
+# Signal
+echo "Converting signal samples (train/test)..."
+ntuple2hdf.py $OUTDIR/sigXP_v12_train_%d.h5 truthXp \
     $NTUPLE_DIR/*Gammatautau*.root \
-    $FLAGS --sel "$TRAIN_SEL"
-
-# 3-prong signal (training)
-echo "Converting 3-prong signal sample (train)..."
-ntuple2hdf.py $OUTDIR/sig3P_v12_train_%d.h5 truth3p \
-    $NTUPLE_DIR/*Gammatautau*.root \
-    $FLAGS --sel "$TRAIN_SEL"
-
-# 1-prong background (training)
-echo "Converting 1-prong background sample (train)..."
-ntuple2hdf.py $OUTDIR/bkg1P_v12_train_%d.h5 1p $NTUPLE_DIR/*JZ?W*.root \
-    $FLAGS --sel "$TRAIN_SEL"
-
-# 3-prong background (training)
-echo "Converting 3-prong background sample (train)..."
-ntuple2hdf.py $OUTDIR/bkg3P_v12_train_%d.h5 3p $NTUPLE_DIR/*JZ?W*.root \
-    $FLAGS --sel "$TRAIN_SEL"
-
-
-# TESTING
-
-# 1-prong signal (testing)
-echo "Converting 1-prong signal sample (test)..."
-ntuple2hdf.py $OUTDIR/sig1P_v12_test_%d.h5 truth1p \
-    $NTUPLE_DIR/*Gammatautau*.root \
-    $FLAGS --sel "$TEST_SEL"
-
-# 3-prong signal (testing)
-echo "Converting 3-prong signal sample (test)..."
-ntuple2hdf.py $OUTDIR/sig3P_v12_test_%d.h5 truth3p \
-    $NTUPLE_DIR/*Gammatautau*.root \
-    $FLAGS --sel "$TEST_SEL"
-
-# 1-prong background (testing)
-echo "Converting 1-prong background sample (test)..."
-ntuple2hdf.py $OUTDIR/bkg1P_v12_test_%d.h5 1p $NTUPLE_DIR/*JZ?W*.root \
-    $FLAGS --sel "$TEST_SEL"
-
-# 3-prong background (testing)
-echo "Converting 3-prong background sample (test)..."
-ntuple2hdf.py $OUTDIR/bkg3P_v12_test_%d.h5 3p $NTUPLE_DIR/*JZ?W*.root \
-    $FLAGS --sel "$TEST_SEL"
+    $FLAGS --sel "$TRAIN_SEL" \
+    --fanout $OUTDIR/sigXP_v12_test_%d.h5 truthXp "$TEST_SEL" \
+    --flags
+
+# Background
+echo "Converting background samples (train/test)..."
+ntuple2hdf.py $OUTDIR/bkgXP_v12_train_%d.h5 Xp $NTUPLE_DIR/*JZ?W*.root \
+    $FLAGS --sel "$TRAIN_SEL" \
+    --fanout $OUTDIR/bkgXP_v12_test_%d.h5 Xp "$TEST_SEL" \
+    --flags
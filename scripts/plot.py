@@ -17,11 +17,12 @@ def main(args):
         FlattenerCutmapPlot, FlattenerEfficiencyPlot, EfficiencyPlot, \
         RejectionPlot
     from rnn_tauid.plotting.utils import Sample, SampleHolder
+    from rnn_tauid.preprocessing import PtReweighter
 
 
-    # Find sample files
+    # Find sample files (Xp for samples of both prongs with selection flags)
     pattern = re.compile(r".*(?P<s>sig|bkg)"
-                         r".*(?P<p>1P|3P)"
+                         r".*(?P<p>1P|3P|XP)"
                          r".*(?P<t>train|test)"
                          r".*\D(?P<idx>\d+)"
                          r".*\.h5$",
@@ -70,30 +71,65 @@ def main(args):
     # Merge samples and scores
     merge_dict = {}
     for key in set(sample_dict.keys()) | set(score_dict.keys()):
-        if key in sample_dict:
-            merge_dict.setdefault(key, []).append(sample_dict[key])
+        # Prong subsets of samples with selection flags
+        sample_key = key
+        if key not in sample_dict:
+            sample_key = re.sub(r"_[13]p_", "_xp_", key)
+
+        if sample_key in sample_dict:
+            merge_dict.setdefault(key, []).append(sample_dict[sample_key])
         if key in score_dict:
             merge_dict.setdefault(key, []).append(score_dict[key])
 
+    # Selection flags of the signal and background ('{prong}' replaced by
+    # 1p / 3p), None to read all events
+    def selections(prong):
+        sig_sel = args.sig_selection or args.selection
+        bkg_sel = args.selection
+        return [sel.format(prong=prong) if sel else None
+                for sel in (sig_sel, bkg_sel)]
+
+    # pt-reweighting of the background stored by the training ('{prong}'
+    # replaced by 1p / 3p), None to fit the reweighting
+    def reweighter(prong):
+        if not args.preprocessing:
+            return None
+
+        filename = args.preprocessing.format(prong=prong)
+        try:
+            return PtReweighter.load(filename)
+        except KeyError:
+            print("No pt-reweighting stored in {}, fitting the "
+                  "reweighting".format(filename))
+            return None
+
     # Input samples
     inputs = {}
 
     if args.prong_1:
+        sig_sel, bkg_sel = selections("1p")
+        rw = reweighter("1p")
         samples_1p = SampleHolder(
-            sig_train=Sample(*merge_dict["sig_1p_train"]),
-            sig_test=Sample(*merge_dict["sig_1p_test"]),
-            bkg_train=Sample(*merge_dict["bkg_1p_train"]),
-            bkg_test=Sample(*merge_dict["bkg_1p_test"])
+            sig_train=Sample(*merge_dict["sig_1p_train"], selection=sig_sel),
+            sig_test=Sample(*merge_dict["sig_1p_test"], selection=sig_sel),
+            bkg_train=Sample(*merge_dict["bkg_1p_train"], selection=bkg_sel,
+                             reweighter=rw),
+            bkg_test=Sample(*merge_dict["bkg_1p_test"], selection=bkg_sel,
+                            reweighter=rw)
         )
 
         inputs["1P"] = samples_1p
 
     if args.prong_3:
+        sig_sel, bkg_sel = selections("3p")
+        rw = reweighter("3p")
         samples_3p = SampleHolder(
-            sig_train=Sample(*merge_dict["sig_3p_train"]),
-            sig_test=Sample(*merge_dict["sig_3p_test"]),
-            bkg_train=Sample(*merge_dict["bkg_3p_train"]),
-            bkg_test=Sample(*merge_dict["bkg_3p_test"])
+            sig_train=Sample(*merge_dict["sig_3p_train"], selection=sig_sel),
+            sig_test=Sample(*merge_dict["sig_3p_test"], selection=sig_sel),
+            bkg_train=Sample(*merge_dict["bkg_3p_train"], selection=bkg_sel,
+                             reweighter=rw),
+            bkg_test=Sample(*merge_dict["bkg_3p_test"], selection=bkg_sel,
+                            reweighter=rw)
         )
 
         inputs["3P"] = samples_3p
@@ -177,5 +213,18 @@ if __name__ == "__main__":
     parser.add_argument("-1p", "--1-prong", dest="prong_1", action="store_true")
     parser.add_argument("-3p", "--3-prong", dest="prong_3", action="store_true")
 
+    parser.add_argument("--selection", default=None,
+                        help="Read the events passing this selection flag "
+                             "from samples converted with --flags, '{prong}' "
+                             "is replaced by 1p / 3p (e.g. '{prong}')")
+    parser.add_argument("--sig-selection", default=None,
+                        help="Selection flag of the signal if different "
+                             "(e.g. 'truth{prong}')")
+    parser.add_argument("--preprocessing", default=None,
+                        help="Preprocessing file of the training with the "
+                             "stored pt-reweighting of the background, "
+                             "'{prong}' is replaced by 1p / 3p (e.g. "
+                             "'preproc_{prong}.h5'), fitted if not given")
+
     args = parser.parse_args()
     main(args)
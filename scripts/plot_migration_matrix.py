@@ -17,6 +17,8 @@ mpl.rcParams["ytick.major.size"] = 4
 
 import matplotlib.pyplot as plt
 
+from rnn_tauid.utils import open_sample
+
 
 def migration_matrix(truth, reco, comp=False):
     assert len(truth) == len(reco)
@@ -36,7 +38,7 @@ def migration_matrix(truth, reco, comp=False):
 
 
 def main(args):
-    with h5py.File(args.data, "r", driver="family", memb_size=8*1024**3) as f:
+    with open_sample(args.data) as f:
         nTracks = f["TauJets/nTracks"][...]
         mask = (nTracks == 1) | (nTracks == 3)
 
@@ -10,16 +10,20 @@ def main(args):
     from keras.callbacks import EarlyStopping, ModelCheckpoint, CSVLogger
 
     from rnn_tauid.models import baseline_model
-    from rnn_tauid.utils import load_vars, load_data, train_test_split
-    from rnn_tauid.preprocessing import preprocess, save_preprocessing
-
-    # Determine prongness
-    if "1p" in args.sig.lower() and "1p" in args.bkg.lower():
+    from rnn_tauid.utils import load_vars, load_data, train_test_split, \
+        open_sample, fit_preprocessing
+    from rnn_tauid.preprocessing import preprocess, save_preprocessing, \
+        PtReweighter
+
+    # Determine prongness (from the selections if given)
+    sig_name = (args.sig_selection or args.sig).lower()
+    bkg_name = (args.bkg_selection or args.bkg).lower()
+    if "1p" in sig_name and "1p" in bkg_name:
         prong = "1p"
-    elif "3p" in args.sig.lower() and "3p" in args.bkg.lower():
+    elif "3p" in sig_name and "3p" in bkg_name:
         prong = "3p"
     else:
-        print("Could not infer prongness from sample names.")
+        print("Could not infer prongness from sample names / selections.")
         sys.exit(1)
 
     # Load rules for variables from file or use defaults if None
@@ -30,50 +34,124 @@ def main(args):
     trk_varnames, _, trk_preproc_func = zip(*trk_vars)
     cls_varnames, _, cls_preproc_func = zip(*cls_vars)
 
-    # Load data
-    h5file = dict(driver="family", memb_size=8*1024**3)
-    with h5py.File(args.sig, "r", **h5file) as sig, \
-         h5py.File(args.bkg, "r", **h5file) as bkg:
-        lsig = len(sig["TauJets/pt"])
-        lbkg = len(bkg["TauJets/pt"])
-
-        if args.fraction:
-            sig_idx = int(args.fraction * lsig)
-            bkg_idx = int(args.fraction * lbkg)
-        else:
-            sig_idx = lsig
-            bkg_idx = lbkg
-
-        print("Loading sig [:{}] and bkg [:{}]".format(sig_idx, bkg_idx))
-
-        # Load jet data
-        jet_data = load_data(sig, bkg, np.s_[:sig_idx], np.s_[:bkg_idx],
-                             jet_vars)
+    # Cache of the preprocessed inputs (in-memory training only)
+    cache = None
+    if args.cache_dir and not args.generator:
+        from rnn_tauid.cache import TensorCache, cache_key
 
-        # Load track data
-        trk_data = load_data(sig, bkg, np.s_[:sig_idx], np.s_[:bkg_idx],
-                             trk_vars, num=args.num_tracks)
-
-        # Load cluster data
+        variables = [jet_vars, trk_vars]
         if args.do_clusters:
-            cls_data = load_data(sig, bkg, np.s_[:sig_idx], np.s_[:bkg_idx],
-                                 cls_vars, num=args.num_clusters)
-
+            variables.append(cls_vars)
+
+        key = cache_key(
+            [(args.sig, args.sig_selection), (args.bkg, args.bkg_selection)],
+            variables, num_tracks=args.num_tracks,
+            num_clusters=args.num_clusters if args.do_clusters else None,
+            fraction=args.fraction, test_size=args.test_size,
+            split_by_event_number=args.split_by_event_number,
+            dtype=args.dtype)
+        cache = TensorCache(args.cache_dir, key)
+
+    cached = cache is not None and cache.exists()
+    if cached:
+        print("Loading preprocessed inputs from " + cache.path)
+        datasets = cache.load()
+        jet_train, jet_test = datasets["jet_train"], datasets["jet_test"]
+        trk_train, trk_test = datasets["trk_train"], datasets["trk_test"]
+        jet_preproc = cache.load_preprocessing("jet_preproc", jet_varnames)
+        trk_preproc = cache.load_preprocessing("trk_preproc", trk_varnames)
+        if args.do_clusters:
+            cls_train, cls_test = datasets["cls_train"], datasets["cls_test"]
+            cls_preproc = cache.load_preprocessing("cls_preproc",
+                                                   cls_varnames)
 
-    # Validation split
-    if args.do_clusters:
-        jet_train, jet_test, trk_train, trk_test, cls_train, cls_test = \
-            train_test_split([jet_data, trk_data, cls_data],
-                             test_size=args.test_size)
+        reweighter = PtReweighter.load(cache.preprocessing)
     else:
-        jet_train, jet_test, trk_train, trk_test = train_test_split(
-            [jet_data, trk_data], test_size=args.test_size)
+        # Load data
+        with open_sample(args.sig, selection=args.sig_selection) as sig, \
+             open_sample(args.bkg, selection=args.bkg_selection) as bkg:
+            lsig = len(sig["TauJets/pt"])
+            lbkg = len(bkg["TauJets/pt"])
+
+            if args.fraction:
+                sig_idx = int(args.fraction * lsig)
+                bkg_idx = int(args.fraction * lbkg)
+            else:
+                sig_idx = lsig
+                bkg_idx = lbkg
+
+            # pt-reweighting shared by all inputs
+            reweighter = PtReweighter().fit(sig["TauJets/pt"][:sig_idx],
+                                            bkg["TauJets/pt"][:bkg_idx])
+
+            if args.generator:
+                # Streamed training: preprocessing determined on the
+                # training events (all but the last 'test_size' fraction of
+                # each sample) in a single pass without loading the data
+                sig_split = int((1.0 - args.test_size) * sig_idx)
+                bkg_split = int((1.0 - args.test_size) * bkg_idx)
+                sources = [(sig, 0, sig_split), (bkg, 0, bkg_split)]
+
+                print("Fitting preprocessing on sig [:{}] and bkg "
+                      "[:{}]".format(sig_split, bkg_split))
+
+                jet_preproc = fit_preprocessing(sources, jet_vars,
+                                                workers=args.workers)
+                trk_preproc = fit_preprocessing(sources, trk_vars,
+                                                num=args.num_tracks,
+                                                workers=args.workers)
+                if args.do_clusters:
+                    cls_preproc = fit_preprocessing(sources, cls_vars,
+                                                    num=args.num_clusters,
+                                                    workers=args.workers)
+            else:
+                print("Loading sig [:{}] and bkg [:{}]".format(sig_idx,
+                                                                bkg_idx))
+
+                # Load jet data
+                jet_data = load_data(sig, bkg, np.s_[:sig_idx],
+                                     np.s_[:bkg_idx], jet_vars,
+                                     dtype=args.dtype, reweighter=reweighter)
+
+                # Load track data
+                trk_data = load_data(sig, bkg, np.s_[:sig_idx],
+                                     np.s_[:bkg_idx], trk_vars,
+                                     num=args.num_tracks, dtype=args.dtype,
+                                     reweighter=reweighter)
+
+                # Load cluster data
+                if args.do_clusters:
+                    cls_data = load_data(sig, bkg, np.s_[:sig_idx],
+                                         np.s_[:bkg_idx], cls_vars,
+                                         num=args.num_clusters,
+                                         dtype=args.dtype,
+                                         reweighter=reweighter)
+
+                # Event numbers for the validation split
+                if args.split_by_event_number:
+                    event_number = np.concatenate([
+                        sig["TauJets/mcEventNumber"][:sig_idx],
+                        bkg["TauJets/mcEventNumber"][:bkg_idx]])
+                else:
+                    event_number = None
+
+    if not args.generator and not cached:
+        # Validation split
+        if args.do_clusters:
+            jet_train, jet_test, trk_train, trk_test, cls_train, cls_test = \
+                train_test_split([jet_data, trk_data, cls_data],
+                                 test_size=args.test_size,
+                                 event_number=event_number)
+        else:
+            jet_train, jet_test, trk_train, trk_test = train_test_split(
+                [jet_data, trk_data], test_size=args.test_size,
+                event_number=event_number)
 
-    # Apply preprocessing functions
-    jet_preproc = preprocess(jet_train, jet_test, jet_preproc_func)
-    trk_preproc = preprocess(trk_train, trk_test, trk_preproc_func)
-    if args.do_clusters:
-        cls_preproc = preprocess(cls_train, cls_test, cls_preproc_func)
+        # Apply preprocessing functions
+        jet_preproc = preprocess(jet_train, jet_test, jet_preproc_func)
+        trk_preproc = preprocess(trk_train, trk_test, trk_preproc_func)
+        if args.do_clusters:
+            cls_preproc = preprocess(cls_train, cls_test, cls_preproc_func)
 
     preproc_results = [(jet_varnames, jet_preproc),
                        (trk_varnames, trk_preproc)]
@@ -95,12 +173,22 @@ def main(args):
         save_kwargs["cls_preproc"] = (cls_varnames, cls_preproc)
 
     save_preprocessing(args.preprocessing, **save_kwargs)
+    reweighter.save(args.preprocessing)
+
+    if cache is not None and not cached:
+        datasets = dict(jet_train=jet_train, jet_test=jet_test,
+                        trk_train=trk_train, trk_test=trk_test)
+        if args.do_clusters:
+            datasets.update(cls_train=cls_train, cls_test=cls_test)
+
+        cache.save(datasets, args.preprocessing)
+        print("Stored preprocessed inputs in " + cache.path)
 
     # Setup training
-    shape_jet = jet_train.x.shape[1:]
-    shape_trk = trk_train.x.shape[1:]
+    shape_jet = (len(jet_varnames),)
+    shape_trk = (args.num_tracks, len(trk_varnames))
     if args.do_clusters:
-        shape_cls = cls_train.x.shape[1:]
+        shape_cls = (args.num_clusters, len(cls_varnames))
     else:
         shape_cls = None
 
@@ -131,7 +219,32 @@ def main(args):
         callbacks.append(csv_logger)
 
     # Start training
-    if args.do_clusters:
+    if args.generator:
+        from rnn_tauid.generators import Input, tauid_sequences
+
+        inputs = [Input(trk_vars, args.num_tracks, trk_preproc)]
+        if args.do_clusters:
+            inputs.append(Input(cls_vars, args.num_clusters, cls_preproc))
+        inputs.append(Input(jet_vars, None, jet_preproc))
+
+        with open_sample(args.sig, selection=args.sig_selection) as sig, \
+             open_sample(args.bkg, selection=args.bkg_selection) as bkg:
+            train_seq, test_seq = tauid_sequences(
+                sig, bkg, sig_idx, bkg_idx, inputs,
+                test_size=args.test_size, reweighter=reweighter,
+                batch_size=args.batch_size, block_size=args.block_size,
+                queue_depth=args.queue_depth, workers=args.workers)
+
+            print("Streaming {} training and {} validation batches".format(
+                len(train_seq), len(test_seq)))
+
+            hist = model.fit_generator(
+                train_seq, validation_data=test_seq, epochs=args.epochs,
+                callbacks=callbacks, shuffle=False, verbose=1)
+
+            print("Training: " + train_seq.pipeline.summary())
+            print("Validation: " + test_seq.pipeline.summary())
+    elif args.do_clusters:
         hist = model.fit(
             [trk_train.x, cls_train.x, jet_train.x], trk_train.y,
             sample_weight=trk_train.w,
@@ -156,6 +269,13 @@ if __name__ == "__main__":
     parser.add_argument("sig", help="Input signal")
     parser.add_argument("bkg", help="Input background")
 
+    parser.add_argument("--sig-selection", default=None,
+                        help="Use signal events passing this selection flag "
+                             "(e.g. truth1p)")
+    parser.add_argument("--bkg-selection", default=None,
+                        help="Use background events passing this selection "
+                             "flag (e.g. 1p)")
+
     parser.add_argument("--preprocessing", default="preproc.h5")
     parser.add_argument("--model", default="model.h5")
 
@@ -166,8 +286,31 @@ if __name__ == "__main__":
     parser.add_argument("--patience", type=int, default=10)
     parser.add_argument("--epochs", type=int, default=100)
     parser.add_argument("--test-size", type=float, default=0.2)
+    parser.add_argument("--split-by-event-number", action="store_true",
+                        help="Select the validation events by their "
+                             "mcEventNumber instead of randomly")
     parser.add_argument("--csv-log", default=None)
     parser.add_argument("--var-mod", default=None)
+    parser.add_argument("--dtype", choices=["float32", "float64"],
+                        default="float32",
+                        help="Floating point type of the loaded inputs")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Directory caching the preprocessed inputs, "
+                             "reused if the samples, variables and options "
+                             "are unchanged (not with --generator)")
+
+    gen = parser.add_argument_group("streaming")
+    gen.add_argument("--generator", action="store_true",
+                     help="Stream batches from the samples instead of "
+                          "loading them into memory")
+    gen.add_argument("--block-size", type=int, default=100000,
+                     help="Number of events read and shuffled at once when "
+                          "streaming")
+    gen.add_argument("--queue-depth", type=int, default=2,
+                     help="Number of blocks read ahead in the background "
+                          "(0 to read in the training thread)")
+    gen.add_argument("--workers", type=int, default=1,
+                     help="Number of threads reading ahead")
 
     arch = parser.add_argument_group("architecture")
     arch.add_argument("--dense-units-1", type=int, default=32)
@@ -13,7 +13,8 @@ def main(args):
         ReduceLROnPlateau
 
     from rnn_tauid.models import decaymodeclf_model
-    from rnn_tauid.utils import load_vars_decaymodeclf, load_data_decaymodeclf, train_test_split
+    from rnn_tauid.utils import load_vars_decaymodeclf, load_data_decaymodeclf, train_test_split, open_sample, \
+        fit_preprocessing
     from rnn_tauid.preprocessing import preprocess, save_preprocessing
 
     logging.basicConfig(level=logging.DEBUG)
@@ -30,8 +31,7 @@ def main(args):
     conv_varnames, _, conv_preproc_func = zip(*conv_vars)
 
     # Load data
-    h5file = dict(driver="family", memb_size=8*1024**3)
-    with h5py.File(args.sig, "r", **h5file) as sig:
+    with open_sample(args.sig) as sig:
         lsig = len(sig["TauJets/pt"])
 
         if args.fraction:
@@ -39,49 +39,81 @@ def main(args):
         else:
             sig_idx = lsig
 
-        log.info("Loading sample slice [:{}]".format(sig_idx))
-
-        # Load charged pfo data
-        log.info("Loading data for {} charged pfos ...".format(args.num_chrg))
-        chrg_data = load_data_decaymodeclf(sig, np.s_[:sig_idx], chrg_vars,
-                                           args.num_chrg)
-
-        # Load neutral pfo data
-        log.info("Loading data for {} neutral pfos ...".format(args.num_neut))
-        neut_data = load_data_decaymodeclf(sig, np.s_[:sig_idx], neut_vars,
-                                           args.num_neut)
-
-        # Load shot pfo data
-        log.info("Loading data for {} shot pfos ...".format(args.num_shot))
-        shot_data = load_data_decaymodeclf(sig, np.s_[:sig_idx], shot_vars,
-                                           args.num_shot)
-
-        # Load conversion track data
-        log.info("Loading data for {} conversion tracks ...".format(args.num_conv))
-        conv_data = load_data_decaymodeclf(sig, np.s_[:sig_idx], conv_vars,
-                                           args.num_conv)
-
-    # Apply neutral pt cut
-    if args.neut_pt_cut:
-        log.info("Applying neutral pfo pt cut: pt > {} GeV".format(args.neut_pt_cut))
-        pt_col = neut_varnames.index("NeutralPFO/pt_log")
-        neut_pfo_pt = neut_data.x[..., pt_col]
-        pt_fail = neut_pfo_pt < np.log10(1e3 * args.neut_pt_cut)
-        neut_data.x[pt_fail] = np.nan
-        del neut_pfo_pt, pt_fail
-
-    # Validation split
-    log.info("Performing train-validation split ...")
-    chrg_train, chrg_test, neut_train, neut_test, shot_train, shot_test, conv_train, conv_test = \
-        train_test_split([chrg_data, neut_data, shot_data, conv_data],
-                         test_size=args.test_size)
-
-    # Apply preprocessing functions
-    log.info("Applying preprocessing functions ...")
-    chrg_preproc = preprocess(chrg_train, chrg_test, chrg_preproc_func)
-    neut_preproc = preprocess(neut_train, neut_test, neut_preproc_func)
-    shot_preproc = preprocess(shot_train, shot_test, shot_preproc_func)
-    conv_preproc = preprocess(conv_train, conv_test, conv_preproc_func)
+        if args.generator:
+            # Streamed training: preprocessing determined on the training
+            # events (all but the last 'test_size' fraction) in a single pass
+            # without loading the data
+            split = int((1.0 - args.test_size) * sig_idx)
+            sources = [(sig, 0, split)]
+            log.info("Fitting preprocessing on sample slice [:{}]".format(
+                split))
+
+            # Neutral pt cut
+            neut_cut = None
+            if args.neut_pt_cut:
+                neut_cut = (neut_varnames.index("NeutralPFO/pt_log"),
+                            np.log10(1e3 * args.neut_pt_cut))
+
+            chrg_preproc = fit_preprocessing(sources, chrg_vars, args.num_chrg,
+                                             workers=args.workers)
+            neut_preproc = fit_preprocessing(sources, neut_vars, args.num_neut,
+                                             cut=neut_cut,
+                                             workers=args.workers)
+            shot_preproc = fit_preprocessing(sources, shot_vars, args.num_shot,
+                                             workers=args.workers)
+            conv_preproc = fit_preprocessing(sources, conv_vars, args.num_conv,
+                                             workers=args.workers)
+        else:
+            log.info("Loading sample slice [:{}]".format(sig_idx))
+
+            # Load charged pfo data
+            log.info("Loading data for {} charged pfos ...".format(args.num_chrg))
+            chrg_data = load_data_decaymodeclf(sig, np.s_[:sig_idx], chrg_vars,
+                                               args.num_chrg, dtype=args.dtype)
+
+            # Load neutral pfo data
+            log.info("Loading data for {} neutral pfos ...".format(args.num_neut))
+            neut_data = load_data_decaymodeclf(sig, np.s_[:sig_idx], neut_vars,
+                                               args.num_neut, dtype=args.dtype)
+
+            # Load shot pfo data
+            log.info("Loading data for {} shot pfos ...".format(args.num_shot))
+            shot_data = load_data_decaymodeclf(sig, np.s_[:sig_idx], shot_vars,
+                                               args.num_shot, dtype=args.dtype)
+
+            # Load conversion track data
+            log.info("Loading data for {} conversion tracks ...".format(args.num_conv))
+            conv_data = load_data_decaymodeclf(sig, np.s_[:sig_idx], conv_vars,
+                                               args.num_conv, dtype=args.dtype)
+
+            # Event numbers for the validation split
+            if args.split_by_event_number:
+                event_number = sig["TauJets/mcEventNumber"][:sig_idx]
+            else:
+                event_number = None
+
+    if not args.generator:
+        # Apply neutral pt cut
+        if args.neut_pt_cut:
+            log.info("Applying neutral pfo pt cut: pt > {} GeV".format(args.neut_pt_cut))
+            pt_col = neut_varnames.index("NeutralPFO/pt_log")
+            neut_pfo_pt = neut_data.x[..., pt_col]
+            pt_fail = neut_pfo_pt < np.log10(1e3 * args.neut_pt_cut)
+            neut_data.x[pt_fail] = np.nan
+            del neut_pfo_pt, pt_fail
+
+        # Validation split
+        log.info("Performing train-validation split ...")
+        chrg_train, chrg_test, neut_train, neut_test, shot_train, shot_test, conv_train, conv_test = \
+            train_test_split([chrg_data, neut_data, shot_data, conv_data],
+                             test_size=args.test_size, event_number=event_number)
+
+        # Apply preprocessing functions
+        log.info("Applying preprocessing functions ...")
+        chrg_preproc = preprocess(chrg_train, chrg_test, chrg_preproc_func)
+        neut_preproc = preprocess(neut_train, neut_test, neut_preproc_func)
+        shot_preproc = preprocess(shot_train, shot_test, shot_preproc_func)
+        conv_preproc = preprocess(conv_train, conv_test, conv_preproc_func)
 
     preproc_results = [
         (chrg_varnames, chrg_preproc),
@@ -108,10 +140,10 @@ def main(args):
     save_preprocessing(args.preprocessing, **save_kwargs)
 
     # Setup training
-    chrg_shape = chrg_train.x.shape[1:]
-    neut_shape = neut_train.x.shape[1:]
-    shot_shape = shot_train.x.shape[1:]
-    conv_shape = conv_train.x.shape[1:]
+    chrg_shape = (args.num_chrg, len(chrg_varnames))
+    neut_shape = (args.num_neut, len(neut_varnames))
+    shot_shape = (args.num_shot, len(shot_varnames))
+    conv_shape = (args.num_conv, len(conv_varnames))
 
     model = decaymodeclf_model(
         5, chrg_shape, neut_shape, shot_shape, conv_shape,
@@ -153,13 +185,48 @@ def main(args):
     import pdb; pdb.set_trace()
 
     # Start training
-    hist = model.fit(
-        [chrg_train.x, neut_train.x, shot_train.x, conv_train.x],
-        chrg_train.y, sample_weight=chrg_train.w,
-        validation_data=([chrg_test.x, neut_test.x, shot_test.x, conv_test.x],
-                         chrg_test.y, chrg_test.w),
-        epochs=args.epochs, batch_size=args.batch_size, callbacks=callbacks,
-        verbose=1)
+    if args.generator:
+        from rnn_tauid.generators import Input, decaymodeclf_sequences
+
+        # Neutral pt cut on the preprocessed variable
+        neut_cut = None
+        if args.neut_pt_cut:
+            pt_col = neut_varnames.index("NeutralPFO/pt_log")
+            offset, scale = neut_preproc[pt_col]
+            neut_cut = (pt_col,
+                        (np.log10(1e3 * args.neut_pt_cut) - offset) / scale)
+
+        inputs = [
+            Input(chrg_vars, args.num_chrg, chrg_preproc),
+            Input(neut_vars, args.num_neut, neut_preproc, cut=neut_cut),
+            Input(shot_vars, args.num_shot, shot_preproc),
+            Input(conv_vars, args.num_conv, conv_preproc)
+        ]
+
+        with open_sample(args.sig) as sig:
+            train_seq, test_seq = decaymodeclf_sequences(
+                sig, sig_idx, inputs, 5, test_size=args.test_size,
+                batch_size=args.batch_size, block_size=args.block_size,
+                queue_depth=args.queue_depth, workers=args.workers)
+
+            log.info("Streaming {} training and {} validation batches".format(
+                len(train_seq), len(test_seq)))
+
+            hist = model.fit_generator(
+                train_seq, validation_data=test_seq, epochs=args.epochs,
+                callbacks=callbacks, shuffle=False, verbose=1)
+
+            log.info("Training: " + train_seq.pipeline.summary())
+            log.info("Validation: " + test_seq.pipeline.summary())
+    else:
+        hist = model.fit(
+            [chrg_train.x, neut_train.x, shot_train.x, conv_train.x],
+            chrg_train.y, sample_weight=chrg_train.w,
+            validation_data=([chrg_test.x, neut_test.x, shot_test.x,
+                              conv_test.x],
+                             chrg_test.y, chrg_test.w),
+            epochs=args.epochs, batch_size=args.batch_size,
+            callbacks=callbacks, verbose=1)
 
     # Determine best epoch & validation loss
     val_loss, epoch = min(zip(hist.history["val_loss"], hist.epoch))
@@ -178,8 +245,27 @@ if __name__ == "__main__":
     parser.add_argument("--patience", type=int, default=10)
     parser.add_argument("--epochs", type=int, default=100)
     parser.add_argument("--test-size", type=float, default=0.2)
+    parser.add_argument("--split-by-event-number", action="store_true",
+                        help="Select the validation events by their "
+                             "mcEventNumber instead of randomly")
     parser.add_argument("--csv-log", default=None)
     parser.add_argument("--var-mod", default=None)
+    parser.add_argument("--dtype", choices=["float32", "float64"],
+                        default="float32",
+                        help="Floating point type of the loaded inputs")
+
+    gen = parser.add_argument_group("streaming")
+    gen.add_argument("--generator", action="store_true",
+                     help="Stream batches from the sample instead of "
+                          "loading it into memory")
+    gen.add_argument("--block-size", type=int, default=100000,
+                     help="Number of events read and shuffled at once when "
+                          "streaming")
+    gen.add_argument("--queue-depth", type=int, default=2,
+                     help="Number of blocks read ahead in the background "
+                          "(0 to read in the training thread)")
+    gen.add_argument("--workers", type=int, default=1,
+                     help="Number of threads reading ahead")
 
     parser.add_argument("--num-chrg", type=int, default=3)
     parser.add_argument("--num-neut", type=int, default=10)
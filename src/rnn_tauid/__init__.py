@@ -0,0 +1,6 @@
+# Register additional HDF5 compression filters (e.g. Blosc, LZ4) if available
+# to be able to read samples written with these codecs
+try:
+    import hdf5plugin
+except ImportError:
+    pass
@@ -0,0 +1,160 @@
+"""
+On-disk cache of the preprocessed training inputs (see 'TensorCache'), such
+that repeated trainings on the same inputs (e.g. scanning the architecture)
+skip loading and preprocessing the samples.
+"""
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import tempfile
+from functools import partial
+
+import numpy as np
+
+from rnn_tauid.expressions import Transform
+from rnn_tauid.preprocessing import load_preprocessing
+from rnn_tauid.utils import Data
+
+# Increment if the layout of the cached inputs changes
+cache_version = 1
+
+
+def file_signature(filename):
+    """
+    Path, size and modification time of a sample (of every member for
+    samples split with '%d'). The content is not hashed as the samples are
+    usually too large to be read for every training.
+    """
+    if "%d" in filename:
+        members = []
+        while os.path.exists(filename % len(members)):
+            members.append(filename % len(members))
+    else:
+        members = [filename]
+
+    signature = []
+    for fn in members:
+        stat = os.stat(fn)
+        signature.append([os.path.abspath(fn), stat.st_size, stat.st_mtime])
+
+    return signature
+
+
+def describe(func):
+    """Description of a variable / preprocessing function for the cache key"""
+    if func is None:
+        return None
+
+    if isinstance(func, partial):
+        return {"func": describe(func.func),
+                "args": [repr(arg) for arg in func.args],
+                "keywords": {k: repr(v) for k, v in
+                             (func.keywords or {}).items()}}
+
+    if isinstance(func, Transform):
+        return {"transform": func.expr}
+
+    # Source of functions changed in place (e.g. in 'rnn_tauid.variables')
+    try:
+        source = inspect.getsource(func)
+    except (TypeError, IOError):
+        source = None
+
+    return {"name": "{}.{}".format(getattr(func, "__module__", None),
+                                   getattr(func, "__name__", repr(func))),
+            "source": source}
+
+
+def cache_key(samples, variables, **options):
+    """
+    Hash of the samples (list of (filename, selection)), the variable
+    definitions (lists of (varname, func, preproc_func)) and further options
+    (e.g. number of objects, fraction and test size) determining the inputs.
+    """
+    description = {
+        "version": cache_version,
+        "samples": [[file_signature(fn), selection]
+                    for fn, selection in samples],
+        "variables": [[[varname, describe(func), describe(preproc_func)]
+                       for varname, func, preproc_func in invars]
+                      for invars in variables],
+        "options": {k: repr(v) for k, v in options.items()}
+    }
+
+    text = json.dumps(description, sort_keys=True)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class TensorCache(object):
+    """
+    Preprocessed inputs ('Data' of the training and validation sets) stored
+    in the subdirectory 'key' of 'directory' as uncompressed .npy files,
+    which are memory-mapped when loaded, together with the preprocessing
+    file of the training. Entries are written to a temporary directory and
+    renamed, such that trainings running in parallel never see incomplete
+    entries.
+    """
+    def __init__(self, directory, key):
+        self.directory = directory
+        self.key = key
+        self.path = os.path.join(directory, key)
+        self.preprocessing = os.path.join(self.path, "preproc.h5")
+
+
+    def exists(self):
+        return os.path.isdir(self.path)
+
+
+    def load(self, mmap_mode="r"):
+        """Loads the stored inputs as dict of name -> 'Data'"""
+        with open(os.path.join(self.path, "names.json")) as f:
+            names = json.load(f)
+
+        datasets = {}
+        for name in names:
+            datasets[name] = Data(*[
+                np.load(os.path.join(self.path, "{}_{}.npy".format(name, f)),
+                        mmap_mode=mmap_mode)
+                for f in Data._fields])
+
+        return datasets
+
+
+    def load_preprocessing(self, group, variables):
+        """List of (offset, scale) of 'variables' stored in 'group'"""
+        offset, scale = load_preprocessing(self.preprocessing, group)
+        return [(offset[group][var], scale[group][var]) for var in variables]
+
+
+    def save(self, datasets, preprocessing):
+        """
+        Stores the inputs (dict of name -> 'Data') and a copy of the
+        preprocessing file
+        """
+        if self.exists():
+            return
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        tmp = tempfile.mkdtemp(prefix=".tmp-" + self.key, dir=self.directory)
+        try:
+            for name, data in datasets.items():
+                for f, arr in zip(Data._fields, data):
+                    np.save(os.path.join(tmp, "{}_{}.npy".format(name, f)),
+                            arr)
+
+            with open(os.path.join(tmp, "names.json"), "w") as f:
+                json.dump(sorted(datasets), f)
+
+            shutil.copyfile(preprocessing, os.path.join(tmp, "preproc.h5"))
+            os.rename(tmp, self.path)
+        except OSError:
+            # Stored by another training in the meantime
+            if not self.exists():
+                raise
+        finally:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp)
@@ -0,0 +1,1427 @@
+import os
+import logging
+import shutil
+import tempfile
+from collections import namedtuple
+from functools import partial, reduce
+from multiprocessing import Pool
+
+import numpy as np
+import h5py
+
+from rnn_tauid.preprocessing import stats_fields, stats_group
+
+log = logging.getLogger(__name__)
+
+# Value used by root2array to pad sequences
+default_value = 0
+
+# Seed for shuffling the converted samples
+seed = 1234567890
+
+# Dataset listing the converted input files
+manifest_name = "_manifest"
+
+# Number of histogram bins of the variable statistics (see 'write_stats')
+stats_bins = 100
+
+# h5py dataset kwargs
+h5opt = {
+    "compression": "gzip",
+    "compression_opts": 9,
+    "shuffle": True,
+    "fletcher32": True
+}
+
+# Compression codecs selectable with 'codec_options'
+codecs = ["none", "lzf", "gzip-N", "blosc-lz4", "blosc-zstd", "lz4"]
+
+# Storage types of the 'compact' dtype policy (dataset name patterns). Values
+# that cannot be represented raise an error during the conversion.
+compact_dtypes = [
+    ("TauJets/nTracks", "uint8"),
+    ("TauJets/truthProng", "uint8"),
+    ("TauJets/truthDecayMode", "int8"),
+    ("TauJets/IsTruthMatched", "uint8"),
+    ("TauTracks/n*Hits", "uint8"),
+    ("NeutralPFO/nHitsInEM1", "int16"),
+    ("NeutralPFO/nPosECells_EM1", "int16")
+]
+
+
+# Group of branches sharing a common prefix (e.g. 'TauTracks'). Sequences are
+# padded / truncated to 'max_len' and entries where 'mask_branch' equals the
+# default value are set to nan. Scalar containers have 'max_len' set to None.
+# The datasets are written with the h5py kwargs 'h5opt' (defaults to the
+# module level 'h5opt' if None). If 'chunk_rows' is set, datasets are chunked
+# in blocks of 'chunk_rows' events spanning the full object axis. Otherwise
+# h5py chooses the chunk shape. 'storage' is one of 'storages'. For scalar
+# containers 'flags' can be a list of (name, selection) pairs which are
+# evaluated on the tree and stored as bits of the integer dataset
+# '<container>/selection' (bit i is set if the event passes the i-th
+# selection). 'dtypes' maps dataset names to storage types other than float32
+# (see 'encode', not applicable to packed containers).
+Container = namedtuple("Container", ["name", "branches", "mask_branch",
+                                     "max_len", "h5opt", "chunk_rows",
+                                     "storage", "flags", "dtypes"])
+Container.__new__.__defaults__ = (None, None, "dense", None, None)
+
+# Storage formats of containers:
+# - dense: One dataset per branch (e.g. 'TauTracks/pt')
+# - packed: Single dataset '<container>/packed' of shape
+#   (n_events, [max_len,] n_vars) with the variable names stored in the
+#   attribute 'variables'
+# - ragged: Sequences are stored without padding as flat datasets of all
+#   objects (e.g. 'TauTracks/pt') with the number of objects per event in
+#   '<container>/_counts' and the start of each event in '<container>/_offsets'
+#   (n_events + 1 entries). Scalar containers are stored dense.
+storages = ["dense", "packed", "ragged"]
+
+
+def codec_options(spec, fletcher32=True):
+    """
+    Returns the h5py dataset kwargs for a compression codec specification:
+
+    - 'none': No compression
+    - 'lzf': LZF compression (shipped with h5py)
+    - 'gzip' or 'gzip-N': gzip compression with level N (default: 4)
+    - 'blosc-lz4', 'blosc-zstd', 'lz4': Blosc / LZ4 compression (requires
+      the hdf5plugin package)
+
+    The byte shuffle filter is enabled for all codecs that do not shuffle
+    internally. A fletcher32 checksum is added if 'fletcher32' is True.
+    """
+    name, _, level = spec.lower().partition("-")
+
+    if name == "none":
+        opts = {}
+    elif name == "lzf":
+        opts = {"compression": "lzf", "shuffle": True}
+    elif name == "gzip":
+        opts = {"compression": "gzip",
+                "compression_opts": int(level) if level else 4,
+                "shuffle": True}
+    elif name in ("blosc", "lz4"):
+        try:
+            import hdf5plugin
+        except ImportError:
+            raise RuntimeError("Codec '{}' requires the hdf5plugin "
+                               "package".format(spec))
+
+        if name == "blosc":
+            opts = dict(hdf5plugin.Blosc(cname=level or "lz4", clevel=5,
+                                         shuffle=hdf5plugin.Blosc.SHUFFLE))
+        else:
+            opts = dict(hdf5plugin.LZ4())
+            opts["shuffle"] = True
+    else:
+        raise ValueError("Unknown codec '{}' (available: {})".format(
+            spec, ", ".join(codecs)))
+
+    if fletcher32:
+        opts["fletcher32"] = True
+
+    return opts
+
+
+def flag_branch(container):
+    """Name of the branch holding the selection bits of a container"""
+    return container.name + ".selection"
+
+
+def flag_dtype(n_flags):
+    """Smallest unsigned integer type holding 'n_flags' bits"""
+    for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if n_flags <= 8 * np.dtype(dtype).itemsize:
+            return dtype
+
+    raise ValueError("Too many selection flags: {}".format(n_flags))
+
+
+def output_branches(container):
+    """Branches written for a container (including the selection bits)"""
+    if container.flags:
+        return list(container.branches) + [flag_branch(container)]
+    else:
+        return list(container.branches)
+
+
+def branch_dtype(container, branch):
+    """Data type of a branch in the output"""
+    if container.flags and branch == flag_branch(container):
+        return flag_dtype(len(container.flags))
+    else:
+        return np.float32
+
+
+def storage_dtype(container, branch):
+    """Data type of a branch in the output according to 'container.dtypes'"""
+    if container.dtypes and container.storage != "packed":
+        return np.dtype(container.dtypes.get(dataset_name(branch), np.float32))
+    else:
+        return np.dtype(np.float32)
+
+
+def nan_value(dtype):
+    """Value representing nan in integer datasets"""
+    info = np.iinfo(dtype)
+    return info.max if info.min == 0 else info.min
+
+
+def encode(col, dtype, name=None):
+    """
+    Converts a float32 column to its storage type. Integer types store nan as
+    'nan_value'. Raises a ValueError if the values cannot be represented
+    (non-integer or out of range values).
+    """
+    dtype = np.dtype(dtype)
+    if dtype == col.dtype:
+        return col
+
+    if dtype.kind == "f":
+        out = col.astype(dtype)
+        if np.any(np.isinf(out) & ~np.isinf(col)):
+            raise ValueError("{}: Values out of range for {}".format(
+                name, dtype))
+        return out
+
+    nan = np.isnan(col)
+    valid = col[~nan]
+    if len(valid) > 0:
+        info = np.iinfo(dtype)
+        if np.any(valid != np.round(valid)) or valid.min() < info.min \
+           or valid.max() > info.max or np.any(valid == nan_value(dtype)):
+            raise ValueError("{}: Values cannot be stored as {}".format(
+                name, dtype))
+
+    return np.where(nan, nan_value(dtype), col).astype(dtype)
+
+
+def _create_branch(outf, container, br, data=None, shape=None):
+    """
+    Creates the dataset of a branch with its storage type. Integer datasets
+    store the value representing nan in the attribute 'nan_value'.
+    """
+    dtype = storage_dtype(container, br)
+    if data is not None:
+        data = encode(data, dtype, name=br)
+
+    dset = _create_dataset(outf, container, dataset_name(br), data,
+                           dtype=dtype, shape=shape)
+    if dtype.kind in "iu":
+        dset.attrs["nan_value"] = nan_value(dtype)
+
+    return dset
+
+
+def dataset_name(branch):
+    """Converts branch names (e.g. 'TauJets.pt') to dataset names"""
+    return "{}/{}".format(*branch.split("."))
+
+
+def variable_name(branch):
+    """Variable name of a branch without the container (e.g. 'pt')"""
+    return branch.split(".")[1]
+
+
+def _branch_specs(container):
+    """Returns the branches and root2array branch specifications to read"""
+    branches = list(container.branches)
+    if container.max_len and container.mask_branch not in branches:
+        branches.append(container.mask_branch)
+
+    if container.max_len:
+        specs = [(br, default_value, container.max_len) for br in branches]
+    else:
+        specs = branches
+
+    return branches, specs
+
+
+def num_entries(infile, treename):
+    """Returns the number of entries of a tree"""
+    import ROOT
+
+    f = ROOT.TFile.Open(infile)
+    try:
+        return int(f.Get(treename).GetEntries())
+    finally:
+        f.Close()
+
+
+def block_size(container, memory_budget):
+    """
+    Number of tree entries to read per block such that reading a block of the
+    container stays within 'memory_budget' (in bytes). Assumes up to 8 bytes
+    per value as stored in the tree plus the float32 copy.
+    """
+    n_branches = len(container.branches) + 1
+    bytes_per_entry = 12 * n_branches * (container.max_len or 1)
+
+    return max(1, int(memory_budget // bytes_per_entry))
+
+
+def read_file(infile, treename, container, sels, start=None, stop=None):
+    """
+    Reads all branches of a container from a single file in one call to
+    root2array, i.e. the tree is traversed and the selection is evaluated only
+    once for all branches. Optionally only the entries [start, stop) are read.
+
+    Multiple selections can be given in 'sels' (fan-out). In this case the
+    union of all selections is read once and the selections are evaluated as
+    additional expressions to split the entries.
+
+    Returns a list of dictionaries mapping branch names to float32 arrays (one
+    for each selection).
+    """
+    # Load here to avoid root taking over the command line
+    from root_numpy import root2array
+
+    branches, specs = _branch_specs(container)
+
+    flags = container.flags or []
+    if flags and container.max_len:
+        raise ValueError("Selection flags require a scalar container")
+
+    # Selection flags and fan-out selections are read as expressions after the
+    # branches (identical expressions only once)
+    exprs = []
+
+    def expr_field(expr):
+        expr = "({})".format(expr)
+        if expr not in exprs:
+            exprs.append(expr)
+        return len(branches) + exprs.index(expr)
+
+    flag_fields = [expr_field(flag_sel) for _, flag_sel in flags]
+
+    if len(sels) > 1:
+        assert len(set(sels)) == len(sels), "Selections are not unique"
+        sel = " || ".join("({})".format(s) for s in sels)
+        sel_fields = [expr_field(s) for s in sels]
+    else:
+        sel = sels[0]
+
+    specs = specs + exprs
+
+    arr = root2array(infile, treename=treename, branches=specs, selection=sel,
+                     start=start, stop=stop)
+
+    # Fields are accessed by position since root2array names them after the
+    # branch expressions
+    fields = arr.dtype.names
+    columns = {br: arr[field] for br, field in zip(branches, fields)}
+
+    if flags:
+        bits = np.zeros(len(arr), dtype=flag_dtype(len(flags)))
+        for i, field in enumerate(flag_fields):
+            bits[arr[fields[field]] != 0] |= 1 << i
+        columns[flag_branch(container)] = bits
+
+    if len(sels) > 1:
+        masks = [arr[fields[field]].astype(bool) for field in sel_fields]
+
+    if container.max_len:
+        mask = (columns[container.mask_branch] == default_value)
+
+    data = [{} for _ in sels]
+    for br in output_branches(container):
+        col = columns[br].astype(branch_dtype(container, br))
+        if container.max_len:
+            col[mask] = np.nan
+
+        if len(sels) > 1:
+            for d, m in zip(data, masks):
+                d[br] = col[m]
+        else:
+            data[0][br] = col
+
+    return data
+
+
+def iter_blocks(infile, treename, container, sels, block_size=None):
+    """
+    Yields the container of a single file in blocks of 'block_size' tree
+    entries (before the selection). Reads the whole file if 'block_size' is
+    None.
+    """
+    if not block_size:
+        yield read_file(infile, treename, container, sels)
+        return
+
+    n_entries = num_entries(infile, treename)
+    for start in range(0, n_entries, block_size):
+        stop = min(n_entries, start + block_size)
+        yield read_file(infile, treename, container, sels, start=start,
+                        stop=stop)
+
+
+def read_container(infiles, treename, container, sels, progress=None):
+    """
+    Reads all branches of a container from a list of files (one pass per file)
+    and concatenates the results. Returns a list of dictionaries (one for each
+    selection).
+    """
+    if progress is None:
+        progress = lambda it: it
+
+    branches = output_branches(container)
+
+    pieces = [{br: [] for br in branches} for _ in sels]
+    for fn in progress(infiles):
+        for p, data in zip(pieces, read_file(fn, treename, container, sels)):
+            for br in branches:
+                p[br].append(data.pop(br))
+
+    data = [{} for _ in sels]
+    for d, p in zip(data, pieces):
+        for br in branches:
+            d[br] = np.concatenate(p.pop(br))
+
+    return data
+
+
+def _object_shape(container):
+    """Shape of a single event of a dataset of the container"""
+    shape = (container.max_len,) if container.max_len else ()
+    if container.storage == "packed":
+        shape += (len(container.branches),)
+
+    return shape
+
+
+def is_ragged(container):
+    """True if the container is stored in the ragged format"""
+    return container.storage == "ragged" and container.max_len is not None
+
+
+def chunk_shape(container, n_events):
+    """
+    Chunk shape for the datasets of a container with 'n_events' events
+    according to 'container.chunk_rows' (None for automatic chunking). For
+    the flat datasets of ragged containers 'n_events' is the number of objects
+    and chunks hold 'chunk_rows * max_len' objects.
+    """
+    if not container.chunk_rows or n_events == 0:
+        return None
+
+    if is_ragged(container):
+        return (min(container.chunk_rows * container.max_len, n_events),)
+
+    rows = min(container.chunk_rows, n_events)
+    return (rows,) + _object_shape(container)
+
+
+def write_layout_attrs(outf, containers):
+    """
+    Records the chunk layout in the file attributes such that readers can size
+    their chunk caches ('rnn_tauid.utils.open_sample'):
+
+    - layout: 'rows' if datasets are chunked in blocks of events, else 'auto'
+    - chunk_rows: Number of events per chunk
+    - chunk_bytes: Size of the largest chunk in bytes
+    """
+    chunk_rows = set(c.chunk_rows for c in containers)
+    if None in chunk_rows or len(chunk_rows) != 1:
+        outf.attrs["layout"] = "auto"
+        return
+
+    rows = chunk_rows.pop()
+    itemsize = np.dtype(np.float32).itemsize
+
+    outf.attrs["layout"] = "rows"
+    outf.attrs["chunk_rows"] = rows
+    outf.attrs["chunk_bytes"] = max(
+        rows * int(np.prod(_object_shape(c))) * itemsize for c in containers)
+
+
+def _create_dataset(outf, container, name, data=None, dtype=np.float32,
+                    chunked=True, shape=None):
+    """
+    Creates a dataset with the codec and layout of the container from 'data'
+    or empty with the given 'shape'. Datasets are resizable along the first
+    axis to allow appending ('append_sample').
+    """
+    if data is not None:
+        shape = data.shape
+
+    opts = container.h5opt if container.h5opt is not None else h5opt
+    chunks = chunk_shape(container, shape[0]) if chunked else None
+    if chunks:
+        opts = dict(opts, chunks=chunks)
+
+    return outf.create_dataset(name, shape=shape, data=data, dtype=dtype,
+                               maxshape=(None,) + shape[1:], **opts)
+
+
+def _shuffle(arr):
+    """Shuffles along the first axis using the global seed"""
+    random_state = np.random.RandomState(seed=seed)
+    random_state.shuffle(arr)
+
+
+def permutation(n_events):
+    """
+    Permutation applied by '_shuffle' to 'n_events' events, i.e.
+    '_shuffle(arr)' is equivalent to 'arr = arr[permutation(len(arr))]'
+    """
+    return np.random.RandomState(seed=seed).permutation(n_events)
+
+
+def external_shuffle(blocks, perm, block_rows, tmpfile):
+    """
+    Shuffles rows according to 'perm' (output row i is input row perm[i])
+    holding only about one block of 'block_rows' rows in memory. The input rows
+    are given as iterable of consecutive blocks of 'block_rows' rows (the last
+    one may be shorter). Yields the shuffled rows in blocks of 'block_rows'.
+
+    In the first pass every input block is written to the uncompressed
+    'tmpfile' with its rows sorted by output block. In the second pass the rows
+    of every output block are collected from all input blocks and placed.
+    """
+    n = len(perm)
+    n_blocks = -(-n // block_rows)
+
+    inverse = np.empty_like(perm)
+    inverse[perm] = np.arange(n)
+
+    # Start of the rows for output block b within input block j
+    offsets = np.zeros((n_blocks, n_blocks + 1), dtype=np.int64)
+
+    try:
+        with h5py.File(tmpfile, "w") as f:
+            rows = None
+            for j, block in enumerate(blocks):
+                start = j * block_rows
+                stop = min(n, start + block_rows)
+                assert len(block) == stop - start
+
+                if rows is None:
+                    rows = f.create_dataset("rows", dtype=block.dtype,
+                                            shape=(n,) + block.shape[1:])
+
+                target = inverse[start:stop] // block_rows
+                rows[start:stop] = block[np.argsort(target, kind="mergesort")]
+                np.cumsum(np.bincount(target, minlength=n_blocks),
+                          out=offsets[j, 1:])
+                del block
+
+            for b in range(n_blocks):
+                pieces = [rows[j * block_rows + offsets[j, b]:
+                               j * block_rows + offsets[j, b + 1]]
+                          for j in range(n_blocks)
+                          if offsets[j, b + 1] > offsets[j, b]]
+                pieces = np.concatenate(pieces)
+
+                # Pieces are ordered by input row
+                out = np.empty_like(pieces)
+                out[np.argsort(perm[b * block_rows:(b + 1) * block_rows])] = \
+                    pieces
+                del pieces
+
+                yield out
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+
+def ragged_counts(mask_col):
+    """
+    Number of objects per event from the padded (nan-masked) column of the
+    mask branch. Objects up to the last unmasked one are kept.
+    """
+    valid = ~np.isnan(mask_col)
+    last = valid.shape[1] - np.argmax(valid[:, ::-1], axis=1)
+
+    return np.where(valid.any(axis=1), last, 0).astype(np.int32)
+
+
+def _write_ragged(outf, container, load):
+    """
+    Shuffles (using the global seed) and writes the columns of a sequence
+    container in the ragged format. 'load' returns the padded array of a
+    branch.
+    """
+    if container.mask_branch not in container.branches:
+        raise ValueError("Ragged storage of {} requires the mask branch "
+                         "{}".format(container.name, container.mask_branch))
+
+    mask_col = load(container.mask_branch)
+    n_events = len(mask_col)
+
+    counts = ragged_counts(mask_col)
+    _shuffle(counts)
+
+    offsets = np.zeros(n_events + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    valid = np.arange(container.max_len) < counts[:, np.newaxis]
+
+    for br in container.branches:
+        if br == container.mask_branch:
+            col, mask_col = mask_col, None
+        else:
+            col = load(br)
+
+        # Check if same number of events
+        assert n_events == len(col)
+
+        _shuffle(col)
+        _create_branch(outf, container, br, col[valid])
+        del col
+
+    _write_ragged_index(outf, container, counts, offsets)
+    return n_events
+
+
+def _write_ragged_index(outf, container, counts, offsets):
+    """Writes the counts and offsets of a ragged container"""
+    group = outf[container.name]
+    _create_dataset(group, container, "_counts", counts, dtype=np.int32,
+                    chunked=False)
+    _create_dataset(group, container, "_offsets", offsets, dtype=np.int64,
+                    chunked=False)
+    group.attrs["storage"] = "ragged"
+    group.attrs["max_len"] = container.max_len
+
+
+def _write_columns(outf, container, load):
+    """
+    Shuffles (using the global seed) and writes the columns of a container.
+    'load' returns the array of a branch and is called once per branch in the
+    order of 'container.branches'.
+    """
+    if is_ragged(container):
+        return _write_ragged(outf, container, load)
+
+    n_events = None
+    packed = None
+
+    for i, br in enumerate(container.branches):
+        col = load(br)
+
+        # Check if same number of events
+        if n_events is not None:
+            assert n_events == len(col)
+        else:
+            n_events = len(col)
+
+        if container.storage == "packed":
+            if packed is None:
+                packed = np.empty((n_events,) + _object_shape(container),
+                                  dtype=np.float32)
+            packed[..., i] = col
+        else:
+            _shuffle(col)
+            _create_branch(outf, container, br, col)
+
+        del col
+
+    if container.storage == "packed":
+        _shuffle(packed)
+        dset = _create_dataset(outf, container,
+                               container.name + "/packed", packed)
+        dset.attrs["variables"] = np.array(
+            [variable_name(br) for br in container.branches], "S")
+
+    if container.flags:
+        write_flags(outf, container, load(flag_branch(container)))
+
+    return n_events
+
+
+def write_flags(outf, container, bits):
+    """
+    Shuffles (using the global seed) and writes the selection bits of a
+    container. The names and selections of the flags are stored in the
+    attributes 'flags' and 'selections'.
+    """
+    _shuffle(bits)
+    # Separate dataset also for packed containers
+    name = dataset_name(flag_branch(container))
+    dset = _create_dataset(outf, container._replace(storage="dense"), name,
+                           bits, dtype=bits.dtype)
+
+    names, sels = zip(*container.flags)
+    dset.attrs["flags"] = np.array(names, "S")
+    dset.attrs["selections"] = np.array(sels, "S")
+
+
+def write_container(outf, container, data):
+    """
+    Shuffles (using the global seed) and writes the branches of a container to
+    an open hdf5 file. Consumes the arrays in 'data'.
+    """
+    return _write_columns(outf, container, data.pop)
+
+
+def _staging_name(i, br):
+    """Dataset name of a branch for the i-th selection in staging files"""
+    return "output_{}/{}".format(i, dataset_name(br))
+
+
+def create_staging(f, container, n_sels=1):
+    """
+    Creates empty resizable datasets for the branches of a container (and each
+    selection) in an open hdf5 file. Blocks are appended with 'append_block'.
+    """
+    shape = (container.max_len,) if container.max_len else ()
+
+    # Chunks of roughly 1 MB
+    chunk_rows = max(1, 2**18 // (container.max_len or 1))
+
+    for i in range(n_sels):
+        for br in output_branches(container):
+            f.create_dataset(_staging_name(i, br), shape=(0,) + shape,
+                             maxshape=(None,) + shape,
+                             chunks=(chunk_rows,) + shape,
+                             dtype=branch_dtype(container, br))
+
+
+def append_block(f, container, data):
+    """
+    Appends a block of the container (list of dictionaries as returned by
+    'read_file') to the staging datasets
+    """
+    for i, d in enumerate(data):
+        for br in output_branches(container):
+            col = d.pop(br)
+
+            dset = f[_staging_name(i, br)]
+            n = len(dset)
+            dset.resize(n + len(col), axis=0)
+            dset[n:] = col
+
+
+def stage_files(infiles, treename, containers, sels, partfile,
+                memory_budget=None, progress=None):
+    """
+    Converts all containers of the input files to an uncompressed and
+    unshuffled hdf5 part file. If 'memory_budget' (in bytes) is given, the
+    input files are read in blocks of entries that fit within the budget and
+    appended to resizable datasets.
+    """
+    if progress is None:
+        progress = lambda it: it
+
+    with h5py.File(partfile, "w") as f:
+        for container in containers:
+            create_staging(f, container, n_sels=len(sels))
+
+            if memory_budget:
+                size = block_size(container, memory_budget)
+            else:
+                size = None
+
+            for fn in progress(infiles):
+                for data in iter_blocks(fn, treename, container, sels,
+                                        block_size=size):
+                    append_block(f, container, data)
+
+    return partfile
+
+
+def convert_file_to_part(task):
+    """
+    Converts a single input file to a part file. Used as the worker function
+    of the pool in 'convert_parallel'.
+    """
+    infile, treename, containers, sels, partfile, memory_budget = task
+
+    return stage_files([infile], treename, containers, sels, partfile,
+                       memory_budget=memory_budget)
+
+
+def _aligned_rows(block_rows, dset):
+    """Rounds 'block_rows' to a multiple of the rows per chunk of a dataset"""
+    if dset.chunks:
+        rows = dset.chunks[0]
+        return max(rows, block_rows // rows * rows)
+    else:
+        return block_rows
+
+
+def _write_columns_external(outf, container, read, n_events, block_rows,
+                            tmpdir):
+    """
+    Out-of-core version of '_write_columns' giving identical results.
+    'read(br, start, stop)' returns the unshuffled events [start, stop) of a
+    branch. The events are shuffled with 'external_shuffle' in blocks of about
+    'block_rows' events.
+    """
+    perm = permutation(n_events)
+    tmpfile = os.path.join(tmpdir, "shuffle.h5")
+
+    def shuffled(read_block, rows):
+        blocks = (read_block(start, min(n_events, start + rows))
+                  for start in range(0, n_events, rows))
+        return external_shuffle(blocks, perm, rows, tmpfile)
+
+    def write(dset, read_block):
+        rows = _aligned_rows(block_rows, dset)
+        for b, out in enumerate(shuffled(read_block, rows)):
+            dset[b * rows:b * rows + len(out)] = encode(out, dset.dtype,
+                                                        name=dset.name)
+
+    if is_ragged(container):
+        if container.mask_branch not in container.branches:
+            raise ValueError("Ragged storage of {} requires the mask branch "
+                             "{}".format(container.name,
+                                         container.mask_branch))
+
+        counts = np.concatenate([
+            ragged_counts(read(container.mask_branch, start,
+                               min(n_events, start + block_rows)))
+            for start in range(0, n_events, block_rows)])[perm]
+
+        offsets = np.zeros(n_events + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        for br in container.branches:
+            dset = _create_branch(outf, container, br, shape=(offsets[-1],))
+
+            for b, out in enumerate(shuffled(partial(read, br), block_rows)):
+                start = b * block_rows
+                stop = start + len(out)
+                valid = np.arange(container.max_len) < \
+                    counts[start:stop, np.newaxis]
+                dset[offsets[start]:offsets[stop]] = encode(
+                    out[valid], dset.dtype, name=br)
+
+        _write_ragged_index(outf, container, counts, offsets)
+        return n_events
+
+    if container.storage == "packed":
+        def read_packed(start, stop):
+            return np.stack([read(br, start, stop)
+                             for br in container.branches], axis=-1)
+
+        shape = (n_events,) + _object_shape(container)
+        dset = _create_dataset(outf, container, container.name + "/packed",
+                               shape=shape)
+        write(dset, read_packed)
+        dset.attrs["variables"] = np.array(
+            [variable_name(br) for br in container.branches], "S")
+    else:
+        for br in container.branches:
+            shape = (n_events,) + _object_shape(container)
+            dset = _create_branch(outf, container, br, shape=shape)
+            write(dset, partial(read, br))
+
+    if container.flags:
+        # Small enough to be shuffled in memory
+        write_flags(outf, container, read(flag_branch(container), 0, n_events))
+
+    return n_events
+
+
+def merge_container(outf, container, partfiles, i=0, memory_budget=None,
+                    tmpdir=None):
+    """
+    Merges the branches of a container for the i-th selection from the part
+    files (in the order given) and writes them to an open hdf5 file. Only one
+    branch (or the packed container) is held in memory at a time (required
+    for the in-memory shuffle). If 'memory_budget' (in bytes) is given, the
+    branches are shuffled out-of-core in blocks of events fitting into the
+    budget using temporary files in 'tmpdir'.
+    """
+    # Event boundaries of the part files
+    first = _staging_name(i, output_branches(container)[0])
+    lengths = []
+    for fn in partfiles:
+        with h5py.File(fn, "r") as f:
+            lengths.append(len(f[first]))
+    bounds = np.cumsum([0] + lengths)
+
+    if memory_budget and bounds[-1] > 0:
+        files = [h5py.File(fn, "r") for fn in partfiles]
+        try:
+            def read(br, start, stop):
+                name = _staging_name(i, br)
+
+                pieces = []
+                for f, lo, hi in zip(files, bounds[:-1], bounds[1:]):
+                    if lo < stop and hi > start:
+                        pieces.append(f[name][max(start, lo) - lo:
+                                              min(stop, hi) - lo])
+
+                return np.concatenate(pieces)
+
+            return _write_columns_external(
+                outf, container, read, int(bounds[-1]),
+                block_size(container, memory_budget), tmpdir)
+        finally:
+            for f in files:
+                f.close()
+
+    def load(br):
+        name = _staging_name(i, br)
+
+        pieces = []
+        for fn in partfiles:
+            with h5py.File(fn, "r") as f:
+                pieces.append(f[name][...])
+
+        return np.concatenate(pieces)
+
+    return _write_columns(outf, container, load)
+
+
+def convert_serial(infiles, treename, containers, sels, outfs, progress=None):
+    """
+    Converts the input files in memory. Writes the entries passing the i-th
+    selection in 'sels' to the i-th open hdf5 file in 'outfs'.
+    """
+    for container in containers:
+        log.info("Loading {} branches ...".format(container.name))
+        data = read_container(infiles, treename, container, sels,
+                              progress=progress)
+
+        for outf, d in zip(outfs, data):
+            write_container(outf, container, d)
+
+
+def convert_streaming(infiles, treename, containers, sels, outfs,
+                      memory_budget, tmpdir=None, progress=None):
+    """
+    Converts the input files reading blocks of entries within 'memory_budget'
+    (in bytes) which are appended to a temporary staging file. The staged
+    branches are then shuffled and written one at a time. The result is
+    identical to the in-memory conversion.
+    """
+    stagedir = tempfile.mkdtemp(prefix="ntuple2hdf_", dir=tmpdir)
+    try:
+        stagefile = os.path.join(stagedir, "staging.h5")
+
+        log.info("Staging input files ...")
+        stage_files(infiles, treename, containers, sels, stagefile,
+                    memory_budget=memory_budget, progress=progress)
+
+        for container in containers:
+            log.info("Writing {} branches ...".format(container.name))
+            for i, outf in enumerate(outfs):
+                merge_container(outf, container, [stagefile], i=i,
+                                memory_budget=memory_budget, tmpdir=stagedir)
+    finally:
+        shutil.rmtree(stagedir)
+
+
+def convert_parallel(infiles, treename, containers, sels, outfs, jobs,
+                     memory_budget=None, tmpdir=None, progress=None):
+    """
+    Converts the input files in parallel using a pool of 'jobs' workers (one
+    task per input file) and merges the per-file outputs in the order of
+    'infiles'. The result is identical to the serial conversion. The memory
+    budget (in bytes) applies to each worker.
+    """
+    if progress is None:
+        progress = lambda it, **kwargs: it
+
+    partdir = tempfile.mkdtemp(prefix="ntuple2hdf_", dir=tmpdir)
+    try:
+        partfiles = [os.path.join(partdir, "part_{:05d}.h5".format(i))
+                     for i in range(len(infiles))]
+        tasks = [(fn, treename, containers, sels, partfile, memory_budget)
+                 for fn, partfile in zip(infiles, partfiles)]
+
+        log.info("Converting {} files using {} workers ...".format(
+            len(infiles), jobs))
+
+        pool = Pool(processes=jobs)
+        try:
+            # imap preserves the order of the tasks
+            for _ in progress(pool.imap(convert_file_to_part, tasks),
+                              total=len(tasks)):
+                pass
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        for container in containers:
+            log.info("Merging {} branches ...".format(container.name))
+            for i, outf in enumerate(outfs):
+                merge_container(outf, container, partfiles, i=i,
+                                memory_budget=memory_budget, tmpdir=partdir)
+    finally:
+        shutil.rmtree(partdir)
+
+
+def read_manifest(outf):
+    """
+    Returns the list of input files converted into an open hdf5 file or None
+    if the file has no manifest
+    """
+    if manifest_name not in outf:
+        return None
+
+    return [fn.decode() if isinstance(fn, bytes) else fn
+            for fn in outf[manifest_name][...]]
+
+
+def write_manifest(outf, infiles):
+    """Adds input files (absolute paths) to the manifest of an hdf5 file"""
+    infiles = [os.path.abspath(fn) for fn in infiles]
+
+    if manifest_name not in outf:
+        outf.create_dataset(manifest_name, shape=(0,), maxshape=(None,),
+                            dtype=h5py.special_dtype(vlen=str))
+
+    dset = outf[manifest_name]
+    n = len(dset)
+    dset.resize(n + len(infiles), axis=0)
+    dset[n:] = infiles
+
+
+def is_stats_dataset(name):
+    """True for the statistics of packed containers (see 'write_stats')"""
+    return stats_group in name.split("/")
+
+
+def _container_datasets(f, container):
+    """
+    Names of all datasets of a container in an open hdf5 file (excluding the
+    statistics)
+    """
+    names = []
+
+    def visitor(name, node):
+        if isinstance(node, h5py.Dataset) and not is_stats_dataset(name):
+            names.append(container.name + "/" + name)
+
+    f[container.name].visititems(visitor)
+    return names
+
+
+def _append_dataset(dset, data, offset=None):
+    """Appends an array to a resizable dataset (optionally shifted)"""
+    if offset is not None:
+        data = data + offset
+
+    n = len(dset)
+    dset.resize(n + len(data), axis=0)
+    dset[n:] = data
+
+
+def append_sample(outf, newf, containers):
+    """
+    Appends the containers converted into the open hdf5 file 'newf' to the
+    resizable datasets of 'outf'. Both files have to be converted with the
+    same branches and storage format. Returns the number of events before
+    appending.
+    """
+    n_old = None
+    for container in containers:
+        names = _container_datasets(newf, container)
+
+        missing = [name for name in names if name not in outf]
+        if missing:
+            raise ValueError("Datasets missing in output: " + ", ".join(missing))
+
+        for name in names:
+            dset = outf[name]
+            if name.endswith("/_offsets"):
+                # Shift offsets of the new events by the existing objects
+                _append_dataset(dset, newf[name][1:], offset=dset[-1])
+            else:
+                if name.endswith("/_counts") or not is_ragged(container):
+                    n_old = len(dset)
+                _append_dataset(dset, newf[name][...])
+
+    return n_old
+
+
+def block_swaps(n_old, n_total, block_rows, random_state):
+    """
+    Block swaps that insert the blocks of events appended after 'n_old'
+    events at random positions (inside-out Fisher-Yates on blocks of
+    'block_rows' events). A trailing partial block is not moved.
+    """
+    swaps = []
+    for j in range(n_old // block_rows, n_total // block_rows):
+        i = random_state.randint(0, j + 1)
+        if i != j:
+            swaps.append((i, j))
+
+    return swaps
+
+
+def block_shuffle(outf, containers, n_old, block_rows):
+    """
+    Shuffles the events appended after the first 'n_old' events into the
+    existing events by swapping blocks of 'block_rows' events. The same swaps
+    are applied to all datasets of the containers. Ragged containers cannot
+    be block-shuffled in place (blocks differ in the number of objects).
+    """
+    if any(is_ragged(c) for c in containers):
+        raise ValueError("Block shuffle not supported for ragged storage")
+
+    names = []
+    for container in containers:
+        names += _container_datasets(outf, container)
+
+    n_total = len(outf[names[0]])
+
+    # Seeded with the number of existing events so that repeated appends use
+    # different swaps
+    random_state = np.random.RandomState(seed=seed + n_old)
+    swaps = block_swaps(n_old, n_total, block_rows, random_state)
+    log.info("Swapping {} blocks of {} events ...".format(len(swaps),
+                                                         block_rows))
+
+    for name in names:
+        dset = outf[name]
+        assert len(dset) == n_total
+
+        for i, j in swaps:
+            sel_i = np.s_[i * block_rows:(i + 1) * block_rows]
+            sel_j = np.s_[j * block_rows:(j + 1) * block_rows]
+
+            block_i = dset[sel_i]
+            dset[sel_i] = dset[sel_j]
+            dset[sel_j] = block_i
+
+
+class ColumnStats(object):
+    """
+    Accumulates the statistics of a variable (see
+    'rnn_tauid.preprocessing.stats_fields') over blocks of events of shape
+    (n_events, [n_objects]). The histogram is filled in a second pass over the
+    blocks ('fill') once the range of the values is known.
+    """
+    def __init__(self, shape, bins=stats_bins):
+        self.bins = bins
+        self.n_events = 0
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.sum = np.zeros(shape)
+        self.sumsq = np.zeros(shape)
+        self.min = np.full(shape, np.inf)
+        self.max = np.full(shape, -np.inf)
+        self.hist = np.zeros(shape + (bins,), dtype=np.int64)
+
+
+    def update(self, block):
+        block = np.asarray(block, dtype=np.float64)
+        self.n_events += len(block)
+        if len(block) == 0:
+            return
+
+        valid = ~np.isnan(block)
+        values = np.where(valid, block, 0.0)
+        self.count += valid.sum(axis=0)
+        self.sum += values.sum(axis=0)
+        self.sumsq += (values * values).sum(axis=0)
+
+        finite = np.isfinite(block)
+        np.minimum(self.min, np.where(finite, block, np.inf).min(axis=0),
+                   out=self.min)
+        np.maximum(self.max, np.where(finite, block, -np.inf).max(axis=0),
+                   out=self.max)
+
+
+    def edges(self):
+        """Bin edges of the histogram (range of all objects)"""
+        lo, hi = self.min.min(), self.max.max()
+        if not np.isfinite(lo):
+            lo, hi = 0.0, 1.0
+        elif hi == lo:
+            hi = lo + 1.0
+
+        return np.linspace(lo, hi, self.bins + 1)
+
+
+    def fill(self, block):
+        block = np.asarray(block, dtype=np.float64)
+        edges = self.edges()
+        finite = np.isfinite(block)
+
+        # Flat index (object, bin) of every finite value
+        index = (block[finite] - edges[0]) / (edges[-1] - edges[0])
+        index = np.clip((index * self.bins).astype(np.int64), 0,
+                        self.bins - 1)
+        obj = np.broadcast_to(np.arange(self.count.size).reshape(
+            self.count.shape), block.shape)
+        index += obj[finite] * self.bins
+
+        self.hist += np.bincount(index, minlength=self.hist.size).reshape(
+            self.hist.shape)
+
+
+    def attrs(self):
+        """Statistics as dictionary of attributes"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            nan_fraction = 1.0 - self.count / float(self.n_events)
+
+        stats = {
+            "count": self.count,
+            "nan_fraction": nan_fraction,
+            "sum": self.sum,
+            "sumsq": self.sumsq,
+            "min": np.where(np.isfinite(self.min), self.min, np.nan),
+            "max": np.where(np.isfinite(self.max), self.max, np.nan),
+            "hist": self.hist,
+            "hist_edges": self.edges()
+        }
+        assert sorted(stats) == sorted(stats_fields)
+
+        return stats
+
+
+def write_stats(outf, containers, block_rows=65536, bins=stats_bins):
+    """
+    Computes the statistics of all variables of the containers (two passes
+    over blocks of 'block_rows' events) and stores them as attributes
+    'stats_<field>' of the datasets. For packed containers the statistics of
+    all variables are stacked and stored as datasets
+    '<container>/_stats/<field>' (too large for attributes, see
+    'rnn_tauid.preprocessing.stats_group'). Missing values and padding are
+    ignored.
+    """
+    from rnn_tauid.utils import SampleFile
+    sample = SampleFile(outf)
+
+    for container in containers:
+        names = [dataset_name(br) for br in container.branches]
+        columns = [sample[name] for name in names]
+        n_events = len(columns[0])
+
+        stats = [ColumnStats(tuple(col.shape[1:]), bins=bins)
+                 for col in columns]
+
+        log.info("Computing statistics of {} ...".format(container.name))
+        for update in ("update", "fill"):
+            for start in range(0, n_events, block_rows):
+                sel = np.s_[start:start + block_rows]
+                for col, st in zip(columns, stats):
+                    getattr(st, update)(col[sel])
+
+        stats = [st.attrs() for st in stats]
+        if container.storage == "packed":
+            _write_stats_group(outf, container.name, {
+                field: np.stack([st[field] for st in stats])
+                for field in stats_fields})
+        else:
+            for name, st in zip(names, stats):
+                for field, value in st.items():
+                    outf[name].attrs["stats_" + field] = value
+
+    sample.clear_cache()
+
+
+def remove_stats(outf, containers):
+    """
+    Removes the statistics of the containers (e.g. outdated after appending
+    events)
+    """
+    for container in containers:
+        name = container.name + "/" + stats_group
+        if name in outf:
+            del outf[name]
+
+        for name in _container_datasets(outf, container):
+            attrs = outf[name].attrs
+            for field in stats_fields:
+                if "stats_" + field in attrs:
+                    del attrs["stats_" + field]
+
+
+def _write_stats_group(outf, container, stats):
+    """Stores the statistics of a packed container (replacing existing)"""
+    name = container + "/" + stats_group
+    if name in outf:
+        del outf[name]
+
+    group = outf.create_group(name)
+    for field, value in stats.items():
+        group[field] = value
+
+
+def _rebin(hist, edges, new_edges):
+    """Moves the counts of a histogram to the bins of 'new_edges'"""
+    centres = 0.5 * (edges[1:] + edges[:-1])
+    index = np.clip(np.searchsorted(new_edges, centres, side="right") - 1,
+                    0, len(new_edges) - 2)
+    return np.bincount(index, weights=hist,
+                       minlength=len(new_edges) - 1).astype(hist.dtype)
+
+
+def merge_stats(stats, n_events):
+    """
+    Merges the statistics (dictionaries of attributes, see 'ColumnStats') of
+    samples with 'n_events' events each. Histograms with different ranges are
+    rebinned to the combined range by the bin centres.
+    """
+    n_total = float(sum(n_events))
+    merged = {
+        "count": sum(st["count"] for st in stats),
+        "sum": sum(st["sum"] for st in stats),
+        "sumsq": sum(st["sumsq"] for st in stats),
+        "min": reduce(np.fmin, [st["min"] for st in stats]),
+        "max": reduce(np.fmax, [st["max"] for st in stats]),
+        "nan_fraction": sum(st["nan_fraction"] * n
+                            for st, n in zip(stats, n_events)) / n_total
+    }
+
+    edges = [np.asarray(st["hist_edges"]) for st in stats]
+    if all(np.array_equal(e, edges[0]) for e in edges):
+        merged["hist"] = sum(st["hist"] for st in stats)
+        merged["hist_edges"] = edges[0]
+        return merged
+
+    # Common range per variable (leading axes of the edges)
+    lo = reduce(np.fmin, [e[..., 0] for e in edges])
+    hi = reduce(np.fmax, [e[..., -1] for e in edges])
+    bins = edges[0].shape[-1] - 1
+    new_edges = np.linspace(lo, hi, bins + 1, axis=-1)
+
+    hist = np.zeros_like(stats[0]["hist"])
+    for st, e in zip(stats, edges):
+        # Loop over variables and objects
+        for index in np.ndindex(hist.shape[:-1]):
+            e_index = index[:e.ndim - 1]
+            hist[index] += _rebin(st["hist"][index], e[e_index],
+                                  new_edges[e_index])
+
+    merged["hist"] = hist
+    merged["hist_edges"] = new_edges
+    return merged
+
+
+def _source_name(filename):
+    """File name of a virtual dataset source ('%' is a format character)"""
+    return os.path.abspath(filename).replace("%", "%%")
+
+
+def _sample_datasets(f):
+    """
+    Names of all datasets of a sample (excluding the manifest and the
+    statistics of packed containers)
+    """
+    names = []
+
+    def visitor(name, node):
+        if isinstance(node, h5py.Dataset) and name != manifest_name and \
+           not is_stats_dataset(name):
+            names.append(name)
+
+    f.visititems(visitor)
+    return names
+
+
+def _plain_attrs(attrs):
+    """Attributes excluding the statistics"""
+    return {k: v for k, v in attrs.items() if not k.startswith("stats_")}
+
+
+def _same_attrs(a, b):
+    return sorted(a) == sorted(b) and \
+        all(np.array_equal(a[k], b[k]) for k in a)
+
+
+def combine_samples(outf, filenames, srcfs):
+    """
+    Writes virtual datasets into the open hdf5 file 'outf' that concatenate
+    the events of the samples 'srcfs' (open hdf5 files of 'filenames') in the
+    given order without copying the data. The samples must have the same
+    datasets, object shapes, types and attributes (storage, variables of
+    packed containers, selection flags). The offsets of ragged containers are
+    recomputed, the statistics and manifests are merged.
+
+    The sources are opened with the file driver of 'outf', i.e. samples split
+    with the family driver can only be combined into a family file and vice
+    versa.
+    """
+    names = _sample_datasets(srcfs[0])
+    for fn, f in zip(filenames[1:], srcfs[1:]):
+        if sorted(_sample_datasets(f)) != sorted(names):
+            raise ValueError("Datasets of {} differ from {}".format(
+                fn, filenames[0]))
+
+    # Groups and their attributes (storage of ragged containers)
+    groups = sorted(set(name.rpartition("/")[0] for name in names) - {""})
+    for group in groups:
+        attrs = _plain_attrs(srcfs[0][group].attrs)
+        for fn, f in zip(filenames[1:], srcfs[1:]):
+            if not _same_attrs(attrs, _plain_attrs(f[group].attrs)):
+                raise ValueError("Attributes of {} in {} differ from {}"
+                                 .format(group, fn, filenames[0]))
+
+        outf.require_group(group).attrs.update(attrs)
+
+    ragged = [g for g in groups if outf[g].attrs.get("storage") == "ragged"]
+    offsets = [g + "/_offsets" for g in ragged]
+
+    # Number of events of the samples (from any dataset of event rows)
+    ragged_values = set(name for name in names
+                        if name.rpartition("/")[0] in ragged)
+    event_rows = [name for name in names if name not in ragged_values]
+    n_events = [len(f[event_rows[0]]) for f in srcfs]
+
+    for name in names:
+        if name in offsets:
+            continue
+
+        dsets = [f[name] for f in srcfs]
+        dtype = dsets[0].dtype
+        shape = dsets[0].shape[1:]
+        attrs = _plain_attrs(dsets[0].attrs)
+        for fn, dset in zip(filenames[1:], dsets[1:]):
+            if dset.dtype != dtype or dset.shape[1:] != shape or \
+               not _same_attrs(attrs, _plain_attrs(dset.attrs)):
+                raise ValueError("Dataset {} of {} differs from {}".format(
+                    name, fn, filenames[0]))
+
+        n_rows = [len(dset) for dset in dsets]
+        layout = h5py.VirtualLayout(shape=(sum(n_rows),) + shape,
+                                    dtype=dtype)
+
+        start = 0
+        for fn, dset in zip(filenames, dsets):
+            layout[start:start + len(dset)] = h5py.VirtualSource(
+                _source_name(fn), name, shape=dset.shape)
+            start += len(dset)
+
+        fillvalue = np.nan if dtype.kind == "f" else \
+            attrs.get("nan_value", 0)
+        dset = outf.create_virtual_dataset(name, layout, fillvalue=fillvalue)
+        dset.attrs.update(attrs)
+
+        if all("stats_count" in d.attrs for d in dsets):
+            stats = merge_stats(
+                [{k[len("stats_"):]: d.attrs[k] for k in d.attrs
+                  if k.startswith("stats_")} for d in dsets], n_events)
+            for field, value in stats.items():
+                dset.attrs["stats_" + field] = value
+
+    # Statistics of packed containers
+    for group in groups:
+        name = group + "/" + stats_group
+        if all(name in f for f in srcfs):
+            stats = merge_stats(
+                [{field: f[name][field][...] for field in stats_fields}
+                 for f in srcfs], n_events)
+            _write_stats_group(outf, group, stats)
+
+    # Offsets of the events of ragged containers in the combined sample
+    for group in ragged:
+        counts = np.concatenate([f[group + "/_counts"][...] for f in srcfs])
+        index = np.zeros(len(counts) + 1,
+                         dtype=srcfs[0][group + "/_offsets"].dtype)
+        np.cumsum(counts, out=index[1:])
+        outf.create_dataset(group + "/_offsets", data=index)
+
+    # File attributes (chunk layout) if common to all samples
+    attrs = dict(srcfs[0].attrs)
+    if all(_same_attrs(attrs, dict(f.attrs)) for f in srcfs[1:]):
+        outf.attrs.update(attrs)
+    else:
+        outf.attrs["layout"] = "auto"
+
+    infiles = []
+    for f in srcfs:
+        infiles += read_manifest(f) or []
+    write_manifest(outf, infiles)
+
+    return sum(n_events)
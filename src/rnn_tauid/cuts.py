@@ -1,3 +1,6 @@
+from rnn_tauid.expressions import Expression
+
+
 def and_cuts(cuts):
     """Combines a list of cut expressions with the logical and"""
     parens = ["({0})".format(cut) for cut in cuts]
@@ -36,3 +39,17 @@ sel_dict = {
     "truth3p": sel_truth_3p, "3p": sel_3p,
     "truthXp": sel_truth_Xp, "Xp": sel_Xp
 }
+
+
+def compile_cut(cut, backend="auto"):
+    """
+    Compiles a cut expression (e.g. 'sel_dict["1p"]') to a vectorized
+    selection evaluated on columns instead of a ROOT tree. The result is
+    called with a dictionary of arrays or an open hdf5 file (branch names are
+    mapped to dataset names) and returns the boolean mask:
+
+        mask = compile_cut(sel_1p)(datafile)
+
+    See 'rnn_tauid.expressions.Expression'.
+    """
+    return Expression(cut, backend=backend, boolean=True)
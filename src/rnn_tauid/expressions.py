@@ -0,0 +1,458 @@
+"""
+Parser and vectorized evaluation of the C-like expressions used for
+selections (see 'rnn_tauid.cuts'), e.g.
+
+    (abs(TauJets.eta) < 2.5) && (TauJets.nTracks == 1 || TauJets.nTracks == 3)
+
+Expressions support the operators ||, &&, !, comparisons, +, -, *, /, %, the
+functions in 'functions' and the constants in 'constants'. Variables are branch names ('TauJets.pt') or
+dataset names ('TauJets/pt') and are looked up in both forms in the columns
+passed on evaluation (dictionaries of arrays or open hdf5 files). Since
+'a/b' is read as a dataset name, divisions of undotted variables need spaces
+('a / b').
+
+Expressions are evaluated with numexpr if available and supported by the
+expression, otherwise with numpy. 'Transform' uses expressions as variable
+definitions (see 'rnn_tauid.variables').
+"""
+import re
+from collections import namedtuple
+
+import numpy as np
+
+
+# Node of the expression tree: 'op' is one of 'num', 'var', 'call', 'not',
+# 'neg' or a binary operator. 'args' holds the value / name for 'num' and
+# 'var', the function name followed by the arguments for 'call' and the
+# operands otherwise.
+Node = namedtuple("Node", ["op", "args"])
+
+# Functions available in expressions: name -> (numpy function, numexpr name)
+functions = {
+    "abs": (np.abs, "abs"),
+    "fabs": (np.abs, "abs"),
+    "sqrt": (np.sqrt, "sqrt"),
+    "exp": (np.exp, "exp"),
+    "log": (np.log, "log"),
+    "log10": (np.log10, "log10"),
+    "sin": (np.sin, "sin"),
+    "cos": (np.cos, "cos"),
+    "tan": (np.tan, "tan"),
+    "atan2": (np.arctan2, "arctan2"),
+    "fmod": (np.fmod, "fmod"),
+    "min": (np.minimum, "minimum"),
+    "max": (np.maximum, "maximum")
+}
+
+# Named constants
+constants = {
+    "pi": np.pi
+}
+
+# Binary operators by precedence (lowest first)
+_binary_ops = [["||"], ["&&"], ["==", "!=", "<=", ">=", "<", ">"],
+               ["+", "-"], ["*", "/", "%"]]
+
+_logical_ops = {"||", "&&", "not"}
+_comparison_ops = {"==", "!=", "<=", ">=", "<", ">"}
+
+_token_re = re.compile(r"""
+    \s*(?:
+        (?P<num>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?) |
+        (?P<name>(?:[A-Za-z_]\w*::)?[A-Za-z_]\w*(?:[./][A-Za-z_]\w*)?) |
+        (?P<op>\|\||&&|==|!=|<=|>=|[-+*/%<>!(),])
+    )""", re.VERBOSE)
+
+
+def tokenize(expr):
+    """Splits an expression into a list of (kind, value) tokens"""
+    tokens = []
+    pos = 0
+    expr = expr.rstrip()
+    while pos < len(expr):
+        match = _token_re.match(expr, pos)
+        if not match:
+            raise SyntaxError("Invalid expression at position {}: {}".format(
+                pos, expr))
+
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind)))
+        pos = match.end()
+
+    return tokens
+
+
+class _Parser(object):
+    """Recursive descent parser for 'parse'"""
+    def __init__(self, expr):
+        self.expr = expr
+        self.tokens = tokenize(expr)
+        self.pos = 0
+
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        else:
+            return (None, None)
+
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+
+    def expect(self, value):
+        kind, token = self.next()
+        if token != value:
+            raise SyntaxError("Expected '{}' but got '{}' in: {}".format(
+                value, token, self.expr))
+
+
+    def parse(self):
+        node = self.binary(0)
+        if self.pos != len(self.tokens):
+            raise SyntaxError("Unexpected '{}' in: {}".format(
+                self.peek()[1], self.expr))
+
+        return node
+
+
+    def binary(self, level):
+        if level == len(_binary_ops):
+            return self.unary()
+
+        node = self.binary(level + 1)
+        while self.peek()[0] == "op" and self.peek()[1] in _binary_ops[level]:
+            _, op = self.next()
+            node = Node(op, (node, self.binary(level + 1)))
+
+            # Comparisons do not chain
+            if op in _comparison_ops:
+                break
+
+        return node
+
+
+    def unary(self):
+        kind, token = self.peek()
+        if kind == "op" and token in ("!", "-", "+"):
+            self.next()
+            node = self.unary()
+            if token == "!":
+                return Node("not", (node,))
+            elif token == "-":
+                return Node("neg", (node,))
+            else:
+                return node
+
+        return self.atom()
+
+
+    def atom(self):
+        kind, token = self.next()
+        if kind == "num":
+            return Node("num", (float(token),))
+        elif kind == "name":
+            if self.peek()[1] == "(":
+                self.next()
+                name = token.split("::")[-1].lower()
+                if name not in functions:
+                    raise SyntaxError("Unknown function '{}' in: {}".format(
+                        token, self.expr))
+
+                args = [self.binary(0)]
+                while self.peek()[1] == ",":
+                    self.next()
+                    args.append(self.binary(0))
+                self.expect(")")
+
+                return Node("call", (name,) + tuple(args))
+            elif token in constants:
+                return Node("num", (constants[token],))
+            else:
+                return Node("var", (token.replace("/", "."),))
+        elif token == "(":
+            node = self.binary(0)
+            self.expect(")")
+            return node
+        else:
+            raise SyntaxError("Unexpected '{}' in: {}".format(token,
+                                                               self.expr))
+
+
+def parse(expr):
+    """Parses an expression into a tree of 'Node's"""
+    return _Parser(expr).parse()
+
+
+def variables(node):
+    """Returns the sorted list of variables (branch names) of a tree"""
+    if node.op == "var":
+        return list(node.args)
+    elif node.op == "num":
+        return []
+
+    args = node.args[1:] if node.op == "call" else node.args
+    return sorted(set(v for arg in args for v in variables(arg)))
+
+
+def is_boolean(node):
+    """True if the node evaluates to a boolean"""
+    return node.op in _logical_ops or node.op in _comparison_ops
+
+
+def lookup(columns, name, source_sel=Ellipsis):
+    """
+    Reads a variable from 'columns' (dictionary of arrays or open hdf5 file)
+    as branch name (e.g. 'TauJets.pt') or dataset name (e.g. 'TauJets/pt')
+    """
+    for key in (name, name.replace(".", "/")):
+        if key in columns:
+            return np.asarray(columns[key][source_sel])
+
+    raise KeyError("Variable '{}' not found".format(name))
+
+
+def _mod(a, b):
+    """Modulo of the operands converted to integers (as in TTreeFormula)"""
+    return np.fmod(np.asarray(a).astype(np.int64),
+                   np.asarray(b).astype(np.int64))
+
+
+_numpy_ops = {
+    "||": np.logical_or,
+    "&&": np.logical_and,
+    "==": np.equal,
+    "!=": np.not_equal,
+    "<=": np.less_equal,
+    ">=": np.greater_equal,
+    "<": np.less,
+    ">": np.greater,
+    "+": np.add,
+    "-": np.subtract,
+    "*": np.multiply,
+    "/": np.true_divide,
+    "%": _mod
+}
+
+
+def evaluate(node, values):
+    """
+    Evaluates a tree with numpy. 'values' maps variable names to arrays.
+    """
+    if node.op == "num":
+        return node.args[0]
+    elif node.op == "var":
+        return values[node.args[0]]
+    elif node.op == "call":
+        func, _ = functions[node.args[0]]
+        return func(*[evaluate(arg, values) for arg in node.args[1:]])
+    elif node.op == "not":
+        return np.logical_not(evaluate(node.args[0], values))
+    elif node.op == "neg":
+        return np.negative(evaluate(node.args[0], values))
+    else:
+        lhs, rhs = node.args
+        return _numpy_ops[node.op](evaluate(lhs, values),
+                                   evaluate(rhs, values))
+
+
+def to_numexpr(node, names):
+    """
+    Translates a tree to a numexpr expression. 'names' maps variable names to
+    numexpr identifiers. Returns None if the expression is not supported by
+    numexpr.
+    """
+    def truth(arg):
+        code = to_numexpr(arg, names)
+        if code is None or is_boolean(arg):
+            return code
+        else:
+            return "({} != 0)".format(code)
+
+    if node.op == "num":
+        return repr(node.args[0])
+    elif node.op == "var":
+        return names[node.args[0]]
+    elif node.op == "call":
+        _, name = functions[node.args[0]]
+        args = [to_numexpr(arg, names) for arg in node.args[1:]]
+        if name is None or None in args:
+            return None
+        return "{}({})".format(name, ", ".join(args))
+    elif node.op == "not":
+        arg = truth(node.args[0])
+        return None if arg is None else "(~{})".format(arg)
+    elif node.op == "neg":
+        arg = to_numexpr(node.args[0], names)
+        return None if arg is None else "(-{})".format(arg)
+    elif node.op == "%":
+        # Integer conversion not supported by numexpr
+        return None
+    elif node.op in ("||", "&&"):
+        lhs, rhs = truth(node.args[0]), truth(node.args[1])
+        op = "|" if node.op == "||" else "&"
+    else:
+        lhs = to_numexpr(node.args[0], names)
+        rhs = to_numexpr(node.args[1], names)
+        op = node.op
+
+    if lhs is None or rhs is None:
+        return None
+
+    return "({} {} {})".format(lhs, op, rhs)
+
+
+def _numexpr_compiles(numexpr, code, names):
+    """True if the installed numexpr version supports the expression"""
+    local_dict = {name: np.zeros(1, dtype=np.float32) for name in names}
+    try:
+        numexpr.evaluate(code, local_dict=local_dict)
+    except (KeyError, NotImplementedError, SyntaxError, TypeError,
+            ValueError):
+        return False
+
+    return True
+
+
+class Expression(object):
+    """
+    Compiled expression. Calling it with columns (dictionary of arrays or open
+    hdf5 file) and an optional selection of entries returns the evaluated
+    array. Boolean expressions (e.g. cuts) are returned as boolean masks.
+    """
+    def __init__(self, expr, backend="auto", boolean=False):
+        if backend not in ("auto", "numpy", "numexpr"):
+            raise ValueError("Unknown backend: " + backend)
+
+        self.expr = expr
+        self.tree = parse(expr)
+        self.variables = variables(self.tree)
+        self.boolean = boolean
+
+        self._names = {var: "v{}".format(i)
+                       for i, var in enumerate(self.variables)}
+        self._numexpr = None
+        self._code = None
+
+        if backend != "numpy":
+            try:
+                import numexpr
+            except ImportError:
+                numexpr = None
+
+            tree = self.tree
+            if boolean and not is_boolean(tree):
+                tree = Node("!=", (tree, Node("num", (0.0,))))
+
+            code = to_numexpr(tree, self._names)
+            if numexpr is not None and code is not None and \
+               _numexpr_compiles(numexpr, code, self._names.values()):
+                self._numexpr = numexpr
+                self._code = code
+
+            if backend == "numexpr" and self._numexpr is None:
+                raise RuntimeError("Expression not supported by numexpr or "
+                                   "numexpr not installed: " + expr)
+
+        self.backend = "numexpr" if self._numexpr is not None else "numpy"
+
+
+    def __call__(self, columns, source_sel=Ellipsis):
+        values = {var: lookup(columns, var, source_sel=source_sel)
+                  for var in self.variables}
+
+        if self._numexpr is not None:
+            local_dict = {self._names[var]: values[var]
+                          for var in self.variables}
+            result = self._numexpr.evaluate(self._code,
+                                            local_dict=local_dict)
+        else:
+            result = evaluate(self.tree, values)
+
+        if self.boolean:
+            result = np.asarray(result) != 0
+
+        return result
+
+
+    def __repr__(self):
+        return "Expression({!r})".format(self.expr)
+
+
+class Transform(object):
+    """
+    Variable definition given by an expression of datasets, e.g.
+
+        Transform("log10(max(TauJets/mEflowApprox, 140))")
+
+    which is used in place of the functions in 'rnn_tauid.variables'
+    (signature 'func(datafile, dest, source_sel=None, dest_sel=None)').
+    Scalar variables (e.g. 'TauJets/eta') are broadcast along the objects of
+    sequences. If 'offset' and 'scale' are given, the preprocessing
+    '(x - offset) / scale' is applied as well. With numexpr the expression
+    is evaluated in a single pass into the destination array.
+    """
+    def __init__(self, expr, backend="auto"):
+        self.expression = Expression(expr, backend=backend)
+        self.expr = expr
+        self.variables = self.expression.variables
+        self.backend = self.expression.backend
+
+        if self.backend == "numexpr":
+            self._code = self.expression._code
+            self._scaled_code = "(({}) - offset) / scale".format(self._code)
+
+
+    def values(self, datafile, source_sel=None):
+        """Reads the variables of the expression for a selection"""
+        if source_sel is None:
+            source_sel = Ellipsis
+
+        values = {}
+        for var in self.variables:
+            column = datafile[var.replace(".", "/")]
+            if isinstance(source_sel, tuple) and len(column.shape) == 1:
+                # Broadcast along the objects
+                values[var] = np.asarray(
+                    column[source_sel[0]])[:, np.newaxis]
+            else:
+                values[var] = np.asarray(column[source_sel])
+
+        return values
+
+
+    def __call__(self, datafile, dest, source_sel=None, dest_sel=None,
+                 offset=None, scale=None):
+        if dest_sel is None:
+            dest_sel = Ellipsis
+
+        values = self.values(datafile, source_sel=source_sel)
+
+        if self.backend == "numexpr":
+            names = self.expression._names
+            local_dict = {names[var]: values[var] for var in self.variables}
+            code = self._code
+            if offset is not None:
+                local_dict["offset"] = np.asarray(offset)
+                local_dict["scale"] = np.asarray(scale)
+                code = self._scaled_code
+
+            numexpr = self.expression._numexpr
+            out = dest[dest_sel]
+            if np.may_share_memory(out, dest):
+                numexpr.evaluate(code, local_dict=local_dict, out=out,
+                                 casting="same_kind")
+            else:
+                dest[dest_sel] = numexpr.evaluate(code, local_dict=local_dict)
+        else:
+            result = evaluate(self.expression.tree, values)
+            if offset is not None:
+                result = (result - offset) / scale
+            dest[dest_sel] = result
+
+
+    def __repr__(self):
+        return "Transform({!r})".format(self.expr)
@@ -0,0 +1,321 @@
+"""
+Batches for the training streamed from converted samples instead of loading
+the samples into memory (see 'BatchSequence').
+"""
+import logging
+import threading
+from collections import namedtuple
+
+import numpy as np
+from keras.utils import Sequence
+
+from rnn_tauid.expressions import Transform
+from rnn_tauid.pipeline import Pipeline
+from rnn_tauid.preprocessing import PtReweighter
+from rnn_tauid.utils import ReadPlan, aligned_chunksize, float_dtype, \
+    label_dtype, onehot_encode
+
+log = logging.getLogger(__name__)
+
+# Events [start, stop) of an open sample. 'labels(datafile, sel)' returns the
+# labels of the events in 'sel', 'weights' holds the per-event weights of the
+# events [start, stop) (or None for unit weights).
+Source = namedtuple("Source", ["datafile", "start", "stop", "labels",
+                               "weights"])
+
+# Network input: variable definitions (as in 'rnn_tauid.variables') read into
+# arrays of 'num' objects (None for scalar variables) and preprocessed with
+# 'preprocessing' (list of (offset, scale) for every variable). If 'cut' is
+# given as (variable index, threshold), objects with the preprocessed
+# variable below the threshold are removed (set to zero).
+Input = namedtuple("Input", ["variables", "num", "preprocessing", "cut"])
+Input.__new__.__defaults__ = (None,)
+
+
+def constant_labels(value):
+    """Labels of a source with a single class (e.g. signal / background)"""
+    def labels(datafile, sel):
+        n = len(np.arange(*sel.indices(len(datafile["TauJets/pt"]))))
+        return np.full(n, value, dtype=label_dtype)
+
+    return labels
+
+
+def onehot_labels(name, n_classes):
+    """
+    One-hot encoded labels from a dataset of class indices (e.g. decay mode,
+    see 'rnn_tauid.utils.onehot_encode')
+    """
+    def labels(datafile, sel):
+        return onehot_encode(datafile[name][sel], n_classes, name=name)
+
+    return labels
+
+
+def input_shape(inp):
+    """Shape of an input (without the event axis)"""
+    if inp.num:
+        return inp.num, len(inp.variables)
+    else:
+        return len(inp.variables),
+
+
+def read_input(datafile, inp, sel, plan=None, out=None):
+    """
+    Reads and preprocesses an input for the events in 'sel' (slice). The
+    result is written to the first events of 'out' if given.
+    """
+    n_events = len(np.arange(*sel.indices(len(datafile["TauJets/pt"]))))
+
+    if out is None:
+        x = np.empty((n_events,) + input_shape(inp), dtype=float_dtype)
+    else:
+        x = out[:n_events]
+
+    if inp.num:
+        src = np.s_[sel, :inp.num]
+    else:
+        src = sel
+
+    if plan is None:
+        plan = ReadPlan(datafile, (inp.variables, inp.num))
+    reader = plan.reader(datafile)
+
+    for i, ((varname, func, _), (offset, scale)) in enumerate(
+            zip(inp.variables, inp.preprocessing)):
+        dest = np.s_[..., i]
+
+        # Transforms apply offset and scale in the same pass
+        if isinstance(func, Transform):
+            func(reader, x, source_sel=src, dest_sel=dest, offset=offset,
+                 scale=scale)
+            continue
+
+        if func:
+            func(reader, x, source_sel=src, dest_sel=dest)
+        else:
+            reader[varname].read_direct(x, source_sel=src, dest_sel=dest)
+
+        x[dest] -= offset
+        x[dest] /= scale
+
+    if inp.cut:
+        col, threshold = inp.cut
+        x[x[..., col] < threshold] = np.nan
+
+    x[np.isnan(x)] = 0
+    return x
+
+
+class BatchSequence(Sequence):
+    """
+    Keras sequence of batches ([x for every input], y, w) read from the
+    sources on the fly. The events are read in blocks made of one part of
+    every source (parts of about 'block_size' events in total, aligned to the
+    chunks of the samples), such that every block mixes all sources. With
+    'shuffle' the order of the parts and the events within a block are
+    shuffled every epoch. With 'queue_depth' > 0 up to 'queue_depth' blocks
+    are read ahead by 'workers' threads while the batches of the current
+    block are consumed (see 'rnn_tauid.pipeline.Pipeline'). The blocks are
+    read into preallocated buffers and only the current and the blocks read
+    ahead are held in memory, therefore the batches are meant to be requested
+    in order (shuffle=False for keras).
+    """
+    def __init__(self, sources, inputs, batch_size=256, block_size=100000,
+                 shuffle=True, queue_depth=0, workers=1, seed=1234567890):
+        self.sources = sources
+        self.inputs = inputs
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.random_state = np.random.RandomState(seed=seed)
+
+        # Share datasets read by several variables of an input
+        self.plans = [[ReadPlan(src.datafile, (inp.variables, inp.num))
+                       for inp in inputs] for src in sources]
+
+        # Parts of the sources (one per source in every block)
+        n_total = sum(src.stop - src.start for src in sources)
+        n_blocks = max(1, -(-n_total // block_size))
+
+        self.parts = []
+        for src in sources:
+            n = src.stop - src.start
+            rows = aligned_chunksize(src.datafile, max(1, -(-n // n_blocks)))
+            self.parts.append([(i, min(i + rows, n))
+                               for i in range(0, n, rows)])
+
+        self.n_blocks = max(len(parts) for parts in self.parts)
+
+        # Buffers large enough for any block
+        max_events = sum(max(stop - start for start, stop in parts)
+                         for parts in self.parts if parts)
+
+        def alloc():
+            return [np.empty((max_events,) + input_shape(inp),
+                             dtype=float_dtype) for inp in inputs]
+
+        self.pipeline = Pipeline(self.read_block, alloc, depth=queue_depth,
+                                 workers=workers)
+
+        self._lock = threading.Lock()
+        self._items = None
+        self.on_epoch_end()
+
+
+    def on_epoch_end(self):
+        """Shuffles the parts and schedules the batches of the next epoch"""
+        with self._lock:
+            # Blocks read ahead belong to the previous epoch
+            self._stop()
+            if self.pipeline.waits:
+                log.info(self.pipeline.summary())
+
+            order = []
+            for parts in self.parts:
+                index = np.arange(self.n_blocks)
+                if self.shuffle:
+                    self.random_state.shuffle(index)
+                order.append([parts[i] if i < len(parts) else None
+                              for i in index])
+
+            self.blocks = list(zip(*order))
+            self.seeds = self.random_state.randint(2**31, size=self.n_blocks)
+
+            # Batches as (block, start, stop)
+            self.batches = []
+            for b, block in enumerate(self.blocks):
+                n = sum(stop - start for start, stop in
+                        (part for part in block if part is not None))
+                self.batches += [(b, i, min(i + self.batch_size, n))
+                                 for i in range(0, n, self.batch_size)]
+
+
+    def __len__(self):
+        return len(self.batches)
+
+
+    def read_block(self, b, buffers):
+        """
+        Reads block 'b' into 'buffers' (one per input). Returns the inputs
+        (views of the buffers), labels, weights and the order of the events.
+        """
+        n = 0
+        ys = []
+        ws = []
+        for src, plans, part in zip(self.sources, self.plans, self.blocks[b]):
+            if part is None:
+                continue
+
+            start, stop = part
+            sel = np.s_[src.start + start:src.start + stop]
+            for buf, inp, plan in zip(buffers, self.inputs, plans):
+                read_input(src.datafile, inp, sel, plan=plan, out=buf[n:])
+
+            ys.append(src.labels(src.datafile, sel))
+            if src.weights is None:
+                ws.append(np.ones(stop - start, dtype=float_dtype))
+            else:
+                ws.append(src.weights[start:stop])
+
+            n += stop - start
+
+        if self.shuffle:
+            order = np.random.RandomState(self.seeds[b]).permutation(n)
+        else:
+            order = np.arange(n)
+
+        return ([buf[:n] for buf in buffers], np.concatenate(ys),
+                np.concatenate(ws), order)
+
+
+    def _stop(self):
+        """Stops reading ahead"""
+        if self._items is not None:
+            self._items.close()
+
+        self._items = None
+        self._current = None
+        self._next = None
+
+
+    def block(self, b):
+        """Block 'b' (valid until another block is requested)"""
+        if self._current is not None and self._current[0] == b:
+            return self._current[1]
+
+        # Restart the pipeline if the blocks are not requested in order
+        if self._next != b:
+            self._stop()
+            self._items = self.pipeline.run(range(b, self.n_blocks))
+
+        _, _, block = next(self._items)
+        self._current = b, block
+        self._next = b + 1
+
+        return block
+
+
+    def __getitem__(self, i):
+        b, start, stop = self.batches[i]
+        with self._lock:
+            x, y, w, order = self.block(b)
+
+            # Copies, the buffers are reused for the following blocks
+            index = order[start:stop]
+            return [xi[index] for xi in x], y[index], w[index]
+
+
+def tauid_sequences(sig, bkg, sig_stop, bkg_stop, inputs, test_size=0.2,
+                    reweighter=None, **kwargs):
+    """
+    Training and validation sequences of the first 'sig_stop' / 'bkg_stop'
+    events of the signal and background samples (labels 1 and 0) with
+    pt-reweighting (fitted on these events if no 'reweighter' is given). The
+    last 'test_size' fraction of each sample is used for validation. Keyword
+    arguments are passed to 'BatchSequence'.
+    """
+    sig_pt = sig["TauJets/pt"][:sig_stop]
+    bkg_pt = bkg["TauJets/pt"][:bkg_stop]
+    if reweighter is None:
+        reweighter = PtReweighter().fit(sig_pt, bkg_pt)
+    sig_weight, bkg_weight = reweighter.transform(sig_pt, bkg_pt)
+    del sig_pt, bkg_pt
+
+    sig_split = int((1.0 - test_size) * sig_stop)
+    bkg_split = int((1.0 - test_size) * bkg_stop)
+
+    train = BatchSequence([
+        Source(sig, 0, sig_split, constant_labels(1),
+               sig_weight[:sig_split]),
+        Source(bkg, 0, bkg_split, constant_labels(0), bkg_weight[:bkg_split])
+    ], inputs, **kwargs)
+
+    kwargs["shuffle"] = False
+    test = BatchSequence([
+        Source(sig, sig_split, sig_stop, constant_labels(1),
+               sig_weight[sig_split:]),
+        Source(bkg, bkg_split, bkg_stop, constant_labels(0),
+               bkg_weight[bkg_split:])
+    ], inputs, **kwargs)
+
+    return train, test
+
+
+def decaymodeclf_sequences(sig, sig_stop, inputs, n_classes, test_size=0.2,
+                           **kwargs):
+    """
+    Training and validation sequences of the first 'sig_stop' events with
+    one-hot encoded truth decay modes as labels. The last 'test_size'
+    fraction is used for validation.
+    """
+    labels = onehot_labels("TauJets/truthDecayMode", n_classes)
+    split = int((1.0 - test_size) * sig_stop)
+
+    train = BatchSequence([Source(sig, 0, split, labels, None)], inputs,
+                          **kwargs)
+
+    kwargs["shuffle"] = False
+    test = BatchSequence([Source(sig, split, sig_stop, labels, None)],
+                         inputs, **kwargs)
+
+    return train, test
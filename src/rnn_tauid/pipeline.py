@@ -0,0 +1,141 @@
+"""
+Producer / consumer pipeline preparing items in worker threads while the
+previous items are consumed (see 'Pipeline').
+"""
+import logging
+import threading
+import time
+from collections import namedtuple
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# Time the consumer waited for items in seconds
+WaitStats = namedtuple("WaitStats", ["items", "total", "mean", "max"])
+
+
+class Pipeline(object):
+    """
+    Prepares items with 'func(task, buffers)' in 'workers' threads into a ring
+    of preallocated buffers ('alloc()' returns the buffers of one slot).
+    Iterating 'run(tasks)' yields (task, buffers, result) in the order of the
+    tasks while up to 'depth' of the following items are prepared in the
+    background. The slot of an item is reused as soon as the next item is
+    requested, i.e. the buffers must not be used beyond the current
+    iteration. With depth=0 (or workers=0) the items are prepared in the
+    consuming thread.
+
+    h5py serialises all calls into the HDF5 library, therefore more than one
+    worker only helps if the transformations of the data dominate.
+    """
+    def __init__(self, func, alloc, depth=2, workers=1):
+        self.func = func
+        self.depth = depth
+        self.workers = workers if depth > 0 else 0
+
+        n_slots = depth + 1 if self.workers else 1
+        self.slots = [alloc() for _ in range(n_slots)]
+        self.waits = []
+
+
+    def stats(self):
+        """Statistics of the time the consumer waited for items"""
+        waits = np.array(self.waits)
+        if len(waits) == 0:
+            return WaitStats(0, 0.0, 0.0, 0.0)
+
+        return WaitStats(len(waits), waits.sum(), waits.mean(), waits.max())
+
+
+    def summary(self):
+        stats = self.stats()
+        return "Waited {:.2f} s for {} items (mean {:.1f} ms, max {:.1f} " \
+               "ms) with {} workers and queue depth {}".format(
+                   stats.total, stats.items, 1e3 * stats.mean,
+                   1e3 * stats.max, self.workers, self.depth)
+
+
+    def run(self, tasks):
+        """Generator of (task, buffers, func(task, buffers)) for all tasks"""
+        tasks = list(tasks)
+
+        if not self.workers:
+            buffers = self.slots[0]
+            for task in tasks:
+                start = time.time()
+                result = self.func(task, buffers)
+                self.waits.append(time.time() - start)
+                yield task, buffers, result
+            return
+
+        free = Queue()
+        for slot in range(len(self.slots)):
+            free.put(slot)
+
+        # Index of the next task, finished items by task index, first error
+        state = {"next": 0, "stop": False, "error": None}
+        done = {}
+        assign = threading.Lock()
+        finished = threading.Condition()
+
+        def work():
+            while True:
+                # Tasks and slots are assigned in order
+                with assign:
+                    if state["next"] >= len(tasks):
+                        return
+
+                    slot = None
+                    while slot is None:
+                        if state["stop"]:
+                            return
+                        try:
+                            slot = free.get(timeout=0.1)
+                        except Empty:
+                            pass
+
+                    i = state["next"]
+                    state["next"] += 1
+
+                try:
+                    result = self.func(tasks[i], self.slots[slot])
+                except Exception as err:
+                    with finished:
+                        state["error"] = err
+                        finished.notify_all()
+                    return
+
+                with finished:
+                    done[i] = slot, result
+                    finished.notify_all()
+
+        threads = [threading.Thread(target=work) for _ in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            for i, task in enumerate(tasks):
+                start = time.time()
+                with finished:
+                    while i not in done and state["error"] is None:
+                        finished.wait()
+
+                    if i not in done:
+                        raise state["error"]
+
+                    slot, result = done.pop(i)
+                self.waits.append(time.time() - start)
+
+                yield task, self.slots[slot], result
+                free.put(slot)
+        finally:
+            state["stop"] = True
+            for thread in threads:
+                thread.join()
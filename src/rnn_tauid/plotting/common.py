@@ -9,9 +9,7 @@ from scipy.stats import binned_statistic_2d
 from rnn_tauid.plotting.mpl_style import mpl_setup
 from rnn_tauid.plotting.base import Plot
 from rnn_tauid.plotting.utils import colors, colorseq, roc, roc_ratio, \
-    binned_efficiency_ci
-
-from rnn_tauid.preprocessing import pt_reweight
+    binned_efficiency_ci, pt_weights
 
 # For flattening
 from rnn_tauid.flattener import Flattener
@@ -41,14 +39,14 @@ class ScorePlot(Plot):
         if self.train:
             sig_train = sh.sig_train.get_variables("TauJets/pt", "score")
             bkg_train = sh.bkg_train.get_variables("TauJets/pt", "score")
-            sig_train_weight, bkg_train_weight = pt_reweight(
-                sig_train["TauJets/pt"], bkg_train["TauJets/pt"])
+            sig_train_weight, bkg_train_weight = pt_weights(sh.sig_train,
+                                                            sh.bkg_train)
 
         if self.test:
             sig_test = sh.sig_test.get_variables("TauJets/pt", "score")
             bkg_test = sh.bkg_test.get_variables("TauJets/pt", "score")
-            sig_test_weight, bkg_test_weight = pt_reweight(
-                sig_test["TauJets/pt"], bkg_test["TauJets/pt"])
+            sig_test_weight, bkg_test_weight = pt_weights(sh.sig_test,
+                                                          sh.bkg_test)
 
         # Plot
         fig, ax = plt.subplots()
@@ -103,8 +101,8 @@ class ROC(Plot):
     def plot(self, sh):
         sig_test = sh.sig_test.get_variables("TauJets/pt", *self.scores)
         bkg_test = sh.bkg_test.get_variables("TauJets/pt", *self.scores)
-        sig_test_weight, bkg_test_weight = pt_reweight(
-            sig_test["TauJets/pt"], bkg_test["TauJets/pt"])
+        sig_test_weight, bkg_test_weight = pt_weights(sh.sig_test,
+                                                      sh.bkg_test)
 
         y_true = np.concatenate([np.ones_like(sig_test_weight),
                                  np.zeros_like(bkg_test_weight)])
@@ -156,8 +154,8 @@ class ROCRatio(Plot):
     def plot(self, sh):
         sig_test = sh.sig_test.get_variables("TauJets/pt", *self.scores)
         bkg_test = sh.bkg_test.get_variables("TauJets/pt", *self.scores)
-        sig_test_weight, bkg_test_weight = pt_reweight(
-            sig_test["TauJets/pt"], bkg_test["TauJets/pt"])
+        sig_test_weight, bkg_test_weight = pt_weights(sh.sig_test,
+                                                      sh.bkg_test)
 
         y_true = np.concatenate([np.ones_like(sig_test_weight),
                                  np.zeros_like(bkg_test_weight)])
@@ -408,8 +406,8 @@ class RejectionPlot(Plot):
                                              self.xvar, *self.scores)
 
         # Kinematic reweighting
-        sig_test_weight, bkg_test_weight = pt_reweight(
-            sig_test["TauJets/pt"], bkg_test["TauJets/pt"])
+        sig_test_weight, bkg_test_weight = pt_weights(sh.sig_test,
+                                                      sh.bkg_test)
 
         # Check which events pass the working point for each score
         pass_thr = []
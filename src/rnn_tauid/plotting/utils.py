@@ -6,12 +6,25 @@ from scipy.interpolate import interp1d
 from scipy.stats import binned_statistic
 from sklearn.metrics import roc_curve
 
+from rnn_tauid.utils import open_sample
+from rnn_tauid.preprocessing import PtReweighter
+
 
 class Sample(object):
-    def __init__(self, *args):
+    def __init__(self, *args, **kwargs):
         self.files = args
         self.cache = {}
 
+        # Selection flag to read a subset of the events (see 'open_sample')
+        self.selection = kwargs.get("selection", None)
+
+        # pt-reweighting of this (background) sample stored by the training
+        # ('PtReweighter'), fitted per signal sample if None
+        self.reweighter = kwargs.get("reweighter", None)
+
+        # pt-weights of this (background) sample by signal sample
+        self.pt_weights = {}
+
 
     def get_variables(self, *args, **kwargs):
         store_cache = kwargs.get("cache", True)
@@ -34,13 +47,7 @@ class Sample(object):
 
         length = None
         for fn in self.files:
-            # Set driver to family if "%d" in filename
-            h5opt = {}
-            if "%d" in fn:
-                h5opt["driver"] = "family"
-                h5opt["memb_size"] = 8 * 1024**3
-
-            with h5py.File(fn, "r", **h5opt) as f:
+            with open_sample(fn, selection=self.selection) as f:
                 for var in variables:
                     if var in f:
                         # Check that variables have the same length
@@ -63,6 +70,26 @@ class Sample(object):
         return return_vars
 
 
+def pt_weights(sig, bkg):
+    """
+    Weights (signal, background) of the pt-reweighting of the background
+    sample to the signal sample. Uses the reweighting of the background
+    sample stored by the training if available, otherwise the reweighting is
+    fitted. Computed once per pair of samples.
+    """
+    if sig not in bkg.pt_weights:
+        sig_pt = sig.get_variables("TauJets/pt")["TauJets/pt"]
+        bkg_pt = bkg.get_variables("TauJets/pt")["TauJets/pt"]
+
+        reweighter = bkg.reweighter
+        if reweighter is None:
+            reweighter = PtReweighter().fit(sig_pt, bkg_pt)
+
+        bkg.pt_weights[sig] = reweighter.transform(sig_pt, bkg_pt)
+
+    return bkg.pt_weights[sig]
+
+
 SampleHolder = namedtuple("SampleHolder", ["sig_train", "sig_test",
                                            "bkg_train", "bkg_test"])
 
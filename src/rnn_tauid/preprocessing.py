@@ -1,21 +1,45 @@
+from collections import namedtuple
+from functools import partial
+
 import numpy as np
 import h5py
 
 
+# Statistics of the datasets stored by the conversion as attributes
+# 'stats_<field>' (see 'rnn_tauid.conversion.write_stats'). Statistics of
+# sequences are per object, i.e. have the object index as leading axis:
+# - count: Number of values which are not nan
+# - nan_fraction: Fraction of events with nan (or no object)
+# - sum, sumsq: Sum and sum of squares of the values
+# - min, max: Minimum and maximum of the finite values
+# - hist, hist_edges: Histogram of the finite values with equal bins between
+#   the minimum and maximum of all objects
+stats_fields = ["count", "nan_fraction", "sum", "sumsq", "min", "max", "hist",
+                "hist_edges"]
+
+Stats = namedtuple("Stats", stats_fields)
+
+# Packed containers store the statistics of all variables (stacked along a
+# leading variable axis) as datasets '<container>/_stats/<field>', as they
+# exceed the size limit of attributes (64 kB)
+stats_group = "_stats"
+
+
 def scale(arr, mean=True, std=True, per_obj=True):
     offset = np.zeros(arr.shape[1], dtype=np.float32)
     scale = np.ones(arr.shape[1], dtype=np.float32)
 
+    # Accumulate in double precision for float32 inputs
     if mean:
         if per_obj:
-            np.nanmean(arr, out=offset, axis=0)
+            offset[:] = np.nanmean(arr, axis=0, dtype=np.float64)
         else:
-            offset[:] = np.nanmean(arr)
+            offset[:] = np.nanmean(arr, dtype=np.float64)
     if std:
         if per_obj:
-            np.nanstd(arr, out=scale, axis=0)
+            scale[:] = np.nanstd(arr, axis=0, dtype=np.float64)
         else:
-            scale[:] = np.nanstd(arr)
+            scale[:] = np.nanstd(arr, dtype=np.float64)
 
     return offset, scale
 
@@ -25,9 +49,9 @@ def scale_flat(arr, mean=True, std=True):
     scale = np.float32(1)
 
     if mean:
-        offset = np.mean(arr)
+        offset = np.float32(np.mean(arr, dtype=np.float64))
     if std:
-        scale = np.std(arr)
+        scale = np.float32(np.std(arr, dtype=np.float64))
 
     return offset, scale
 
@@ -74,23 +98,585 @@ def constant_scale(arr, offset=0.0, scale=1.0):
     return offset, scale
 
 
-def pt_reweight(sig_pt, bkg_pt):
-    # Binning
-    bin_edges = np.percentile(bkg_pt, np.linspace(0.0, 100.0, 50))
-    bin_edges[0] = 20000.0  # 20 GeV lower limit
-    bin_edges[-1] = 10000000.0  # 10000 GeV upper limit
+def load_stats(datafile, name):
+    """
+    Loads the statistics of a variable (e.g. 'TauTracks/pt') from a converted
+    sample (h5py.File or 'rnn_tauid.utils.open_sample'). The statistics
+    describe the full sample.
+    """
+    f = getattr(datafile, "file", datafile)
+
+    if name in f:
+        attrs = f[name].attrs
+        index = Ellipsis
+    else:
+        # Packed containers store the statistics of all variables
+        container, _, var = name.rpartition("/")
+        attrs = f[container + "/packed"].attrs
+        variables = np.char.decode(attrs["variables"]).tolist()
+        index = variables.index(var)
+
+        group = container + "/" + stats_group
+        if group in f:
+            return Stats(*[f[group][field][index] for field in stats_fields])
+
+    if "stats_count" not in attrs:
+        raise KeyError("No statistics stored for " + name)
+
+    return Stats(*[np.asarray(attrs["stats_" + field])[index]
+                   for field in stats_fields])
+
+
+def _obj_stats(stats, num=None):
+    """
+    Per-object count, sum, sum of squares, minimum and maximum truncated or
+    padded (as objects without values) to 'num' objects
+    """
+    fields = [np.atleast_1d(np.asarray(arr, dtype=np.float64)) for arr in
+              (stats.count, stats.sum, stats.sumsq, stats.min, stats.max)]
+    if num is None or num == len(fields[0]):
+        return fields
+
+    pad = max(num - len(fields[0]), 0)
+    return [np.pad(arr[:num], (0, pad), mode="constant",
+                   constant_values=np.nan if i >= 3 else 0)
+            for i, arr in enumerate(fields)]
+
+
+def _moments(count, sum_, sumsq):
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = sum_ / count
+        std = np.sqrt(np.maximum(sumsq / count - mean**2, 0.0))
+
+    return mean, std
+
+
+def scale_from_stats(stats, mean=True, std=True, per_obj=True, num=None):
+    """'scale' from stored statistics for sequences of 'num' objects"""
+    count, sum_, sumsq, _, _ = _obj_stats(stats, num)
+    offset = np.zeros(len(count), dtype=np.float32)
+    if not per_obj:
+        count, sum_, sumsq = count.sum(), sum_.sum(), sumsq.sum()
+
+    m, s = _moments(count, sum_, sumsq)
+
+    scale = np.ones_like(offset)
+
+    if mean:
+        offset[:] = m
+    if std:
+        scale[:] = s
+
+    return offset, scale
+
+
+def scale_flat_from_stats(stats, mean=True, std=True):
+    """'scale_flat' from stored statistics"""
+    count, sum_, sumsq, _, _ = _obj_stats(stats)
+    m, s = _moments(count.sum(), sum_.sum(), sumsq.sum())
+
+    offset = np.float32(m) if mean else np.float32(0)
+    scale = np.float32(s) if std else np.float32(1)
+
+    return offset, scale
+
+
+def min_max_scale_from_stats(stats, per_obj=True, num=None):
+    """'min_max_scale' from stored statistics"""
+    _, _, _, min_, max_ = _obj_stats(stats, num)
+    if not per_obj:
+        with np.errstate(invalid="ignore"):
+            min_ = np.full_like(min_, np.nanmin(min_))
+            max_ = np.full_like(max_, np.nanmax(max_))
+
+    offset = min_.astype(np.float32)
+    scale = (max_ - min_).astype(np.float32)
+
+    return offset, scale
+
+
+def constant_scale_from_stats(stats, offset=0.0, scale=1.0, num=None):
+    """'constant_scale' with the number of objects of the statistics"""
+    num = num or len(np.atleast_1d(stats.count))
+    offset = np.full(num, fill_value=offset, dtype=np.float32)
+    scale = np.full(num, fill_value=scale, dtype=np.float32)
+
+    return offset, scale
+
+
+_from_stats = {
+    scale: scale_from_stats,
+    scale_flat: scale_flat_from_stats,
+    min_max_scale: min_max_scale_from_stats,
+    constant_scale: constant_scale_from_stats
+}
+
+
+def preprocessing_from_stats(func, stats, num=None):
+    """
+    Offset and scale of a preprocessing function (e.g.
+    'partial(scale, per_obj=False)' as in 'rnn_tauid.variables') derived
+    from stored statistics without reading the data. Only applicable to
+    variables read from the sample without transformation.
+    """
+    kwargs = {}
+    if isinstance(func, partial):
+        kwargs = dict(func.keywords or {})
+        func = func.func
+
+    if func not in _from_stats:
+        raise ValueError("Cannot derive {} from statistics".format(
+            getattr(func, "__name__", func)))
+
+    derive = _from_stats[func]
+    if derive is not scale_flat_from_stats:
+        kwargs["num"] = num
+
+    return derive(stats, **kwargs)
+
+
+class QuantileSketch(object):
+    """
+    Approximate quantiles of a stream of values in bounded memory (KLL sketch,
+    Karnin, Lang & Liberty 2016). The values are kept in levels of compactors
+    where an item of level h stands for 2^h values. A level exceeding its
+    capacity (k for the top level, shrinking by 2/3 per level below) is
+    sorted and every second item (random offset) is promoted to the next
+    level. The sketch holds O(k) items and the rank error is about 1/k of the
+    number of values independent of their number, e.g. below 1% for the
+    default k=256. Sketches filled with separate parts of the data (chunks,
+    worker processes, the sketches pickle) can be merged. Nan is ignored, the
+    minimum and maximum are exact.
+    """
+    def __init__(self, k=256, seed=1234567890):
+        self.k = k
+        self.n = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.levels = [np.empty(0, dtype=np.float64)]
+        self.random_state = np.random.RandomState(seed=seed)
+
+
+    def _capacity(self, h):
+        depth = len(self.levels) - 1 - h
+        return max(2, int(np.ceil(self.k * (2.0 / 3.0)**depth)))
+
+
+    def _compress(self):
+        h = 0
+        while h < len(self.levels):
+            level = self.levels[h]
+            if len(level) > self._capacity(h):
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.empty(0, dtype=np.float64))
+
+                # Pairs are replaced by one of their items of twice the weight
+                level = np.sort(level)
+                n_pairs = len(level) // 2
+                offset = self.random_state.randint(2)
+                promoted = level[offset:2 * n_pairs:2]
+
+                self.levels[h] = level[2 * n_pairs:]
+                self.levels[h + 1] = np.concatenate([self.levels[h + 1],
+                                                     promoted])
+            h += 1
+
+
+    def update(self, arr):
+        """Adds the (flattened) values of a chunk"""
+        arr = np.asarray(arr, dtype=np.float64).ravel()
+        arr = arr[~np.isnan(arr)]
+        if len(arr) == 0:
+            return self
+
+        self.n += len(arr)
+        self.min = min(self.min, arr.min())
+        self.max = max(self.max, arr.max())
+        self.levels[0] = np.concatenate([self.levels[0], arr])
+        self._compress()
+
+        return self
+
+
+    def merge(self, other):
+        """Adds the values of another sketch"""
+        if other.k != self.k:
+            raise ValueError("Cannot merge sketches with k={} and k={}".format(
+                self.k, other.k))
+
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0, dtype=np.float64))
+        for h, level in enumerate(other.levels):
+            self.levels[h] = np.concatenate([self.levels[h], level])
+
+        self.n += other.n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress()
+
+        return self
+
+
+    def quantile(self, q):
+        """
+        Approximate quantiles 'q' in [0, 1] (linearly interpolated between
+        the items). Nan if no values were added.
+        """
+        q = np.asarray(q, dtype=np.float64)
+        if self.n == 0:
+            return np.full(q.shape, np.nan)
+
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level), 2.0**h)
+                                  for h, level in enumerate(self.levels)])
+        order = np.argsort(values, kind="mergesort")
+        values = values[order]
+        weights = weights[order]
+
+        # Central rank (0 to n - 1) of the values an item stands for, exact
+        # (as 'np.nanpercentile') until the first compaction
+        total = weights.sum()
+        rank = np.cumsum(weights) - 0.5 * (weights + 1.0)
+        rank = np.concatenate([[0.0], rank, [total - 1.0]])
+        values = np.concatenate([[self.min], values, [self.max]])
+
+        return np.interp(q * (total - 1.0), rank, values)
+
+
+    def percentile(self, perc):
+        """Approximate percentiles 'perc' in [0, 100]"""
+        return self.quantile(np.asarray(perc, dtype=np.float64) / 100.0)
+
+
+class Moments(object):
+    """
+    Running count, mean and sum of squared deviations (Welford), minimum,
+    maximum and number of nan of the values of a variable (per object for
+    sequences, i.e. arrays of shape (events, objects)). Accumulators filled
+    with separate parts of the data can be merged (Chan et al.). With
+    'quantiles' a 'QuantileSketch' of the values of every object is filled as
+    well (list 'sketches', e.g. for 'robust_scale').
+    """
+    def __init__(self, shape=(), quantiles=False):
+        self.n_events = 0
+        self.count = np.zeros(shape, dtype=np.float64)
+        self.mean = np.zeros(shape, dtype=np.float64)
+        self.m2 = np.zeros(shape, dtype=np.float64)
+        self.min = np.full(shape, np.inf, dtype=np.float64)
+        self.max = np.full(shape, -np.inf, dtype=np.float64)
+        self.n_nan = np.zeros(shape, dtype=np.int64)
+
+        self.sketches = None
+        if quantiles:
+            self.sketches = [QuantileSketch()
+                             for _ in range(int(np.prod(shape)))]
+
+
+    def update(self, arr):
+        """Adds the values of a chunk of events"""
+        arr = np.asarray(arr)
+        part = Moments(arr.shape[1:])
+        if len(arr) == 0:
+            return self
+
+        valid = ~np.isnan(arr)
+        part.n_events = len(arr)
+        part.count[...] = np.count_nonzero(valid, axis=0)
+        part.n_nan[...] = len(arr) - part.count
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.nansum(arr, axis=0, dtype=np.float64) / part.count
+        part.mean[...] = np.where(part.count > 0, mean, 0.0)
+        part.m2[...] = np.nansum((arr - part.mean)**2, axis=0,
+                                 dtype=np.float64)
+        part.min[...] = np.where(valid, arr, np.inf).min(axis=0)
+        part.max[...] = np.where(valid, arr, -np.inf).max(axis=0)
+
+        if self.sketches is not None:
+            columns = arr.reshape(len(arr), -1)
+            for i, sketch in enumerate(self.sketches):
+                sketch.update(columns[:, i])
+
+        return self.merge(part)
+
+
+    def merge(self, other):
+        """Adds the values of another accumulator"""
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        with np.errstate(invalid="ignore", divide="ignore"):
+            frac = np.where(count > 0, other.count / count, 0.0)
+
+        self.mean = self.mean + delta * frac
+        self.m2 = self.m2 + other.m2 + delta**2 * self.count * frac
+        self.count = count
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        self.n_nan = self.n_nan + other.n_nan
+        self.n_events += other.n_events
+
+        if self.sketches is not None and other.sketches is not None:
+            for sketch, other_sketch in zip(self.sketches, other.sketches):
+                sketch.merge(other_sketch)
+
+        return self
+
+
+    def total(self):
+        """Accumulator of the values of all objects"""
+        total = Moments(quantiles=self.sketches is not None)
+        total.n_events = self.n_events
+        total.count[...] = self.count.sum()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = (self.count * self.mean).sum() / total.count
+        total.mean[...] = mean if total.count > 0 else 0.0
+        total.m2[...] = (self.m2 + self.count * (self.mean - mean)**2).sum()
+        total.min[...] = self.min.min()
+        total.max[...] = self.max.max()
+        total.n_nan[...] = self.n_nan.sum()
+
+        if self.sketches is not None:
+            for sketch in self.sketches:
+                total.sketches[0].merge(sketch)
+
+        return total
+
+
+    @property
+    def std(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.sqrt(self.m2 / self.count)
+
+
+def _num_obj(moments):
+    return moments.count.shape[0]
+
+
+def scale_from_moments(moments, mean=True, std=True, per_obj=True):
+    """'scale' from accumulated moments"""
+    offset = np.zeros(_num_obj(moments), dtype=np.float32)
+    scale = np.ones(_num_obj(moments), dtype=np.float32)
+    if not per_obj:
+        moments = moments.total()
+
+    # Objects without values give nan (as 'np.nanmean')
+    if mean:
+        offset[:] = np.where(moments.count > 0, moments.mean, np.nan)
+    if std:
+        scale[:] = moments.std
+
+    return offset, scale
+
+
+def scale_flat_from_moments(moments, mean=True, std=True):
+    """'scale_flat' from accumulated moments (ignoring nan)"""
+    moments = moments.total()
+
+    offset = np.float32(moments.mean) if mean else np.float32(0)
+    scale = np.float32(moments.std) if std else np.float32(1)
+
+    return offset, scale
+
+
+def robust_scale_from_moments(moments, median=True, interquartile=True,
+                              low_perc=25.0, high_perc=75.0):
+    """'robust_scale' from the quantile sketches of the moments"""
+    if moments.sketches is None:
+        raise ValueError("robust_scale requires moments with quantiles")
+
+    offset = np.zeros(_num_obj(moments), dtype=np.float32)
+    scale = np.ones(_num_obj(moments), dtype=np.float32)
 
-    # Reweighting coefficient
-    sig_hist, _ = np.histogram(sig_pt, bins=bin_edges, density=True)
-    bkg_hist, _ = np.histogram(bkg_pt, bins=bin_edges, density=True)
+    if median:
+        offset[:] = [sketch.quantile(0.5) for sketch in moments.sketches]
+    if interquartile:
+        assert high_perc > low_perc
+        perc = np.array([sketch.percentile([high_perc, low_perc])
+                         for sketch in moments.sketches])
+        scale[:] = perc[:, 0] - perc[:, 1]
+
+    return offset, scale
+
+
+def max_scale_from_moments(moments):
+    """'max_scale' from accumulated moments"""
+    offset = np.zeros(_num_obj(moments), dtype=np.float32)
+    scale = moments.max.astype(np.float32)
+
+    return offset, scale
+
+
+def min_max_scale_from_moments(moments, per_obj=True):
+    """'min_max_scale' from accumulated moments"""
+    if per_obj:
+        offset = moments.min.astype(np.float32)
+        scale = moments.max.astype(np.float32) - offset
+    else:
+        offset = np.float32(moments.min.min())
+        scale = np.float32(moments.max.max()) - offset
+        offset = np.full(_num_obj(moments), fill_value=offset,
+                         dtype=np.float32)
+        scale = np.full(_num_obj(moments), fill_value=scale,
+                        dtype=np.float32)
+
+    return offset, scale
+
+
+def constant_scale_from_moments(moments, offset=0.0, scale=1.0):
+    """'constant_scale' with the number of objects of the moments"""
+    offset = np.full(_num_obj(moments), fill_value=offset, dtype=np.float32)
+    scale = np.full(_num_obj(moments), fill_value=scale, dtype=np.float32)
+
+    return offset, scale
+
+
+_from_moments = {
+    scale: scale_from_moments,
+    scale_flat: scale_flat_from_moments,
+    robust_scale: robust_scale_from_moments,
+    max_scale: max_scale_from_moments,
+    min_max_scale: min_max_scale_from_moments,
+    constant_scale: constant_scale_from_moments
+}
+
+
+def needs_quantiles(func):
+    """Whether the preprocessing function requires 'Moments' with quantiles"""
+    if isinstance(func, partial):
+        func = func.func
+
+    return func is robust_scale
+
+
+def preprocessing_from_moments(func, moments):
+    """
+    Offset and scale of a preprocessing function (as returned when calling it
+    on the data) derived from the moments accumulated over the data. Without
+    a function, the offset and scale are zero and one (as in 'preprocess').
+    """
+    if not func:
+        num = _num_obj(moments)
+        return (np.zeros((num,), dtype=np.float32),
+                np.ones((num,), dtype=np.float32))
+
+    kwargs = {}
+    if isinstance(func, partial):
+        kwargs = dict(func.keywords or {})
+        func = func.func
+
+    if func not in _from_moments:
+        raise ValueError("Cannot derive {} from moments".format(
+            getattr(func, "__name__", func)))
 
-    coeff = sig_hist / bkg_hist
+    return _from_moments[func](moments, **kwargs)
 
-    # Apply reweighting
-    sig_weight = np.ones_like(sig_pt)
-    bkg_weight = coeff[np.digitize(bkg_pt, bin_edges) - 1].astype(np.float32)
 
-    return sig_weight, bkg_weight
+class PtReweighter(object):
+    """
+    Reweights the pt-spectrum of the background to the signal. The pt-bins
+    are the percentiles of the background pt (between 20 and 10000 GeV), the
+    weights of the background are the ratio of the normalised signal and
+    background histograms and the signal has unit weights. The histograms can
+    be filled in chunks with 'update' after the binning is set, which can be
+    taken from a 'QuantileSketch' of the background pt filled in chunks.
+    """
+    def __init__(self, bin_edges=None, n_bins=49):
+        self.n_bins = n_bins
+        self.bin_edges = None
+        if bin_edges is not None:
+            self.set_binning(bin_edges=bin_edges)
+
+
+    def set_binning(self, bkg_pt=None, bin_edges=None):
+        """
+        Sets the binning from the background pt (array or 'QuantileSketch')
+        or explicit edges
+        """
+        if bin_edges is None:
+            perc = np.linspace(0.0, 100.0, self.n_bins + 1)
+            if isinstance(bkg_pt, QuantileSketch):
+                bin_edges = bkg_pt.percentile(perc)
+            else:
+                bin_edges = np.percentile(bkg_pt, perc)
+            bin_edges[0] = 20000.0  # 20 GeV lower limit
+            bin_edges[-1] = 10000000.0  # 10000 GeV upper limit
+
+        self.bin_edges = np.asarray(bin_edges, dtype=np.float64)
+        self.n_bins = len(self.bin_edges) - 1
+        self.sig_counts = np.zeros(self.n_bins, dtype=np.float64)
+        self.bkg_counts = np.zeros(self.n_bins, dtype=np.float64)
+
+        return self
+
+
+    def bin_index(self, pt):
+        """Bin index of every pt (clipped to the first / last bin)"""
+        index = np.searchsorted(self.bin_edges, pt, side="right") - 1
+        return np.clip(index, 0, self.n_bins - 1)
+
+
+    def _counts(self, pt):
+        pt = np.asarray(pt)
+        inside = (pt >= self.bin_edges[0]) & (pt <= self.bin_edges[-1])
+        return np.bincount(self.bin_index(pt[inside]), minlength=self.n_bins)
+
+
+    def update(self, sig_pt=None, bkg_pt=None):
+        """Fills the histograms with a chunk of signal / background pt"""
+        if sig_pt is not None:
+            self.sig_counts += self._counts(sig_pt)
+        if bkg_pt is not None:
+            self.bkg_counts += self._counts(bkg_pt)
+
+        return self
+
+
+    def fit(self, sig_pt, bkg_pt):
+        return self.set_binning(bkg_pt).update(sig_pt, bkg_pt)
+
+
+    @property
+    def coeff(self):
+        """Weight of the background in every bin"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return (self.sig_counts / self.sig_counts.sum()) / \
+                   (self.bkg_counts / self.bkg_counts.sum())
+
+
+    def weights(self, bkg_pt):
+        """Weights of background events"""
+        return self.coeff[self.bin_index(bkg_pt)].astype(np.float32)
+
+
+    def transform(self, sig_pt, bkg_pt):
+        """Weights of signal and background events"""
+        return np.ones(len(sig_pt), dtype=np.float32), self.weights(bkg_pt)
+
+
+    def save(self, filename, group="pt_reweight"):
+        """Stores the reweighting in 'group' of the file (appends)"""
+        with h5py.File(filename, "a") as f:
+            if group in f:
+                del f[group]
+            g = f.create_group(group)
+            g["bin_edges"] = self.bin_edges
+            g["sig_counts"] = self.sig_counts
+            g["bkg_counts"] = self.bkg_counts
+
+
+    @classmethod
+    def load(cls, filename, group="pt_reweight"):
+        with h5py.File(filename, "r") as f:
+            g = f[group]
+            reweighter = cls(bin_edges=g["bin_edges"][...])
+            reweighter.sig_counts[:] = g["sig_counts"][...]
+            reweighter.bkg_counts[:] = g["bkg_counts"][...]
+
+        return reweighter
+
+
+def pt_reweight(sig_pt, bkg_pt):
+    return PtReweighter().fit(sig_pt, bkg_pt).transform(sig_pt, bkg_pt)
 
 
 def preprocess(train, test, funcs):
@@ -1,21 +1,715 @@
 import imp
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
+import h5py
 from collections import namedtuple
-from rnn_tauid.preprocessing import pt_reweight
-from sklearn.preprocessing import OneHotEncoder
+from rnn_tauid.preprocessing import PtReweighter, Moments, \
+    preprocessing_from_moments, needs_quantiles
 
 
 Data = namedtuple("Data", ["x", "y", "w"])
 
+# Default dtypes of the training inputs / weights and of the class labels
+# (keras casts to float32 anyway)
+float_dtype = np.float32
+label_dtype = np.uint8
 
-def load_data(sig, bkg, sig_slice, bkg_slice, invars, num=None):
-    # pt-reweighting
+
+def h5file_kwargs(filename):
+    """Uses the family driver if the filename contains a running index"""
+    if "%d" in filename:
+        return dict(driver="family", memb_size=8*1024**3)
+    else:
+        return dict()
+
+
+def _sel_key(sel):
+    """Hashable key for a selection (slices are not hashable)"""
+    if not isinstance(sel, tuple):
+        sel = (sel,)
+
+    key = []
+    for s in sel:
+        if isinstance(s, slice):
+            key.append((s.start, s.stop, s.step))
+        elif isinstance(s, np.ndarray):
+            key.append((s.shape, s.tobytes()))
+        else:
+            key.append(s)
+
+    return tuple(key)
+
+
+class PackedColumn(object):
+    """
+    Single variable of a packed container. Provides the parts of the
+    h5py.Dataset interface used by the loaders and variable definitions
+    (read_direct, slicing, len, shape).
+    """
+    def __init__(self, sample, container, index):
+        self.sample = sample
+        self.container = container
+        self.index = index
+        self.packed = sample.file[container + "/packed"]
+
+
+    @property
+    def shape(self):
+        return self.packed.shape[:-1]
+
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+
+    @property
+    def dtype(self):
+        return self.packed.dtype
+
+
+    def __len__(self):
+        return self.packed.shape[0]
+
+
+    def __getitem__(self, sel):
+        slab = self.sample.read_packed(self.container, sel)
+        return np.array(slab[..., self.index])
+
+
+    def read_direct(self, dest, source_sel=None, dest_sel=None):
+        slab = self.sample.read_packed(self.container, source_sel)
+        if dest_sel is None:
+            dest[...] = slab[..., self.index]
+        else:
+            dest[dest_sel] = slab[..., self.index]
+
+
+class DecodedColumn(object):
+    """
+    Dataset stored with a compact type (see 'rnn_tauid.conversion.encode').
+    Values are read as float32 with nan restored from the attribute
+    'nan_value' of integer datasets.
+    """
+    def __init__(self, dset):
+        self.dset = dset
+        self.nan_value = dset.attrs.get("nan_value")
+
+
+    @property
+    def shape(self):
+        return self.dset.shape
+
+
+    @property
+    def ndim(self):
+        return self.dset.ndim
+
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32)
+
+
+    def __len__(self):
+        return len(self.dset)
+
+
+    def __getitem__(self, sel):
+        raw = self.dset[sel]
+        out = raw.astype(np.float32)
+        if self.nan_value is not None:
+            out[raw == self.nan_value] = np.nan
+
+        return out
+
+
+    def read_direct(self, dest, source_sel=None, dest_sel=None):
+        if self.nan_value is None:
+            # Type conversion by HDF5
+            self.dset.read_direct(dest, source_sel=source_sel,
+                                  dest_sel=dest_sel)
+        elif dest_sel is None:
+            dest[...] = self[source_sel if source_sel is not None
+                             else Ellipsis]
+        else:
+            dest[dest_sel] = self[source_sel if source_sel is not None
+                                  else Ellipsis]
+
+
+def decoded(dset):
+    """Wraps datasets stored with compact types in a 'DecodedColumn'"""
+    if isinstance(dset, h5py.Dataset) and \
+       ("nan_value" in dset.attrs or dset.dtype == np.float16):
+        return DecodedColumn(dset)
+    else:
+        return dset
+
+
+class RaggedColumn(object):
+    """
+    Single variable of a ragged container. Events are padded with nan on read
+    to the number of objects requested by the selection (e.g.
+    'np.s_[start:stop, :num]'), which may exceed the length used at
+    conversion. Without an object selection events are padded to the maximum
+    length of the conversion.
+    """
+    def __init__(self, sample, container, name):
+        self.sample = sample
+        self.container = container
+        self.values = decoded(sample.file[name])
+        self.max_len = int(sample.file[container].attrs["max_len"])
+
+
+    @property
+    def shape(self):
+        return (len(self), self.max_len)
+
+
+    @property
+    def ndim(self):
+        return 2
+
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+
+    def __len__(self):
+        return len(self.sample.offsets(self.container)) - 1
+
+
+    def _split_sel(self, sel):
+        """Splits a selection into event and object selection"""
+        if sel is None:
+            sel = ()
+        elif not isinstance(sel, tuple):
+            sel = (sel,)
+
+        sel = tuple(s for s in sel if s is not Ellipsis)
+        if len(sel) > 2:
+            raise IndexError("Too many indices for ragged column")
+
+        rows = sel[0] if len(sel) > 0 else slice(None)
+        cols = sel[1] if len(sel) > 1 else slice(None)
+
+        return rows, cols
+
+
+    def __getitem__(self, sel):
+        rows, cols = self._split_sel(sel)
+        offsets = self.sample.offsets(self.container)
+
+        if isinstance(rows, slice):
+            start, stop, step = rows.indices(len(offsets) - 1)
+            if step != 1:
+                raise IndexError("Ragged columns only support contiguous "
+                                 "event slices")
+
+            stop = max(start, stop)
+            begin = offsets[start:stop]
+            end = offsets[start + 1:stop + 1]
+        else:
+            rows = np.asarray(rows)
+            begin = offsets[:-1][rows]
+            end = offsets[1:][rows]
+
+        # Number of objects to pad to
+        if isinstance(cols, slice) and cols.stop is not None \
+           and cols.stop >= 0:
+            width = cols.stop
+        else:
+            width = self.max_len
+
+        out = np.full((len(begin), width), np.nan, dtype=self.dtype)
+        if len(begin) > 0:
+            # Single contiguous read spanning all selected events
+            lo, hi = begin.min(), end.max()
+            values = self.values[lo:hi] if hi > lo else \
+                np.empty(0, dtype=self.dtype)
+
+            pos = np.arange(width)
+            valid = pos < (end - begin)[..., np.newaxis]
+            index = (begin - lo)[..., np.newaxis] + pos
+            out[valid] = values[index[valid]]
+
+        return out[:, cols]
+
+
+    def read_direct(self, dest, source_sel=None, dest_sel=None):
+        if dest_sel is None:
+            dest[...] = self[source_sel]
+        else:
+            dest[dest_sel] = self[source_sel]
+
+
+class SampleFile(object):
+    """
+    Wrapper around an open sample that provides the variables of packed and
+    ragged containers (see 'rnn_tauid.conversion') under the same names and
+    shapes as in dense samples (e.g. 'TauTracks/pt'). The packed tensor of a
+    container is read with a single contiguous read per selection and cached
+    for the following variables of the same selection. Ragged sequences are
+    padded on read. Variables stored with compact types are read as float32.
+    Everything else is forwarded to the h5py.File.
+    """
+    def __init__(self, h5file):
+        self.file = h5file
+
+        # Variable indices of packed containers and ragged containers
+        self.packed = {}
+        self.ragged = set()
+        for name, node in h5file.items():
+            if not isinstance(node, h5py.Group):
+                continue
+
+            if "packed" in node:
+                variables = node["packed"].attrs["variables"]
+                variables = np.char.decode(variables).tolist()
+                self.packed[name] = {v: i for i, v in enumerate(variables)}
+            elif node.attrs.get("storage") == "ragged":
+                self.ragged.add(name)
+
+        # Last read of every packed container and offsets of ragged containers
+        self._slabs = {}
+        self._offsets = {}
+
+
+    def offsets(self, container):
+        """Offsets of the events of a ragged container (cached)"""
+        if container not in self._offsets:
+            self._offsets[container] = \
+                self.file[container + "/_offsets"][...]
+
+        return self._offsets[container]
+
+
+    def read_packed(self, container, sel):
+        """Reads the packed tensor of a container (cached per selection)"""
+        if sel is None:
+            sel = Ellipsis
+
+        key = _sel_key(sel)
+        cached = self._slabs.get(container)
+        if cached is None or cached[0] != key:
+            cached = (key, self.file[container + "/packed"][sel])
+            self._slabs[container] = cached
+
+        return cached[1]
+
+
+    def clear_cache(self):
+        self._slabs.clear()
+        self._offsets.clear()
+
+
+    def _split(self, name):
+        container, _, var = name.rpartition("/")
+        if container in self.packed and var in self.packed[container]:
+            return container, self.packed[container][var]
+        else:
+            return None, None
+
+
+    def __getitem__(self, name):
+        container, index = self._split(name)
+        if container:
+            return PackedColumn(self, container, index)
+
+        group, _, var = name.rpartition("/")
+        if group in self.ragged and not var.startswith("_"):
+            return RaggedColumn(self, group, name)
+
+        return decoded(self.file[name])
+
+
+    def __contains__(self, name):
+        container, _ = self._split(name)
+        return container is not None or name in self.file
+
+
+    def __getattr__(self, attr):
+        return getattr(self.file, attr)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def close(self):
+        self.clear_cache()
+        self.file.close()
+
+
+class SubsetColumn(object):
+    """
+    Column of a 'SubsetSample'. Selections refer to the events of the subset
+    and are mapped to the underlying column through the event index. The
+    selected events are read in windows of at most 'span_rows' events of the
+    underlying column (one contiguous read per window), such that only the
+    result and a single window are held in memory.
+    """
+    # Maximum number of events of the underlying column read at once
+    span_rows = 65536
+
+    def __init__(self, column, index):
+        self.column = column
+        self.index = index
+
+
+    @property
+    def shape(self):
+        return (len(self.index),) + tuple(self.column.shape[1:])
+
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+
+    @property
+    def dtype(self):
+        return self.column.dtype
+
+
+    def __len__(self):
+        return len(self.index)
+
+
+    def _split(self, sel):
+        """Events of the underlying column and selection of the other axes"""
+        if not isinstance(sel, tuple):
+            sel = (sel,)
+
+        if len(sel) > 0 and sel[0] is not Ellipsis:
+            return self.index[sel[0]], tuple(sel[1:])
+        else:
+            return self.index, tuple(sel)
+
+
+    def __getitem__(self, sel):
+        idx, rest = self._split(sel)
+        if np.ndim(idx) == 0:
+            return self._read(np.atleast_1d(idx), rest)[0]
+
+        return self._read(np.asarray(idx), rest)
+
+
+    def _read(self, idx, rest, out=None):
+        """Events 'idx' of the underlying column (into 'out' if given)"""
+        # Windows are formed on the sorted events
+        order = None
+        if np.any(idx[1:] < idx[:-1]):
+            order = np.argsort(idx, kind="mergesort")
+            idx = idx[order]
+
+        if len(idx) == 0:
+            window = self.column[(slice(0, 0),) + rest]
+            return window if out is None else out
+
+        start = 0
+        while start < len(idx):
+            lo = idx[start]
+            stop = np.searchsorted(idx, lo + self.span_rows)
+            hi = idx[stop - 1] + 1
+
+            window = self.column[(slice(lo, hi),) + rest]
+            if out is None:
+                out = np.empty((len(idx),) + window.shape[1:],
+                               dtype=window.dtype)
+
+            # Contiguous events are used without copying the window
+            if hi - lo != stop - start or \
+               np.any(np.diff(idx[start:stop]) != 1):
+                window = window[idx[start:stop] - lo]
+
+            if order is None:
+                out[start:stop] = window
+            else:
+                out[order[start:stop]] = window
+
+            start = stop
+
+        return out
+
+
+    def read_direct(self, dest, source_sel=None, dest_sel=None):
+        if source_sel is None:
+            source_sel = Ellipsis
+        if dest_sel is None:
+            dest_sel = Ellipsis
+
+        target = dest[dest_sel]
+        if not np.may_share_memory(target, dest):
+            # Copy for advanced indexing of the destination
+            dest[dest_sel] = self[source_sel]
+            return
+
+        idx, rest = self._split(source_sel)
+        self._read(np.atleast_1d(idx), rest, out=target)
+
+
+class SubsetSample(object):
+    """
+    View of the events of a sample given by an (increasing) event index, e.g.
+    the events passing a selection flag (see 'selection_index'). Provides the
+    same interface as 'SampleFile' without copying the data.
+    """
+    def __init__(self, sample, index):
+        self.sample = sample
+        self.index = index
+
+
+    def __getitem__(self, name):
+        return SubsetColumn(self.sample[name], self.index)
+
+
+    def __contains__(self, name):
+        return name in self.sample
+
+
+    def __getattr__(self, attr):
+        return getattr(self.sample, attr)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def close(self):
+        self.sample.close()
+
+
+def selection_index(datafile, selection):
+    """
+    Indices of the events passing a selection stored as flag in
+    'TauJets/selection' (see 'ntuple2hdf.py --flags')
+    """
+    dset = datafile["TauJets/selection"]
+    flags = np.char.decode(dset.attrs["flags"]).tolist()
+    if selection not in flags:
+        raise KeyError("Selection '{}' not stored in sample (available: "
+                       "{})".format(selection, ", ".join(flags)))
+
+    bit = flags.index(selection)
+    return np.flatnonzero(dset[...] & (1 << bit))
+
+
+def open_sample(filename, mode="r", cache_chunks=4, selection=None):
+    """
+    Opens a converted sample. If the chunk layout is recorded in the file
+    attributes (see 'rnn_tauid.conversion.write_layout_attrs'), the chunk cache
+    of every dataset is sized to hold 'cache_chunks' chunks, such that chunks
+    spanning the boundaries of consecutive reads are only decompressed once.
+
+    Returns a 'SampleFile' to transparently read packed containers. If
+    'selection' is given and the sample stores selection flags, a
+    'SubsetSample' of the events passing the selection is returned. Samples
+    without flags (e.g. decorated scores) are assumed to hold the selected
+    events only.
+    """
+    kwargs = h5file_kwargs(filename)
+
+    with h5py.File(filename, "r", **kwargs) as f:
+        chunk_bytes = f.attrs.get("chunk_bytes")
+
+    if chunk_bytes:
+        kwargs["rdcc_nbytes"] = int(cache_chunks * chunk_bytes)
+
+    sample = SampleFile(h5py.File(filename, mode, **kwargs))
+
+    if selection and "TauJets/selection" in sample:
+        return SubsetSample(sample, selection_index(sample, selection))
+
+    return sample
+
+
+def chunk_rows(datafile):
+    """Number of events per chunk if chunked in blocks of events"""
+    if datafile.attrs.get("layout") == "rows":
+        return int(datafile.attrs["chunk_rows"])
+    else:
+        return None
+
+
+def aligned_chunksize(datafile, chunksize):
+    """Rounds 'chunksize' up to a multiple of the events per chunk"""
+    rows = chunk_rows(datafile)
+    if rows:
+        return -(-chunksize // rows) * rows
+    else:
+        return chunksize
+
+
+class PlannedColumn(object):
+    """
+    Column of a 'PlannedReader'. Reads are served from the reader's cache if
+    the dataset has further consumers in the plan.
+    """
+    def __init__(self, reader, name):
+        self.reader = reader
+        self.name = name
+        self.column = reader.datafile[name]
+
+
+    @property
+    def shape(self):
+        return self.column.shape
+
+
+    @property
+    def dtype(self):
+        return self.column.dtype
+
+
+    def __len__(self):
+        return len(self.column)
+
+
+    def __getitem__(self, sel):
+        return self.reader.read(self.name, self.column, sel)
+
+
+    def read_direct(self, dest, source_sel=None, dest_sel=None):
+        self.reader.read(self.name, self.column, source_sel, dest=dest,
+                         dest_sel=dest_sel)
+
+
+class PlannedReader(object):
+    """
+    Wrapper around a sample passed to the variable functions instead of the
+    sample for one selection of events (see 'ReadPlan'). Datasets read by
+    several variables are read once and kept until their last read in the
+    plan, datasets read once are read directly. With 'uses' set to None
+    (tracing) every read is counted in 'reads'.
+    """
+    def __init__(self, datafile, uses=None):
+        self.datafile = datafile
+        self.uses = uses
+        self.reads = []
+        self.remaining = dict(uses or {})
+        self.cache = {}
+
+
+    def read(self, name, column, sel, dest=None, dest_sel=None):
+        if sel is None:
+            sel = Ellipsis
+
+        if self.uses is None:
+            self.reads.append(name)
+
+        if self.uses and self.uses.get(name, 0) > 1:
+            key = _sel_key(sel)
+            if (name, key) not in self.cache:
+                self.cache[name, key] = column[sel]
+            arr = self.cache[name, key]
+
+            self.remaining[name] -= 1
+            if self.remaining[name] <= 0:
+                for k in [k for k in self.cache if k[0] == name]:
+                    del self.cache[k]
+
+            if dest is None:
+                # Copy since the caller may modify the array in place
+                return np.array(arr)
+
+            dest[Ellipsis if dest_sel is None else dest_sel] = arr
+        elif dest is None:
+            return column[sel]
+        else:
+            column.read_direct(dest, source_sel=sel, dest_sel=dest_sel)
+
+
+    def __getitem__(self, name):
+        return PlannedColumn(self, name)
+
+
+    def __contains__(self, name):
+        return name in self.datafile
+
+
+    def __getattr__(self, attr):
+        return getattr(self.datafile, attr)
+
+
+class ReadPlan(object):
+    """
+    Plan of the datasets read by variable definitions (as in
+    'rnn_tauid.variables'). 'groups' are (variables, num) pairs of variables
+    read into arrays with 'num' objects (None for scalar variables). The
+    reads of the variable functions are traced once on the first event. For
+    every selection of events a 'reader()' is passed to the variable
+    functions in place of the sample, such that every source dataset is read
+    once per selection and shared among the variables.
+    """
+    def __init__(self, datafile, *groups):
+        self.datafile = datafile
+        self.uses = {}
+
+        for variables, num in groups:
+            for var in variables:
+                for name in self.sources(var, num):
+                    self.uses[name] = self.uses.get(name, 0) + 1
+
+
+    def sources(self, var, num=None):
+        """Names of the datasets read by a variable (in order of reads)"""
+        varname, func = var[:2]
+        if not func:
+            return [varname]
+
+        tracer = PlannedReader(self.datafile)
+        n = min(1, len(self.datafile["TauJets/pt"]))
+        if num:
+            scratch = np.empty((n, num, 1), dtype=np.float32)
+            source_sel = np.s_[:n, :num]
+        else:
+            scratch = np.empty((n, 1), dtype=np.float32)
+            source_sel = np.s_[:n]
+
+        with np.errstate(all="ignore"):
+            func(tracer, scratch, source_sel=source_sel,
+                 dest_sel=np.s_[:n, ..., 0])
+
+        return tracer.reads
+
+
+    def shared(self):
+        """Datasets read by more than one variable"""
+        return sorted(name for name, n in self.uses.items() if n > 1)
+
+
+    def reader(self, datafile=None):
+        """
+        Reader for one selection of events of the traced sample or another
+        sample with the same datasets (e.g. signal and background)
+        """
+        if datafile is None:
+            datafile = self.datafile
+
+        return PlannedReader(datafile, uses=self.uses)
+
+
+def load_data(sig, bkg, sig_slice, bkg_slice, invars, num=None,
+              dtype=float_dtype, reweighter=None):
+    # pt-reweighting (fitted on the loaded events if no reweighter is given)
     sig_pt = sig["TauJets/pt"][sig_slice]
     bkg_pt = bkg["TauJets/pt"][bkg_slice]
 
-    sig_weight, bkg_weight = pt_reweight(sig_pt, bkg_pt)
-    w = np.concatenate([sig_weight, bkg_weight])
+    if reweighter is None:
+        reweighter = PtReweighter().fit(sig_pt, bkg_pt)
+    sig_weight, bkg_weight = reweighter.transform(sig_pt, bkg_pt)
+    w = np.concatenate([sig_weight, bkg_weight]).astype(dtype, copy=False)
 
     sig_len = len(sig_pt)
     bkg_len = len(bkg_pt)
@@ -24,7 +718,7 @@ def load_data(sig, bkg, sig_slice, bkg_slice, invars, num=None):
     del sig_weight, bkg_weight
 
     # Class labels
-    y = np.ones(sig_len + bkg_len, dtype=np.float32)
+    y = np.ones(sig_len + bkg_len, dtype=label_dtype)
     y[sig_len:] = 0
 
     # Load variables
@@ -32,63 +726,169 @@ def load_data(sig, bkg, sig_slice, bkg_slice, invars, num=None):
 
     # If number of timesteps given
     if num:
-        x = np.empty((sig_len + bkg_len, num, n_vars))
+        x = np.empty((sig_len + bkg_len, num, n_vars), dtype=dtype)
 
         sig_src = np.s_[sig_slice, :num]
         bkg_src = np.s_[bkg_slice, :num]
     else:
-        x = np.empty((sig_len + bkg_len, n_vars))
+        x = np.empty((sig_len + bkg_len, n_vars), dtype=dtype)
 
         sig_src = np.s_[sig_slice]
         bkg_src = np.s_[bkg_slice]
 
+    # Datasets shared by several variables are read once
+    plan = ReadPlan(sig, (invars, num))
+    sig_reader = plan.reader(sig)
+    bkg_reader = plan.reader(bkg)
+
     for i, (varname, func, _) in enumerate(invars):
         sig_dest = np.s_[:sig_len, ..., i]
         bkg_dest = np.s_[sig_len:, ..., i]
 
         if func:
-            func(sig, x, source_sel=sig_src, dest_sel=sig_dest)
-            func(bkg, x, source_sel=bkg_src, dest_sel=bkg_dest)
+            func(sig_reader, x, source_sel=sig_src, dest_sel=sig_dest)
+            func(bkg_reader, x, source_sel=bkg_src, dest_sel=bkg_dest)
         else:
-            sig[varname].read_direct(x, source_sel=sig_src, dest_sel=sig_dest)
-            bkg[varname].read_direct(x, source_sel=bkg_src, dest_sel=bkg_dest)
+            sig_reader[varname].read_direct(x, source_sel=sig_src,
+                                            dest_sel=sig_dest)
+            bkg_reader[varname].read_direct(x, source_sel=bkg_src,
+                                            dest_sel=bkg_dest)
 
     return Data(x=x, y=y, w=w)
 
 
-def load_data_decaymodeclf(sig, sig_slice, invars, num=None):
+def onehot_encode(values, n_classes, name="labels"):
+    """
+    One-hot encodes class indices 0 to n_classes - 1 (e.g. truth decay modes).
+    Raises a ValueError for nan (also missing values of compact integer
+    datasets), non-integer or out of range values.
+    """
+    values = np.asarray(values).ravel()
+    if values.dtype.kind == "f":
+        bad = ~np.isfinite(values) | (values != np.round(values))
+    else:
+        bad = np.zeros(len(values), dtype=bool)
+    bad |= (values < 0) | (values >= n_classes)
+
+    if np.any(bad):
+        raise ValueError("{}: {} values are not classes 0 to {} (e.g. {})"
+                         .format(name, np.count_nonzero(bad), n_classes - 1,
+                                 values[bad][:5]))
+
+    return np.eye(n_classes, dtype=label_dtype)[values.astype(np.int64)]
+
+
+def load_data_decaymodeclf(sig, sig_slice, invars, num=None,
+                           dtype=float_dtype, n_classes=5):
     sig_pt = sig["TauJets/pt"][sig_slice]
     sig_len = len(sig_pt)
-    sig_weight = np.ones_like(sig_pt) # TODO: retrieve EventWeight instead
+    sig_weight = np.ones(sig_len, dtype=dtype) # TODO: retrieve EventWeight instead
     w = sig_weight
 
-    # Class labels (OneHotEncoded truth decay mode)
-    y = sig["TauJets/truthDecayMode"][sig_slice].reshape((-1, 1))
-    enc = OneHotEncoder(sparse=False)
-    y = enc.fit_transform(y)
+    # Class labels (one-hot encoded truth decay mode)
+    y = onehot_encode(sig["TauJets/truthDecayMode"][sig_slice], n_classes,
+                      name="TauJets/truthDecayMode")
 
     # Load variables
     n_vars = len(invars)
 
     # If number of timesteps given
     if num:
-        x = np.empty((sig_len, num, n_vars))
+        x = np.empty((sig_len, num, n_vars), dtype=dtype)
         sig_src = np.s_[sig_slice, :num]
     else:
-        x = np.empty((sig_len, n_vars))
+        x = np.empty((sig_len, n_vars), dtype=dtype)
         sig_src = np.s_[sig_slice]
+
+    # Datasets shared by several variables are read once
+    sig_reader = ReadPlan(sig, (invars, num)).reader()
+
     for i, (varname, func, _) in enumerate(invars):
         sig_dest = np.s_[:sig_len, ..., i]
 
         if func:
-            func(sig, x, source_sel=sig_src, dest_sel=sig_dest)
+            func(sig_reader, x, source_sel=sig_src, dest_sel=sig_dest)
         else:
-            sig[varname].read_direct(x, source_sel=sig_src, dest_sel=sig_dest)
+            sig_reader[varname].read_direct(x, source_sel=sig_src,
+                                            dest_sel=sig_dest)
 
     return Data(x=x, y=y, w=w)
 
 
 
+def fit_preprocessing(sources, invars, num=None, cut=None, chunksize=65536,
+                      workers=1):
+    """
+    Determines the preprocessing (offset, scale) of the variables 'invars'
+    (as 'preprocess' on the loaded data) in a single chunked pass over the
+    events [start, stop) of every (datafile, start, stop) in 'sources'
+    without loading the data. The moments of every variable are accumulated
+    per chunk (see 'rnn_tauid.preprocessing.Moments', with quantile sketches
+    for 'robust_scale') and the offsets and scales derived with
+    'preprocessing_from_moments'. Chunks are read by
+    'workers' threads and their accumulators merged in order. If 'cut' is
+    given as (variable index, threshold), objects with the variable below the
+    threshold are ignored.
+    """
+    n_vars = len(invars)
+    if num:
+        shape = (num,)
+    else:
+        shape = ()
+
+    # Quantile sketches only for the variables which need them
+    quantiles = [needs_quantiles(func) for _, _, func in invars]
+
+    tasks = []
+    for datafile, start, stop in sources:
+        plan = ReadPlan(datafile, (invars, num))
+        rows = aligned_chunksize(datafile, chunksize)
+        tasks.extend((datafile, plan, i, min(i + rows, stop))
+                     for i in range(start, stop, rows))
+
+    def fit_chunk(task):
+        datafile, plan, start, stop = task
+        x = np.empty((stop - start,) + shape + (n_vars,), dtype=float_dtype)
+        if num:
+            src = np.s_[start:stop, :num]
+        else:
+            src = np.s_[start:stop]
+
+        reader = plan.reader(datafile)
+        for i, (varname, func, _) in enumerate(invars):
+            dest = np.s_[..., i]
+            if func:
+                func(reader, x, source_sel=src, dest_sel=dest)
+            else:
+                reader[varname].read_direct(x, source_sel=src, dest_sel=dest)
+
+        if cut:
+            col, threshold = cut
+            x[x[..., col] < threshold] = np.nan
+
+        return [Moments(shape, quantiles=q).update(x[..., i])
+                for i, q in enumerate(quantiles)]
+
+    moments = [Moments(shape, quantiles=q) for q in quantiles]
+    if workers > 1:
+        pool = ThreadPool(workers)
+        parts = pool.imap(fit_chunk, tasks)
+    else:
+        pool = None
+        parts = (fit_chunk(task) for task in tasks)
+
+    try:
+        for part in parts:
+            for m, p in zip(moments, part):
+                m.merge(p)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    return [preprocessing_from_moments(func, m)
+            for (_, _, func), m in zip(invars, moments)]
+
+
 def parallel_shuffle(sequences):
     size = None
     for seq in sequences:
@@ -100,23 +900,84 @@ def parallel_shuffle(sequences):
         random_state.shuffle(seq)
 
 
-def train_test_split(data, test_size=0.2):
+def test_events(event_number, test_size=0.2):
+    """
+    Assigns events to the test set by their event number. The event numbers
+    are hashed (Fibonacci hashing), such that the same event is always in the
+    same set independent of the sample and of selections on the event number.
+    """
+    event_number = np.asarray(event_number).astype(np.uint64)
+    with np.errstate(over="ignore"):
+        h = (event_number * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(40)
+
+    return h < np.uint64(test_size * 2**24)
+
+
+def _split_in_place(arrays, test_size=0.2, event_number=None):
+    """
+    Reorders 'arrays' (same events) in place into a shuffled training block
+    followed by a shuffled test block. Returns the size of the training block.
+    """
+    n = len(arrays[0])
+    if event_number is None:
+        n_train = int((1.0 - test_size) * n)
+
+        parallel_shuffle(arrays)
+        return n_train
+
+    is_test = test_events(event_number, test_size)
+    assert len(is_test) == n
+    n_train = n - np.count_nonzero(is_test)
+
+    # Swap test events in the training block with training events in the test
+    # block (only these are copied)
+    to_test = np.flatnonzero(is_test[:n_train])
+    to_train = n_train + np.flatnonzero(~is_test[n_train:])
+    for arr in arrays:
+        tmp = arr[to_test]
+        arr[to_test] = arr[to_train]
+        arr[to_train] = tmp
+        del tmp
+
+    parallel_shuffle([arr[:n_train] for arr in arrays])
+    parallel_shuffle([arr[n_train:] for arr in arrays])
+    return n_train
+
+
+def split_indices(n, test_size=0.2, event_number=None):
+    """
+    Event indices (train, test) of the split done by 'train_test_split'
+    without touching the data.
+    """
+    index = np.arange(n)
+    n_train = _split_in_place([index], test_size=test_size,
+                              event_number=event_number)
+    return index[:n_train], index[n_train:]
+
+
+def train_test_split(data, test_size=0.2, event_number=None):
+    """
+    Splits 'data' (list of Data with the same events) into shuffled training
+    and test sets. The arrays are reordered in place into a training block
+    followed by a test block and the returned Data hold views of the blocks,
+    i.e. no copy of the data is made. The test set is a random 'test_size'
+    fraction of the events or, if 'event_number' is given, the events
+    selected by 'test_events'.
+    """
     if not isinstance(data, list):
         data = [data]
 
     assert len(data) >= 1
 
-    train_size = 1.0 - test_size
-    test_start, test_stop = int(train_size * len(data[0].y)), len(data[0].y)
-
-    train = slice(0, test_start)
-    test = slice(test_start, test_stop)
-
     arr = []
     for d in data:
         arr.extend([d.x, d.y, d.w])
 
-    parallel_shuffle(arr)
+    n_train = _split_in_place(arr, test_size=test_size,
+                              event_number=event_number)
+
+    train = slice(0, n_train)
+    test = slice(n_train, len(data[0].y))
 
     ret = []
     for d in data:
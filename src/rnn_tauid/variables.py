@@ -3,6 +3,7 @@ from functools import partial
 import numpy as np
 from rnn_tauid.preprocessing import scale, scale_flat, robust_scale, \
                                     constant_scale, min_max_scale
+from rnn_tauid.expressions import Transform
 
 
 # Template for log10(x + epsilon)
@@ -31,98 +32,55 @@ def abs_var(datafile, dest, source_sel=None, dest_sel=None, var=None):
 # ===== TAU IDENTIFICATION =====
 
 # Track variables
-pt_log = partial(log10_epsilon, var="TauTracks/pt")
+pt_log = Transform("log10(TauTracks/pt)")
 
-d0_abs = partial(abs_var, var="TauTracks/d0")
+d0_abs = Transform("abs(TauTracks/d0)")
 
-d0_abs_log = partial(abs_log10_epsilon,  var="TauTracks/d0", epsilon=1e-6)
+d0_abs_log = Transform("log10(abs(TauTracks/d0) + 1e-6)")
 
-z0sinThetaTJVA_abs = partial(abs_var, var="TauTracks/z0sinThetaTJVA")
+z0sinThetaTJVA_abs = Transform("abs(TauTracks/z0sinThetaTJVA)")
 
-z0sinThetaTJVA_abs_log = partial(abs_log10_epsilon,
-                                 var="TauTracks/z0sinThetaTJVA", epsilon=1e-6)
+z0sinThetaTJVA_abs_log = Transform(
+    "log10(abs(TauTracks/z0sinThetaTJVA) + 1e-6)")
 
-
-def pt_jetseed_log(datafile, dest, source_sel=None, dest_sel=None):
-    pt = datafile["TauJets/ptJetSeed"][source_sel[0]]
-    dest[dest_sel] = np.log10(pt[:, np.newaxis])
+pt_jetseed_log = Transform("log10(TauJets/ptJetSeed)")
 
 
 # Cluster variables
-et_log = partial(
-    log10_epsilon, var="TauClusters/et")
+et_log = Transform("log10(TauClusters/et)")
 
-SECOND_R_log = partial(
-    log10_epsilon, var="TauClusters/SECOND_R", epsilon=0.1)
+SECOND_R_log = Transform("log10(TauClusters/SECOND_R + 0.1)")
 
-SECOND_LAMBDA_log = partial(
-    log10_epsilon, var="TauClusters/SECOND_LAMBDA", epsilon=0.1)
+SECOND_LAMBDA_log = Transform("log10(TauClusters/SECOND_LAMBDA + 0.1)")
 
-FIRST_ENG_DENS_log = partial(
-    log10_epsilon, var="TauClusters/FIRST_ENG_DENS", epsilon=1e-6)
+FIRST_ENG_DENS_log = Transform("log10(TauClusters/FIRST_ENG_DENS + 1e-6)")
 
-CENTER_LAMBDA_log = partial(
-    log10_epsilon, var="TauClusters/CENTER_LAMBDA", epsilon=1e-6)
+CENTER_LAMBDA_log = Transform("log10(TauClusters/CENTER_LAMBDA + 1e-6)")
 
 
 # ID vars transformations
-def centFrac_trans(datafile, dest, source_sel=None, dest_sel=None):
-    datafile["TauJets/centFrac"].read_direct(dest, source_sel=source_sel,
-                                             dest_sel=dest_sel)
-    np.minimum(dest[dest_sel], 1.0, out=dest[dest_sel])
-
-def etOverPtLeadTrk_trans(datafile, dest, source_sel=None, dest_sel=None):
-    datafile["TauJets/etOverPtLeadTrk"].read_direct(dest, source_sel=source_sel,
-                                                    dest_sel=dest_sel)
-    np.maximum(dest[dest_sel], 0.1, out=dest[dest_sel])
-    np.log10(dest[dest_sel], out=dest[dest_sel])
+centFrac_trans = Transform("min(TauJets/centFrac, 1.0)")
 
-def absipSigLeadTrk_trans(datafile, dest, source_sel=None, dest_sel=None):
-    datafile["TauJets/absipSigLeadTrk"].read_direct(dest, source_sel=source_sel,
-                                                    dest_sel=dest_sel)
-    np.minimum(dest[dest_sel], 30.0, out=dest[dest_sel])
+etOverPtLeadTrk_trans = Transform("log10(max(TauJets/etOverPtLeadTrk, 0.1))")
 
-def EMPOverTrkSysP_trans(datafile, dest, source_sel=None, dest_sel=None):
-    datafile["TauJets/EMPOverTrkSysP"].read_direct(dest, source_sel=source_sel,
-                                                   dest_sel=dest_sel)
-    np.maximum(dest[dest_sel], 1e-3, out=dest[dest_sel])
-    np.log10(dest[dest_sel], out=dest[dest_sel])
+absipSigLeadTrk_trans = Transform("min(TauJets/absipSigLeadTrk, 30.0)")
 
-def ptRatioEflowApprox_trans(datafile, dest, source_sel=None, dest_sel=None):
-    datafile["TauJets/ptRatioEflowApprox"].read_direct(
-        dest, source_sel=source_sel, dest_sel=dest_sel)
-    np.minimum(dest[dest_sel], 4.0, out=dest[dest_sel])
+EMPOverTrkSysP_trans = Transform("log10(max(TauJets/EMPOverTrkSysP, 1e-3))")
 
-def mEflowApprox_trans(datafile, dest, source_sel=None, dest_sel=None):
-    datafile["TauJets/mEflowApprox"].read_direct(dest, source_sel=source_sel,
-                                                 dest_sel=dest_sel)
-    np.maximum(dest[dest_sel], 140.0, out=dest[dest_sel])
-    np.log10(dest[dest_sel], out=dest[dest_sel])
+ptRatioEflowApprox_trans = Transform("min(TauJets/ptRatioEflowApprox, 4.0)")
 
-def ptIntermediateAxis_trans(datafile, dest, source_sel=None, dest_sel=None):
-    datafile["TauJets/ptIntermediateAxis"].read_direct(
-        dest, source_sel=source_sel, dest_sel=dest_sel)
-    np.minimum(dest[dest_sel] / 1000.0, 100.0, out=dest[dest_sel])
-    np.log10(dest[dest_sel], out=dest[dest_sel])
+mEflowApprox_trans = Transform("log10(max(TauJets/mEflowApprox, 140.0))")
 
-def trFlightPathSig_trans(datafile, dest, source_sel=None, dest_sel=None):
-    datafile["TauJets/trFlightPathSig"].read_direct(dest, source_sel=source_sel,
-                                                    dest_sel=dest_sel)
-    np.maximum(dest[dest_sel], 0.01, out=dest[dest_sel])
-    np.log10(dest[dest_sel], out=dest[dest_sel])
+ptIntermediateAxis_trans = Transform(
+    "log10(min(TauJets/ptIntermediateAxis / 1000.0, 100.0))")
 
-def massTrkSys_trans(datafile, dest, source_sel=None, dest_sel=None):
-    datafile["TauJets/massTrkSys"].read_direct(dest, source_sel=source_sel,
-                                               dest_sel=dest_sel)
-    np.maximum(dest[dest_sel], 140.0, out=dest[dest_sel])
-    np.log10(dest[dest_sel], out=dest[dest_sel])
+trFlightPathSig_trans = Transform("log10(max(TauJets/trFlightPathSig, 0.01))")
+
+massTrkSys_trans = Transform("log10(max(TauJets/massTrkSys, 140.0))")
 
 # Old stuff
-def EMPOverTrkSysP_clip_log(datafile, dest, source_sel=None, dest_sel=None):
-    datafile["TauJets/EMPOverTrkSysP"].read_direct(dest, source_sel=source_sel,
-                                                   dest_sel=dest_sel)
-    np.clip(dest[dest_sel], 1e-3, np.inf, out=dest[dest_sel])
-    np.log10(dest[dest_sel], out=dest[dest_sel])
+EMPOverTrkSysP_clip_log = Transform(
+    "log10(max(TauJets/EMPOverTrkSysP, 1e-3))")
 
 
 # PFO variables
@@ -171,13 +129,14 @@ def Pt_jet_log(datafile, dest, source_sel=None, dest_sel=None,
 
 
 # For Track & Cluster RNN
-track_dEta = partial(dEta, var="TauTracks/eta", refvar="TauJets/eta")
-track_dPhi = partial(dPhi, var="TauTracks/phi", refvar="TauJets/phi")
-cluster_dEta = partial(dEta, var="TauClusters/eta", refvar="TauJets/eta")
-cluster_dPhi = partial(dPhi, var="TauClusters/phi", refvar="TauJets/phi")
+track_dEta = Transform("TauTracks/eta - TauJets/eta")
+track_dPhi = Transform("fmod(TauTracks/phi - TauJets/phi + pi, 2 * pi) - pi")
+cluster_dEta = Transform("TauClusters/eta - TauJets/eta")
+cluster_dPhi = Transform(
+    "fmod(TauClusters/phi - TauJets/phi + pi, 2 * pi) - pi")
 
 # Abs eta
-cluster_abs_eta = partial(abs_var, var="TauClusters/eta")
+cluster_abs_eta = Transform("abs(TauClusters/eta)")
 
 track_vars = [
     ("TauTracks/pt_log", pt_log, partial(scale, per_obj=False)),
@@ -237,46 +196,46 @@ id3p_vars = [
 # ===== DECAY MODE CLASSIFICATION =====
 
 # Charged PFO
-charged_Phi = partial(Phi, var="ChargedPFO/phi")
-charged_dPhi = partial(dPhi, var="ChargedPFO/phi")
-charged_Eta = partial(Eta, var="ChargedPFO/eta")
-charged_dEta = partial(dEta, var="ChargedPFO/eta")
-charged_Pt_log = partial(log10_epsilon, var="ChargedPFO/pt")
-charged_Pt_jet_log = partial(Pt_jet_log, var="ChargedPFO/pt")
+charged_Phi = Transform("ChargedPFO/phi * 0 + TauJets/jet_Phi")
+charged_dPhi = Transform(
+    "fmod(ChargedPFO/phi - TauJets/jet_Phi + pi, 2 * pi) - pi")
+charged_Eta = Transform("ChargedPFO/eta * 0 + TauJets/jet_Eta")
+charged_dEta = Transform("ChargedPFO/eta - TauJets/jet_Eta")
+charged_Pt_log = Transform("log10(ChargedPFO/pt)")
+charged_Pt_jet_log = Transform("ChargedPFO/pt * 0 + log10(TauJets/jet_Pt)")
 
 # Neutral PFO
-neutral_Phi = partial(Phi, var="NeutralPFO/phi")
-neutral_dPhi = partial(dPhi, var="NeutralPFO/phi")
-neutral_Eta = partial(Eta, var="NeutralPFO/eta")
-neutral_dEta = partial(dEta, var="NeutralPFO/eta")
-neutral_Pt_log = partial(log10_epsilon, var="NeutralPFO/pt")
-neutral_Pt_jet_log = partial(Pt_jet_log, var="NeutralPFO/pt")
-neutral_SECOND_R_log = partial(log10_epsilon, var="NeutralPFO/SECOND_R", epsilon=1)
-neutral_secondEtaWRTClusterPosition_EM1_log = partial(
-    log10_epsilon, var="NeutralPFO/secondEtaWRTClusterPosition_EM1", epsilon=1e-6)
-
-def PtSubRatio(datafile, dest, source_sel=None, dest_sel=None):
-    datafile["NeutralPFO/ptSub"].read_direct(dest, source_sel=source_sel,
-                                             dest_sel=dest_sel)
-    denom = datafile["NeutralPFO/pt"][source_sel]
-    np.add(dest[dest_sel], denom, out=denom)
-    np.divide(dest[dest_sel], denom, out=dest[dest_sel])
+neutral_Phi = Transform("NeutralPFO/phi * 0 + TauJets/jet_Phi")
+neutral_dPhi = Transform(
+    "fmod(NeutralPFO/phi - TauJets/jet_Phi + pi, 2 * pi) - pi")
+neutral_Eta = Transform("NeutralPFO/eta * 0 + TauJets/jet_Eta")
+neutral_dEta = Transform("NeutralPFO/eta - TauJets/jet_Eta")
+neutral_Pt_log = Transform("log10(NeutralPFO/pt)")
+neutral_Pt_jet_log = Transform("NeutralPFO/pt * 0 + log10(TauJets/jet_Pt)")
+neutral_SECOND_R_log = Transform("log10(NeutralPFO/SECOND_R + 1)")
+neutral_secondEtaWRTClusterPosition_EM1_log = Transform(
+    "log10(NeutralPFO/secondEtaWRTClusterPosition_EM1 + 1e-6)")
+
+PtSubRatio = Transform(
+    "NeutralPFO/ptSub / (NeutralPFO/ptSub + NeutralPFO/pt)")
 
 # Shots
-shot_Phi = partial(Phi, var="ShotPFO/phi")
-shot_dPhi = partial(dPhi, var="ShotPFO/phi")
-shot_Eta = partial(Eta, var="ShotPFO/eta")
-shot_dEta = partial(dEta, var="ShotPFO/eta")
-shot_Pt_log = partial(log10_epsilon, var="ShotPFO/pt")
-shot_Pt_jet_log = partial(Pt_jet_log, var="ShotPFO/pt")
+shot_Phi = Transform("ShotPFO/phi * 0 + TauJets/jet_Phi")
+shot_dPhi = Transform(
+    "fmod(ShotPFO/phi - TauJets/jet_Phi + pi, 2 * pi) - pi")
+shot_Eta = Transform("ShotPFO/eta * 0 + TauJets/jet_Eta")
+shot_dEta = Transform("ShotPFO/eta - TauJets/jet_Eta")
+shot_Pt_log = Transform("log10(ShotPFO/pt)")
+shot_Pt_jet_log = Transform("ShotPFO/pt * 0 + log10(TauJets/jet_Pt)")
 
 # Conversion tracks
-conv_Phi = partial(Phi, var="ConvTrack/phi")
-conv_dPhi = partial(dPhi, var="ConvTrack/phi")
-conv_Eta = partial(Eta, var="ConvTrack/eta")
-conv_dEta = partial(dEta, var="ConvTrack/eta")
-conv_Pt_log = partial(log10_epsilon, var="ConvTrack/pt")
-conv_Pt_jet_log = partial(Pt_jet_log, var="ConvTrack/pt")
+conv_Phi = Transform("ConvTrack/phi * 0 + TauJets/jet_Phi")
+conv_dPhi = Transform(
+    "fmod(ConvTrack/phi - TauJets/jet_Phi + pi, 2 * pi) - pi")
+conv_Eta = Transform("ConvTrack/eta * 0 + TauJets/jet_Eta")
+conv_dEta = Transform("ConvTrack/eta - TauJets/jet_Eta")
+conv_Pt_log = Transform("log10(ConvTrack/pt)")
+conv_Pt_jet_log = Transform("ConvTrack/pt * 0 + log10(TauJets/jet_Pt)")
 
 # Side-note: Phi and Eta in this case is the Phi/Eta of the underlying TauJet
 #            and not the one of the PFO (implementation detail)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Same as setup.sh
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "src"))
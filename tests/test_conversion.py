@@ -0,0 +1,198 @@
+import numpy as np
+import h5py
+import pytest
+
+from rnn_tauid.conversion import Container, write_container, write_stats, \
+    write_layout_attrs, combine_samples, is_stats_dataset, \
+    remove_stats, block_shuffle, create_staging, append_block, \
+    merge_container, block_size
+from rnn_tauid.preprocessing import load_stats, stats_group
+from rnn_tauid.utils import open_sample
+
+
+n_events = 200
+n_tracks = 10
+
+# Stacked statistics of 12 variables of 10 objects exceed 64 kB
+track_branches = ["TauTracks.var{}".format(i) for i in range(12)]
+
+
+def convert(filename, seed):
+    """Converts random events with a packed track and a dense jet container"""
+    random_state = np.random.RandomState(seed)
+    tracks = Container("TauTracks", track_branches, "TauTracks.var0",
+                       n_tracks, storage="packed")
+    jets = Container("TauJets", ["TauJets.pt"], None, None)
+
+    data = {br: random_state.normal(size=(n_events, n_tracks))
+            .astype(np.float32) for br in track_branches}
+    data["TauTracks.var1"][:, 5:] = np.nan
+
+    with h5py.File(filename, "w") as f:
+        write_container(f, tracks, data)
+        write_container(f, jets, {"TauJets.pt": random_state.exponential(
+            size=n_events).astype(np.float32)})
+        write_layout_attrs(f, [tracks, jets])
+        write_stats(f, [tracks, jets])
+
+
+def test_packed_stats(tmpdir):
+    filename = str(tmpdir.join("sample.h5"))
+    convert(filename, seed=1)
+
+    with open_sample(filename) as f:
+        assert "TauTracks/" + stats_group + "/hist" in f.file
+        for name in ["TauTracks/var1", "TauTracks/var11", "TauJets/pt"]:
+            x = f[name][...]
+            stats = load_stats(f, name)
+
+            np.testing.assert_array_equal(stats.count,
+                                          np.count_nonzero(~np.isnan(x), 0))
+            np.testing.assert_allclose(stats.sum, np.nansum(x, axis=0),
+                                       rtol=1e-5)
+            np.testing.assert_array_equal(stats.hist.sum(axis=-1),
+                                          stats.count)
+
+
+def test_combine_packed_stats(tmpdir):
+    filenames = [str(tmpdir.join("sample{}.h5".format(i))) for i in range(2)]
+    for i, fn in enumerate(filenames):
+        convert(fn, seed=i)
+
+    combined = str(tmpdir.join("combined.h5"))
+    srcfs = [h5py.File(fn, "r") for fn in filenames]
+    try:
+        with h5py.File(combined, "w") as outf:
+            assert combine_samples(outf, filenames, srcfs) == 2 * n_events
+    finally:
+        for f in srcfs:
+            f.close()
+
+    with open_sample(combined) as f:
+        assert not f.file["TauTracks/" + stats_group + "/count"].is_virtual
+        for name in ["TauTracks/var1", "TauTracks/var2"]:
+            x = f[name][...]
+            stats = load_stats(f, name)
+
+            np.testing.assert_array_equal(stats.count,
+                                          np.count_nonzero(~np.isnan(x), 0))
+            np.testing.assert_allclose(stats.sum, np.nansum(x, axis=0),
+                                       rtol=1e-5)
+
+        x = f["TauTracks/var2"][...]
+        np.testing.assert_array_equal(load_stats(f, "TauTracks/var2").min,
+                                      x.min(axis=0))
+
+
+def test_is_stats_dataset():
+    assert is_stats_dataset("TauTracks/_stats/hist")
+    assert not is_stats_dataset("TauTracks/packed")
+
+
+def test_remove_stats(tmpdir):
+    filename = str(tmpdir.join("sample.h5"))
+    convert(filename, seed=1)
+
+    tracks = Container("TauTracks", track_branches, "TauTracks.var0",
+                       n_tracks, storage="packed")
+    jets = Container("TauJets", ["TauJets.pt"], None, None)
+
+    with h5py.File(filename, "a") as f:
+        remove_stats(f, [tracks, jets])
+        assert "TauTracks/" + stats_group not in f
+        for name in ["TauTracks/var1", "TauJets/pt"]:
+            with pytest.raises(KeyError):
+                load_stats(f, name)
+
+
+def test_block_shuffle_ragged(tmpdir):
+    tracks = Container("TauTracks", track_branches, "TauTracks.var0",
+                       n_tracks, storage="ragged")
+    with h5py.File(str(tmpdir.join("sample.h5")), "w") as f:
+        with pytest.raises(ValueError):
+            block_shuffle(f, [tracks], n_events, 16)
+
+
+def random_container(container, seed):
+    """
+    Random events of a container (padded with NaN after a random number of
+    objects for sequences)
+    """
+    random_state = np.random.RandomState(seed)
+    shape = (n_events,) + ((container.max_len,) if container.max_len else ())
+
+    data = {br: random_state.normal(size=shape).astype(np.float32)
+            for br in container.branches}
+    if container.max_len:
+        counts = random_state.randint(0, container.max_len + 1, n_events)
+        padding = np.arange(container.max_len) >= counts[:, np.newaxis]
+        for br in container.branches:
+            data[br][padding] = np.nan
+
+    if container.flags:
+        data[container.name + ".selection"] = random_state.randint(
+            0, 4, n_events).astype(np.uint8)
+
+    return data
+
+
+def datasets(f):
+    """Contents of all datasets of an open hdf5 file"""
+    contents = {}
+    f.visititems(lambda name, node: contents.__setitem__(name, node[...])
+                 if isinstance(node, h5py.Dataset) else None)
+    return contents
+
+
+@pytest.mark.parametrize("storage", ["dense", "packed", "ragged"])
+@pytest.mark.parametrize("chunk_rows", [None, 16])
+def test_merge_container(tmpdir, storage, chunk_rows):
+    containers = [
+        Container("TauTracks", track_branches[:3], "TauTracks.var0",
+                  n_tracks, chunk_rows=chunk_rows, storage=storage),
+        Container("TauJets", ["TauJets.pt", "TauJets.eta"], None, None,
+                  chunk_rows=chunk_rows, storage=storage,
+                  flags=[("a", "TauJets.pt > 0"), ("b", "TauJets.eta > 0")])
+    ]
+
+    # Staged in two part files of unequal length
+    partfiles = [str(tmpdir.join("part{}.h5".format(i))) for i in range(2)]
+    data = [random_container(c, seed=i) for i, c in enumerate(containers)]
+    for fn, sel in zip(partfiles, [np.s_[:77], np.s_[77:]]):
+        with h5py.File(fn, "w") as f:
+            for container, d in zip(containers, data):
+                create_staging(f, container)
+                append_block(f, container, [{br: col[sel]
+                                             for br, col in d.items()}])
+
+    in_memory = str(tmpdir.join("in_memory.h5"))
+    with h5py.File(in_memory, "w") as f:
+        for container, d in zip(containers, data):
+            write_container(f, container, dict(d))
+
+    for budget in [None, 37]:
+        merged = str(tmpdir.join("merged_{}.h5".format(budget)))
+        with h5py.File(merged, "w") as f:
+            for container in containers:
+                # Blocks of 'budget' events not aligned with the part files
+                memory_budget = None
+                if budget:
+                    memory_budget = budget * 12 * \
+                        (len(container.branches) + 1) * \
+                        (container.max_len or 1)
+                    assert block_size(container, memory_budget) == budget
+
+                n = merge_container(f, container, partfiles,
+                                    memory_budget=memory_budget,
+                                    tmpdir=str(tmpdir))
+                assert n == n_events
+
+        with h5py.File(in_memory, "r") as f_ref, \
+                h5py.File(merged, "r") as f:
+            expected = datasets(f_ref)
+            result = datasets(f)
+
+            assert sorted(result) == sorted(expected)
+            for name in expected:
+                np.testing.assert_array_equal(result[name], expected[name])
+                assert f[name].chunks == f_ref[name].chunks
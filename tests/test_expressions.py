@@ -0,0 +1,183 @@
+import numpy as np
+import pytest
+
+from rnn_tauid import cuts
+from rnn_tauid.expressions import Expression, Transform, parse, tokenize, \
+    evaluate, to_numexpr, variables
+
+
+n_events = 1000
+
+
+def random_columns(seed=0):
+    """Random 'TauJets' columns of the variables in 'rnn_tauid.cuts'"""
+    random_state = np.random.RandomState(seed)
+
+    def uniform(low, high):
+        return random_state.uniform(low, high, n_events).astype(np.float32)
+
+    columns = {
+        "TauJets.nTracks": random_state.randint(0, 5, n_events),
+        "TauJets.truthProng": random_state.randint(0, 5, n_events),
+        "TauJets.IsTruthMatched": random_state.randint(0, 2, n_events),
+        "TauJets.eta": uniform(-3, 3),
+        "TauJets.truthEtaVis": uniform(-3, 3),
+        "TauJets.pt": uniform(0, 50000),
+        "TauJets.truthPtVis": uniform(0, 50000)
+    }
+
+    # Values at the cut boundaries
+    columns["TauJets.eta"][:4] = [2.5, -1.37, 1.52, -2.5]
+    columns["TauJets.pt"][:2] = 20000.0
+
+    return columns
+
+
+@pytest.mark.parametrize("name", sorted(cuts.sel_dict))
+def test_cut_backends(name):
+    numexpr = pytest.importorskip("numexpr")
+    columns = random_columns()
+    cut = cuts.sel_dict[name]
+
+    numpy_cut = cuts.compile_cut(cut, backend="numpy")
+    numexpr_cut = cuts.compile_cut(cut, backend="numexpr")
+    assert numexpr_cut.backend == "numexpr"
+
+    mask = numpy_cut(columns)
+    assert mask.dtype == np.bool_
+    assert 0 < np.count_nonzero(mask) < n_events
+    np.testing.assert_array_equal(mask, numexpr_cut(columns))
+
+    # Translated expression evaluated directly with numexpr
+    tree = parse(cut)
+    names = {var: "v{}".format(i) for i, var in enumerate(variables(tree))}
+    result = numexpr.evaluate(to_numexpr(tree, names), local_dict={
+        names[var]: columns[var] for var in names})
+    np.testing.assert_array_equal(mask, result)
+
+
+def test_cut_reference():
+    c = random_columns()
+    mask = cuts.compile_cut(cuts.sel_1p)(c)
+
+    eta = np.abs(c["TauJets.eta"])
+    reference = (eta < 2.5) & ((eta < 1.37) | (eta > 1.52)) & \
+        (c["TauJets.pt"] > 20000) & (c["TauJets.nTracks"] == 1)
+    np.testing.assert_array_equal(mask, reference)
+
+
+def test_dataset_names():
+    c = random_columns()
+    columns = {k.replace(".", "/"): v for k, v in c.items()}
+
+    np.testing.assert_array_equal(
+        cuts.compile_cut(cuts.sel_3p)(columns),
+        cuts.compile_cut(cuts.sel_3p)(c))
+    np.testing.assert_allclose(
+        Expression("TauJets/pt / 1000")(columns), c["TauJets.pt"] / 1000,
+        rtol=1e-6)
+
+
+def test_tokenize():
+    assert tokenize("abs(TauJets.eta)<2.5") == [
+        ("name", "abs"), ("op", "("), ("name", "TauJets.eta"), ("op", ")"),
+        ("op", "<"), ("num", "2.5")]
+    assert tokenize("TMath::Abs(a) >= 1e-3") == [
+        ("name", "TMath::Abs"), ("op", "("), ("name", "a"), ("op", ")"),
+        ("op", ">="), ("num", "1e-3")]
+
+    with pytest.raises(SyntaxError):
+        tokenize("a $ b")
+
+
+@pytest.mark.parametrize("expr, expected", [
+    ("1 + 2 * 3", 7),
+    ("(1 + 2) * 3", 9),
+    ("2 * 3 % 4", 2),
+    ("-2 * -3", 6),
+    ("1 + 2 == 3", True),
+    ("1 || 0 && 0", True),
+    ("!0 && 0", False),
+    ("!(1 == 2)", True),
+    ("fmod(7, 3) + TMath::Abs(-1)", 2),
+    ("max(1, min(5, 3))", 3)
+])
+def test_precedence(expr, expected):
+    assert evaluate(parse(expr), {}) == expected
+
+
+@pytest.mark.parametrize("expr", [
+    "a < b < c",
+    "a == b != c",
+    "(a + b",
+    "a b",
+    "unknown(a)",
+    "a +"
+])
+def test_syntax_error(expr):
+    with pytest.raises(SyntaxError):
+        parse(expr)
+
+
+def test_mod_fallback():
+    pytest.importorskip("numexpr")
+    c = random_columns()
+
+    # Integer modulo is evaluated with numpy
+    expr = Expression("TauJets.nTracks % 2 == 1")
+    assert expr.backend == "numpy"
+    np.testing.assert_array_equal(expr(c), c["TauJets.nTracks"] % 2 == 1)
+
+    with pytest.raises(RuntimeError):
+        Expression("TauJets.nTracks % 2 == 1", backend="numexpr")
+
+    # Truncated towards zero (as in TTreeFormula)
+    np.testing.assert_array_equal(
+        Expression("a % 2")({"a": np.array([-3.5, 3.5])}), [-1, 1])
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        Expression("a", backend="cuda")
+
+
+def test_boolean():
+    columns = {"a": np.array([0.0, 2.0, -1.0])}
+    for backend in ("numpy", "auto"):
+        np.testing.assert_array_equal(
+            Expression("a", backend=backend, boolean=True)(columns),
+            [False, True, True])
+        np.testing.assert_array_equal(
+            Expression("!a || a > 1", backend=backend)(columns),
+            [True, True, False])
+
+
+def test_missing_variable():
+    with pytest.raises(KeyError):
+        Expression("TauJets.pt > 0")({"TauJets.eta": np.zeros(2)})
+
+
+@pytest.mark.parametrize("backend", ["numpy", "numexpr"])
+def test_transform(backend):
+    if backend == "numexpr":
+        pytest.importorskip("numexpr")
+
+    random_state = np.random.RandomState(1)
+    datafile = {
+        "TauJets/pt": random_state.exponential(size=20).astype(np.float32),
+        "TauTracks/pt": random_state.exponential(size=(20, 4))
+        .astype(np.float32)
+    }
+
+    func = Transform("log10(TauTracks/pt / TauJets/pt)", backend=backend)
+    assert func.backend == backend
+
+    dest = np.zeros((10, 4, 2), dtype=np.float32)
+    func(datafile, dest, source_sel=np.s_[5:15, :], dest_sel=np.s_[..., 1],
+         offset=1.0, scale=2.0)
+
+    expected = np.log10(datafile["TauTracks/pt"][5:15] /
+                        datafile["TauJets/pt"][5:15, np.newaxis])
+    np.testing.assert_allclose(dest[..., 1], (expected - 1.0) / 2.0,
+                               rtol=1e-5)
+    np.testing.assert_array_equal(dest[..., 0], 0)
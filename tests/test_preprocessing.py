@@ -0,0 +1,215 @@
+import pickle
+from functools import partial
+
+import numpy as np
+import pytest
+
+from rnn_tauid.preprocessing import QuantileSketch, Moments, PtReweighter, \
+    scale, scale_flat, robust_scale, min_max_scale, max_scale, \
+    preprocessing_from_moments, robust_scale_from_moments, needs_quantiles
+
+
+quantiles = np.linspace(0.01, 0.99, 99)
+
+
+def rank_error(sketch, x):
+    """Maximum deviation of the ranks of the sketch quantiles from q"""
+    x = np.sort(x)
+    estimate = sketch.quantile(quantiles)
+    lo = np.searchsorted(x, estimate, side="left") / float(len(x))
+    hi = np.searchsorted(x, estimate, side="right") / float(len(x))
+
+    return np.max(np.maximum(lo - quantiles, quantiles - hi).clip(0))
+
+
+def sample(n, seed=0):
+    random_state = np.random.RandomState(seed)
+    return random_state.exponential(scale=30000.0, size=n)
+
+
+def test_sketch_exact():
+    # Exact (as 'np.percentile') until the first compaction
+    x = sample(200)
+    sketch = QuantileSketch().update(x)
+    np.testing.assert_allclose(sketch.quantile(quantiles),
+                               np.percentile(x, 100 * quantiles))
+    np.testing.assert_allclose(sketch.percentile([0, 50, 100]),
+                               np.percentile(x, [0, 50, 100]))
+
+
+@pytest.mark.parametrize("chunk", [1000, 100000])
+def test_sketch_rank_error(chunk):
+    x = sample(100000)
+    sketch = QuantileSketch()
+    for start in range(0, len(x), chunk):
+        sketch.update(x[start:start + chunk])
+
+    assert sketch.n == len(x)
+    assert sketch.min == x.min() and sketch.max == x.max()
+    assert sum(len(level) for level in sketch.levels) < 3 * sketch.k
+    assert rank_error(sketch, x) < 0.01
+
+
+def test_sketch_merge():
+    x = sample(100000)
+    parts = [QuantileSketch(seed=i).update(part)
+             for i, part in enumerate(np.array_split(x, 8))]
+
+    # As filled in worker processes
+    parts = [pickle.loads(pickle.dumps(part)) for part in parts]
+
+    sketch = parts[0]
+    for part in parts[1:]:
+        sketch.merge(part)
+
+    assert sketch.n == len(x)
+    assert rank_error(sketch, x) < 0.01
+
+    with pytest.raises(ValueError):
+        sketch.merge(QuantileSketch(k=128))
+
+
+def test_sketch_nan():
+    x = sample(300)
+    x[::3] = np.nan
+
+    sketch = QuantileSketch().update(x)
+    assert sketch.n == np.count_nonzero(~np.isnan(x))
+    np.testing.assert_allclose(sketch.quantile(0.5), np.nanmedian(x))
+
+    assert np.all(np.isnan(QuantileSketch().quantile([0.1, 0.9])))
+
+
+def random_objects(n=5000, n_obj=6, seed=1):
+    """Sequences with nan after a random number of objects"""
+    random_state = np.random.RandomState(seed)
+    arr = random_state.normal(loc=100.0, scale=20.0,
+                              size=(n, n_obj)).astype(np.float32)
+    counts = random_state.randint(0, n_obj, n)
+    arr[np.arange(n_obj) >= counts[:, np.newaxis]] = np.nan
+
+    # Last object never present
+    arr[:, -1] = np.nan
+
+    return arr
+
+
+def test_moments_merge():
+    arr = random_objects()
+
+    chunked = Moments(arr.shape[1:])
+    for start in range(0, len(arr), 700):
+        chunked.update(arr[start:start + 700])
+
+    merged = Moments(arr.shape[1:])
+    for part in np.array_split(arr, 3):
+        merged.merge(Moments(arr.shape[1:]).update(part))
+
+    valid = ~np.isnan(arr[:, :-1])
+    for moments in (chunked, merged):
+        assert moments.n_events == len(arr)
+        np.testing.assert_array_equal(moments.count,
+                                      np.count_nonzero(~np.isnan(arr), 0))
+        np.testing.assert_array_equal(moments.n_nan,
+                                      np.count_nonzero(np.isnan(arr), 0))
+
+        np.testing.assert_allclose(
+            moments.mean[:-1],
+            np.nanmean(arr[:, :-1], axis=0, dtype=np.float64), rtol=1e-10)
+        np.testing.assert_allclose(
+            moments.std[:-1],
+            np.nanstd(arr[:, :-1], axis=0, dtype=np.float64), rtol=1e-8)
+        np.testing.assert_array_equal(
+            moments.min[:-1], np.where(valid, arr[:, :-1], np.inf).min(0))
+        np.testing.assert_array_equal(
+            moments.max[:-1], np.where(valid, arr[:, :-1], -np.inf).max(0))
+
+        total = moments.total()
+        np.testing.assert_allclose(total.mean,
+                                   np.nanmean(arr, dtype=np.float64),
+                                   rtol=1e-10)
+        np.testing.assert_allclose(total.std,
+                                   np.nanstd(arr, dtype=np.float64),
+                                   rtol=1e-8)
+
+
+@pytest.mark.parametrize("func", [
+    scale,
+    partial(scale, per_obj=False),
+    partial(scale, std=False),
+    min_max_scale,
+    partial(min_max_scale, per_obj=False),
+    max_scale
+])
+def test_preprocessing_from_moments(func):
+    arr = random_objects()[:, :-1]
+    moments = Moments(arr.shape[1:])
+    for part in np.array_split(arr, 4):
+        moments.update(part)
+
+    offset, scale_ = preprocessing_from_moments(func, moments)
+    expected_offset, expected_scale = func(arr)
+
+    np.testing.assert_allclose(offset, expected_offset, rtol=1e-5)
+    np.testing.assert_allclose(scale_, expected_scale, rtol=1e-5)
+
+
+def test_scale_flat_from_moments():
+    arr = sample(10000).astype(np.float32)
+    moments = Moments().update(arr[:4000]).update(arr[4000:])
+
+    np.testing.assert_allclose(preprocessing_from_moments(scale_flat, moments),
+                               scale_flat(arr), rtol=1e-5)
+
+
+def test_robust_scale_from_moments():
+    arr = random_objects(n=50000)[:, :-1]
+    assert needs_quantiles(partial(robust_scale, low_perc=10.0))
+
+    with pytest.raises(ValueError):
+        robust_scale_from_moments(Moments(arr.shape[1:]).update(arr))
+
+    moments = Moments(arr.shape[1:], quantiles=True)
+    for part in np.array_split(arr, 10):
+        moments.update(part)
+
+    offset, scale_ = robust_scale_from_moments(moments)
+    expected_offset, expected_scale = robust_scale(arr)
+
+    # Within the rank error (1% of the values, normal with sigma 20)
+    np.testing.assert_allclose(offset, expected_offset, atol=0.5)
+    np.testing.assert_allclose(scale_, expected_scale, atol=1.0)
+
+
+def test_pt_reweighter_from_sketch():
+    random_state = np.random.RandomState(2)
+    sig_pt = 20000.0 + random_state.exponential(40000.0, size=50000)
+    bkg_pt = 20000.0 + random_state.exponential(25000.0, size=50000)
+
+    exact = PtReweighter().fit(sig_pt, bkg_pt)
+
+    sketch = QuantileSketch()
+    reweighter = PtReweighter()
+    for start in range(0, len(bkg_pt), 5000):
+        sketch.update(bkg_pt[start:start + 5000])
+    reweighter.set_binning(sketch)
+    for start in range(0, len(bkg_pt), 5000):
+        reweighter.update(sig_pt[start:start + 5000],
+                          bkg_pt[start:start + 5000])
+
+    assert reweighter.n_bins == exact.n_bins
+    np.testing.assert_array_equal(reweighter.bin_edges[[0, -1]],
+                                  exact.bin_edges[[0, -1]])
+
+    # Background equally distributed over the bins within the rank error
+    fraction = reweighter.bkg_counts / len(bkg_pt)
+    np.testing.assert_allclose(fraction, 1.0 / exact.n_bins, atol=0.01)
+
+    # Reweighted background follows the signal spectrum
+    sig_w, bkg_w = reweighter.transform(sig_pt, bkg_pt)
+    np.testing.assert_array_equal(sig_w, 1)
+    bkg_hist = np.bincount(reweighter.bin_index(bkg_pt), weights=bkg_w,
+                           minlength=reweighter.n_bins)
+    np.testing.assert_allclose(bkg_hist / bkg_hist.sum(),
+                               reweighter.sig_counts / len(sig_pt),
+                               rtol=1e-6)
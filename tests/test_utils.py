@@ -0,0 +1,160 @@
+import tracemalloc
+
+import numpy as np
+import h5py
+import pytest
+
+from rnn_tauid.utils import load_data, open_sample, onehot_encode
+
+
+n_events = 20000
+n_tracks = 10
+
+track_vars = [("TauTracks/pt", None, None), ("TauTracks/eta", None, None),
+              ("TauTracks/phi", None, None), ("TauTracks/d0", None, None)]
+
+
+def write_sample(filename, seed):
+    """Synthetic sample of jet pt (in MeV) and track variables"""
+    random_state = np.random.RandomState(seed)
+    with h5py.File(filename, "w") as f:
+        f["TauJets/pt"] = 20000.0 + 1e5 * random_state.exponential(
+            size=n_events).astype(np.float32)
+        for varname, _, _ in track_vars:
+            f[varname] = random_state.normal(
+                size=(n_events, 2 * n_tracks)).astype(np.float32)
+
+
+def peak_memory(func, *args, **kwargs):
+    """Result and peak of the memory allocated by 'func'"""
+    tracemalloc.start()
+    try:
+        result = func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return result, peak
+
+
+def test_load_data_dtype(tmpdir):
+    sig_fn = str(tmpdir.join("sig.h5"))
+    bkg_fn = str(tmpdir.join("bkg.h5"))
+    write_sample(sig_fn, seed=1)
+    write_sample(bkg_fn, seed=2)
+
+    with open_sample(sig_fn) as sig, open_sample(bkg_fn) as bkg:
+        args = (sig, bkg, np.s_[:], np.s_[:], track_vars)
+
+        data, peak = peak_memory(load_data, *args, num=n_tracks,
+                                 dtype=np.float32)
+        data64, peak64 = peak_memory(load_data, *args, num=n_tracks,
+                                     dtype=np.float64)
+
+    assert data.x.dtype == np.float32
+    assert data.w.dtype == np.float32
+    assert data.y.dtype == np.uint8
+    assert data.x.shape == (2 * n_events, n_tracks, len(track_vars))
+    np.testing.assert_array_equal(data.y[:n_events], 1)
+    np.testing.assert_array_equal(data.y[n_events:], 0)
+
+    # Same values as in double precision
+    np.testing.assert_array_equal(data.x, data64.x.astype(np.float32))
+
+    # Inputs dominate the memory, about half of the double precision load
+    assert peak < 0.6 * peak64
+
+
+def test_onehot_encode():
+    y = onehot_encode(np.array([0, 4, 2], dtype=np.int8), 5)
+    assert y.dtype == np.uint8
+    np.testing.assert_array_equal(y, np.eye(5)[[0, 4, 2]])
+    np.testing.assert_array_equal(onehot_encode([1.0, 3.0], 5),
+                                  np.eye(5)[[1, 3]])
+
+    for values in ([0, 5], [-1, 2], [0.5], [np.nan, 1.0]):
+        with pytest.raises(ValueError):
+            onehot_encode(values, 5)
+
+
+def test_onehot_encode_compact_nan(tmpdir):
+    filename = str(tmpdir.join("sample.h5"))
+    with h5py.File(filename, "w") as f:
+        dset = f.create_dataset("TauJets/truthDecayMode",
+                                data=np.array([0, 1, -128, 3], dtype=np.int8))
+        dset.attrs["nan_value"] = np.int8(-128)
+
+    with open_sample(filename) as f:
+        column = f["TauJets/truthDecayMode"]
+        onehot_encode(column[:2], 5)
+        with pytest.raises(ValueError):
+            onehot_encode(column[:], 5)
+
+
+def write_flagged_sample(filename, n=5000, seed=3):
+    """Sample with a selection flag 'odd' (bit 0) and 'low' (bit 1)"""
+    random_state = np.random.RandomState(seed)
+    pt = random_state.exponential(size=n).astype(np.float32)
+    tracks = random_state.normal(size=(n, 2 * n_tracks)).astype(np.float32)
+    bits = ((np.arange(n) % 2 == 1) | ((pt < 0.5) << 1)).astype(np.uint8)
+
+    with h5py.File(filename, "w") as f:
+        f["TauJets/pt"] = pt
+        f["TauTracks/pt"] = tracks
+        dset = f.create_dataset("TauJets/selection", data=bits)
+        dset.attrs["flags"] = np.array(["odd", "low"], "S")
+
+    return pt, tracks, bits
+
+
+def test_subset_read(tmpdir, monkeypatch):
+    filename = str(tmpdir.join("flagged.h5"))
+    pt, tracks, bits = write_flagged_sample(filename)
+
+    # Many windows
+    from rnn_tauid.utils import SubsetColumn
+    monkeypatch.setattr(SubsetColumn, "span_rows", 97)
+
+    for flag, bit in [("odd", 0), ("low", 1)]:
+        index = np.flatnonzero(bits & (1 << bit))
+        with open_sample(filename, selection=flag) as f:
+            col = f["TauTracks/pt"]
+            assert len(f["TauJets/pt"]) == len(index)
+
+            np.testing.assert_array_equal(f["TauJets/pt"][...], pt[index])
+            np.testing.assert_array_equal(col[10:300, :n_tracks],
+                                          tracks[index[10:300], :n_tracks])
+            np.testing.assert_array_equal(col[::-3], tracks[index[::-3]])
+            np.testing.assert_array_equal(col[[5, 2, 2, 40]],
+                                          tracks[index[[5, 2, 2, 40]]])
+            np.testing.assert_array_equal(col[7], tracks[index[7]])
+            assert col[0:0].shape == (0, 2 * n_tracks)
+
+            # Into a view of the destination
+            dest = np.zeros((len(index), n_tracks, 2), dtype=np.float32)
+            col.read_direct(dest, source_sel=np.s_[:, :n_tracks],
+                            dest_sel=np.s_[..., 1])
+            np.testing.assert_array_equal(dest[..., 1],
+                                          tracks[index, :n_tracks])
+            np.testing.assert_array_equal(dest[..., 0], 0)
+
+
+def test_subset_read_memory(tmpdir, monkeypatch):
+    filename = str(tmpdir.join("flagged.h5"))
+    n = 50000
+    _, tracks, bits = write_flagged_sample(filename, n=n)
+
+    from rnn_tauid.utils import SubsetColumn
+    monkeypatch.setattr(SubsetColumn, "span_rows", 1024)
+
+    with open_sample(filename, selection="low") as f:
+        col = f["TauTracks/pt"]
+        dest = np.empty(col.shape, dtype=np.float32)
+        _, peak = peak_memory(col.read_direct, dest)
+
+    index = np.flatnonzero(bits & 2)
+    np.testing.assert_array_equal(dest, tracks[index])
+
+    # Windows of the column instead of the full span (or a copy of the
+    # result)
+    assert peak < 0.2 * tracks.nbytes